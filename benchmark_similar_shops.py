@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import logging
+import multiprocessing
+import numpy as np
+from command_line import parse_options
+from record_stream import RecordWriter, iter_records
+from resource_usage import measure
+from similarity_engine import get_term_matrix, normalize_rows, get_top_similar
+from synthetic_shops import SyntheticShops
+from term_vectors import Vocabulary, get_document_counts, get_term_filter
+from lsi_backends import BACKENDS, GensimLsi, RandomizedLsi
+import get_similar_shops
+import get_similar_shops_lsi
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+# (the similarity scripts imported above have already set logging up, at ERROR,
+# and Gensim's progress messages would bury the results)
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger('gensim').setLevel(logging.WARNING)
+
+# Command line options and their defaults
+OPTIONS = {
+    'sizes': '1000,10000,100000,1000000',
+    'seed': 0,
+    'data_dir': None,
+    'backend': 'gensim',
+    'num_topics': 100,
+    'search_queries': 1000,
+    'baseline': None,
+    'tolerance': 0.25,
+}
+
+# Version of the layout of the results file
+RESULTS_VERSION = 1
+
+# Pipeline stages measured at each size, in the order they run
+STAGES = ('ingest', 'tokenize', 'weight', 'tfidf_search', 'lsi', 'lsi_search')
+
+# Measurements of each stage compared against a baseline
+MEASURED = ('seconds', 'peak_rss_mb')
+
+# Smallest measurements compared against a baseline (smaller ones are noise)
+MIN_SECONDS = 0.1
+MIN_PEAK_RSS_MB = 50.0
+
+def main():
+
+    # Command line arguments (1):
+    #         1. the name of the .json file to save the results to
+    # Options:
+    #         --sizes N,N,...: the numbers of shops to benchmark (default 1000,10000,100000,1000000)
+    #         --seed N: the seed of the synthetic shops (default 0)
+    #         --data-dir DIR: keep the synthetic shop files in DIR, and reuse them in
+    #                         later runs (otherwise they are generated in a temporary
+    #                         directory and removed)
+    #         --backend NAME: fit LSI with "gensim" (the default) or "randomized"
+    #         --num-topics N: the number of LSI topics (default 100)
+    #         --search-queries N: score the first N shops against all the others in the
+    #                             search stages, projecting the time to score every
+    #                             shop (default 1000, 0 for every shop)
+    #         --baseline FILE: compare against the results file of an earlier run, and
+    #                          exit with status 1 if any stage got slower or bigger
+    #         --tolerance F: the fraction a stage may grow by before it counts
+    #                        as a regression (default 0.25)
+    # Output: runs every stage of the pipelines of get_similar_shops.py and
+    #         get_similar_shops_lsi.py on synthetic shops of each size (each size in
+    #         a fresh process), printing and saving each stage's wall and CPU time
+    #         and peak resident memory
+
+    # Check command line arguments
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        output_file = args[0]
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        if options['backend'] not in BACKENDS:
+            raise ValueError("Unknown backend " + options['backend'])
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+    except:
+        e = sys.exc_info()[0]
+        logging.error("We had an error with command line args: " + str(e))
+        return
+
+    data_dir = options['data_dir'] or tempfile.mkdtemp(prefix='benchmark-')
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'options': dict((name, options[name]) for name in ('seed', 'backend', 'num_topics', 'search_queries')),
+        'sizes': [],
+    }
+
+    # Generate and benchmark each size in fresh processes, so each size's
+    # memory is measured (and released) apart from everything else
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for size in sizes:
+            shops_file = pool.apply(get_shops_file, (data_dir, size, options['seed']))
+            result = pool.apply(benchmark_size, (shops_file, options['backend'], options['num_topics'], options['search_queries']))
+            results['sizes'].append(result)
+            print_result(result)
+            output_json(results, output_file)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if not options['data_dir']:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    logging.info("Saved results to " + output_file + ".")
+
+    if baseline is not None:
+        regressions = compare_results(results, baseline, options['tolerance'])
+        if regressions:
+            sys.exit(1)
+
+def get_shops_file(data_dir, num_shops, seed):
+
+    # Input: the directory of the synthetic shop files, the number of shops,
+    #        and the seed of the shops
+    # Output: the name of a file of the synthetic shops, generating it
+    #         unless an earlier run already did
+
+    name = os.path.join(data_dir, 'shops-' + str(seed) + '-' + str(num_shops))
+    file_name = name + '.jsonl.gz'
+    if os.path.exists(file_name):
+        return file_name
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    # The shops are written under a temporary name, so an interrupted run
+    # never leaves an incomplete file to be reused
+    start = time.time()
+    writer = RecordWriter(name + '.tmp.jsonl.gz', flush_every=1000)
+    try:
+        for shop in SyntheticShops(seed).iter_shops(num_shops):
+            writer.write(shop)
+    finally:
+        writer.close()
+    os.rename(name + '.tmp.jsonl.gz', file_name)
+    logging.info("Generated " + str(num_shops) + " synthetic shops in " + str(round(time.time() - start, 2)) + "s.")
+    return file_name
+
+def benchmark_size(shops_file, backend, num_topics, search_queries):
+
+    # Input: the name of a shops file, the LSI backend and number of topics,
+    #        and the number of shops to score in the search stages (0 for all)
+    # Output: a hash of the corpus's sizes, and of the measurements of each stage:
+    #         ingest (reading the shops), tokenize (reading the shops again,
+    #         extracting and cleaning their terms and counting them), weight
+    #         (tf-idf weighting and the normalized term matrix), tfidf_search
+    #         (scoring shops against the term matrix), lsi (fitting LSI and
+    #         projecting the shops) and lsi_search (scoring shops against the LSI vectors)
+
+    stages = {}
+    (num_shops, num_listings), stages['ingest'] = measure(count_shops, shops_file)
+    vocabulary = Vocabulary()
+    shops, stages['tokenize'] = measure(get_similar_shops.read_shops, shops_file, None, vocabulary)
+    vectors = [shop['term_counts'] for shop in shops]
+    matrix, stages['weight'] = measure(get_tfidf_matrix, vectors, len(vocabulary))
+    queries = min(search_queries or num_shops, num_shops)
+    top, stages['tfidf_search'] = measure(search, matrix, matrix, queries)
+    nonzeros = matrix.nnz
+    del matrix
+    lsi, stages['lsi'] = measure(fit_lsi, vectors, vocabulary, backend, num_topics)
+    top, stages['lsi_search'] = measure(search, lsi[0], lsi[1], queries)
+
+    # Project the time it would take to score every shop
+    for stage in ('tfidf_search', 'lsi_search'):
+        stages[stage]['projected_seconds'] = round(stages[stage]['seconds'] * num_shops / max(1, queries), 3)
+    return {
+        'shops': num_shops,
+        'listings': num_listings,
+        'tokens': int(sum(vector.values.sum() for vector in vectors)),
+        'terms': len(vocabulary),
+        'nonzeros': nonzeros,
+        'search_queries': queries,
+        'stages': stages,
+    }
+
+def count_shops(shops_file):
+
+    # Input: the name of a shops file
+    # Output: a (shops, listings) pair of the numbers of shops and listings read
+
+    num_shops = 0
+    num_listings = 0
+    for shop in iter_records(shops_file):
+        num_shops += 1
+        num_listings += len(shop['listings'])
+    return num_shops, num_listings
+
+def get_tfidf_matrix(vectors, num_terms):
+
+    # Input: a list of TermVectors of shop term counts, and the size of their vocabulary
+    # Output: the normalized matrix of the shops' tf-idf weights,
+    #         weighted as get_similar_shops.py weights them
+
+    document_counts = get_document_counts(vectors, num_terms)
+    idfs = get_similar_shops.get_idfs(document_counts, len(vectors))
+    weights = [get_similar_shops.get_term_weights(vector, idfs) for vector in vectors]
+    return normalize_rows(get_term_matrix(weights, num_terms))
+
+def fit_lsi(vectors, vocabulary, backend, num_topics):
+
+    # Input: a list of TermVectors of shop term counts, their Vocabulary,
+    #        the LSI backend, and the number of topics
+    # Output: a (query vectors, index vectors) pair of the shops' LSI vectors,
+    #         fit with get_similar_shops_lsi.py's default options
+
+    defaults = get_similar_shops_lsi.OPTIONS
+    keep = get_term_filter(vectors, len(vocabulary), defaults['min_count'], defaults['min_df'], defaults['max_df'], defaults['max_terms'])
+    if backend == 'randomized':
+        lsi = RandomizedLsi(vectors, vocabulary, keep, num_topics, defaults['oversampling'], defaults['power_iterations'])
+    else:
+        lsi = GensimLsi(vectors, vocabulary, keep, num_topics, defaults['oversampling'], defaults['power_iterations'])
+    return lsi.get_query_vectors(), lsi.get_index_vectors()
+
+def search(query_matrix, index_matrix, queries):
+
+    # Input: normalized matrices of query and index vectors,
+    #        and the number of query rows to score
+    # Output: a list of the top six similarities of each of the first queries rows
+
+    return list(get_top_similar(query_matrix, index_matrix, 6, stop=queries))
+
+def print_result(result):
+
+    # Input: the results hash of one size
+    # Output: prints the size's corpus and a line of measurements per stage
+
+    print (
+        str(result['shops']) + " shops (" + str(result['listings']) + " listings, "
+        + str(result['tokens']) + " tokens, " + str(result['terms']) + " terms):"
+    )
+    for stage in STAGES:
+        measurements = result['stages'][stage]
+        line = (
+            " " + stage.ljust(13) + str(measurements['seconds']).rjust(10) + "s"
+            + str(measurements['cpu_seconds']).rjust(10) + "s CPU"
+            + str(measurements['peak_rss_mb']).rjust(10) + " MB peak"
+        )
+        if 'projected_seconds' in measurements:
+            line += " (" + str(measurements['projected_seconds']) + "s for all shops)"
+        print line
+
+def compare_results(results, baseline, tolerance):
+
+    # Input: the results of this run and of an earlier run, and the fraction
+    #        a measurement may grow by
+    # Output: prints each stage measurement of a size in both runs that grew by
+    #         more than the tolerance, and returns the number of them
+
+    if baseline['options'] != results['options']:
+        logging.warning("The baseline was run with different options: " + str(baseline['options']))
+    baseline_sizes = dict((result['shops'], result) for result in baseline['sizes'])
+    regressions = 0
+    for result in results['sizes']:
+        if result['shops'] not in baseline_sizes:
+            continue
+        baseline_stages = baseline_sizes[result['shops']]['stages']
+        for stage in STAGES:
+            if stage not in baseline_stages:
+                continue
+            for name in MEASURED:
+                before = baseline_stages[stage][name]
+                after = result['stages'][stage][name]
+                floor = MIN_SECONDS if name == 'seconds' else MIN_PEAK_RSS_MB
+                if after > floor and after > before * (1 + tolerance):
+                    print (
+                        "Regression: " + stage + " " + name + " at " + str(result['shops'])
+                        + " shops went from " + str(before) + " to " + str(after) + "."
+                    )
+                    regressions += 1
+    if not regressions:
+        print "No regressions against the baseline."
+    return regressions
+
+def output_json(data, file_name):
+
+    # Input: any object, and an output file_name
+    # Output: saves the object in .json format to the specified file_name
+
+    with open(file_name, 'w') as outfile:
+        json.dump(data, outfile, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import logging
+
+def parse_options(args, defaults):
+
+    # Input: a list of command line arguments,
+    #        a hash from option name to its default value
+    # Output: a (positional arguments, options) pair, where each "--name value"
+    #         pair is pulled out of the arguments and converted to the type of
+    #         the option's default (options defaulting to False take no value)
+
+    options = dict(defaults)
+    positional = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if not arg.startswith('--'):
+            positional.append(arg)
+            continue
+        name = arg[2:].replace('-', '_')
+        if name not in defaults:
+            raise ValueError("Unknown option " + arg)
+        if defaults[name] is False:
+            options[name] = True
+            continue
+        if i >= len(args):
+            raise ValueError("Missing value for option " + arg)
+        value = args[i]
+        i += 1
+        if defaults[name] is None:
+            options[name] = value
+        else:
+            options[name] = type(defaults[name])(value)
+    return positional, options
+
+def get_log_level(name):
+
+    # Input: the name of a logging level, like "info" or "ERROR"
+    # Output: the logging module's number for the level
+
+    level = getattr(logging, name.upper(), None)
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level " + name)
+    return level
@@ -0,0 +1,242 @@
+import re
+import json
+import time
+import random
+import socket
+import logging
+import httplib
+import urllib
+import urlparse
+import threading
+from fetch_pool import TokenBucket
+
+URL_BASE = "https://openapi.etsy.com/v2/"
+
+# HTTP statuses worth retrying: rate limiting and server-side failures
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# HTTP statuses whose responses are worth caching (a 404 is a missing shop About)
+CACHE_STATUSES = (200, 404)
+
+class ApiError(Exception):
+
+    # An API request that failed for good, with its HTTP status
+    # (None when no response was received at all)
+
+    def __init__(self, url, status, message):
+
+        Exception.__init__(self, "HTTP " + str(status) + " (" + message + ") for " + url)
+        self.url = url
+        self.status = status
+        self.message = message
+
+class EtsyClient(object):
+
+    # A thread-safe Etsy API client. Each thread keeps its own persistent
+    # keep-alive connection to the API host; requests failing with 429/5xx or
+    # connection errors are retried with exponential backoff and full jitter;
+    # and every request is counted in per-endpoint latency and error statistics.
+    # With a ResponseCache, fresh cached responses are served from disk, stale
+    # ones are revalidated with conditional requests, and in offline mode only
+    # the cache is read.
+
+    def __init__(self, api_key, url_base=URL_BASE, rate_limiter=None, max_retries=5, backoff=0.5, max_backoff=30.0, timeout=30, cache=None, offline=False):
+
+        # Input: the API key, the base URL of the API, (optional) a TokenBucket
+        #        shared by all requests, the number of retries per request,
+        #        the first and the largest backoff in seconds,
+        #        the socket timeout in seconds, (optional) a ResponseCache,
+        #        and whether to answer every request from the cache alone
+
+        url = urlparse.urlparse(url_base)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.base_path = url.path if url.path.endswith('/') else url.path + '/'
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter or TokenBucket(0)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.connections = threading.local()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, params=None):
+
+        # Input: an API path relative to the base URL (e.g. "shops/123/about"),
+        #        and (optional) a hash of query parameters
+        # Output: the .json object returned by the API
+        #         (raises ApiError once the request has failed for good)
+
+        query = dict(params or {})
+        display_url = self.get_url(path, query)
+        query['api_key'] = self.api_key
+        request_path = self.base_path + path + '?' + urllib.urlencode(sorted(query.items()))
+        endpoint = get_endpoint(path)
+
+        # Answer from the cache when the response is fresh (or when offline),
+        # and otherwise ask the API whether the cached response has changed
+        entry = None
+        request_headers = {}
+        if self.cache:
+            entry = self.cache.get(display_url)
+            if entry and (entry['fresh'] or self.offline):
+                self.record_cache_hit(endpoint)
+                return self.parse(display_url, entry['status'], entry['body'])
+            if entry and entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry and entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        if self.offline:
+            raise ApiError(display_url, None, "not in the offline cache")
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            start = time.time()
+            retry_after = None
+            try:
+                status, headers, body = self.request(request_path, request_headers)
+            except (httplib.HTTPException, socket.error) as e:
+                status, body = None, str(e) or e.__class__.__name__
+            self.record(endpoint, status, time.time() - start, attempt > 0)
+
+            if status == 304 and entry:
+                self.cache.refresh(display_url, entry)
+                return self.parse(display_url, entry['status'], entry['body'])
+            if status in CACHE_STATUSES and self.cache:
+                self.cache.put(display_url, status, body, headers)
+            if status is not None and status not in RETRY_STATUSES:
+                return self.parse(display_url, status, body)
+            if attempt >= self.max_retries:
+                raise ApiError(display_url, status, "gave up after " + str(attempt + 1) + " attempts")
+
+            # Back off exponentially with full jitter, or as long as the API asks
+            if status is not None:
+                retry_after = headers.get('retry-after')
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(self.max_backoff, float(retry_after)))
+            logging.warning("Retrying " + display_url + " in " + str(round(delay, 2)) + "s after status " + str(status) + ".")
+            time.sleep(delay)
+            attempt += 1
+
+    def parse(self, url, status, body):
+
+        # Input: a request's URL (without the API key), response status and body
+        # Output: the .json object in the body of a successful response
+        #         (raises ApiError for any other response)
+
+        if status != 200:
+            raise ApiError(url, status, body.strip()[:200])
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ApiError(url, status, "invalid JSON")
+
+    def get_results(self, path, params=None):
+
+        # Input: an API path and (optional) query parameters
+        # Output: the list of results returned by the API (empty if there were none)
+
+        object = self.get(path, params)
+        if object and object.get('results'):
+            return object['results']
+        return []
+
+    def request(self, request_path, request_headers):
+
+        # Input: the full path and query string of a request, and any extra headers
+        # Output: the (status, headers, body) of the response, sent over this
+        #         thread's persistent connection (reopened if it has dropped)
+
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            if self.scheme == 'https':
+                connection = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+            self.connections.connection = connection
+        try:
+            headers = dict(request_headers)
+            headers['Connection'] = 'keep-alive'
+            connection.request('GET', request_path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except:
+            connection.close()
+            self.connections.connection = None
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+            self.connections.connection = None
+        return response.status, dict(response.getheaders()), body
+
+    def record(self, endpoint, status, seconds, retry):
+
+        # Input: the endpoint requested, the response status (None if there was
+        #        no response), the seconds the request took, and whether it was a retry
+        # Output: adds the request to the endpoint's statistics
+
+        with self.lock:
+            stats = self.get_endpoint_stats(endpoint)
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            if retry:
+                stats['retries'] += 1
+            if status not in (200, 304):
+                stats['errors'] += 1
+            key = str(status)
+            stats['statuses'][key] = stats['statuses'].get(key, 0) + 1
+
+    def record_cache_hit(self, endpoint):
+
+        # Input: the endpoint of a request answered from the cache
+        # Output: adds the cache hit to the endpoint's statistics
+
+        with self.lock:
+            self.get_endpoint_stats(endpoint)['cache_hits'] += 1
+
+    def get_endpoint_stats(self, endpoint):
+
+        # Input: an endpoint (called holding the lock)
+        # Output: the endpoint's hash of statistics
+
+        if endpoint not in self.stats:
+            self.stats[endpoint] = {'requests': 0, 'cache_hits': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'statuses': {}}
+        return self.stats[endpoint]
+
+    def log_stats(self):
+
+        # Output: logs the request count, mean latency and errors of each endpoint
+
+        with self.lock:
+            for endpoint in sorted(self.stats):
+                stats = self.stats[endpoint]
+                logging.info(
+                    "API " + endpoint + ": " + str(stats['requests']) + " requests, "
+                    + str(stats['cache_hits']) + " cache hits, "
+                    + str(int(1000 * stats['seconds'] / max(1, stats['requests']))) + " ms mean, "
+                    + str(stats['errors']) + " errors, " + str(stats['retries']) + " retries, "
+                    + "statuses " + json.dumps(stats['statuses'], sort_keys=True)
+                )
+
+    def get_url(self, path, params):
+
+        # Input: an API path and its query parameters
+        # Output: the request's URL without the API key, for logging
+
+        url = self.scheme + "://" + self.host + self.base_path + path
+        if params:
+            url += "?" + urllib.urlencode(sorted(params.items()))
+        return url
+
+def get_endpoint(path):
+
+    # Input: an API path
+    # Output: the path with ids replaced by ":id", for grouping statistics
+
+    return re.sub('/[0-9]+(?=/|$)', '/:id', path)
@@ -0,0 +1,62 @@
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+class TokenBucket(object):
+
+    # A rate limiter shared by any number of threads. Each call takes a token;
+    # tokens refill at a fixed rate up to a burst capacity, and callers that
+    # find the bucket empty sleep until their token has refilled.
+
+    def __init__(self, rate, capacity=None):
+
+        # Input: the number of calls allowed per second (0 for no limit),
+        #        and (optional) the number of calls allowed in a burst
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        # Output: returns once the caller may make one call
+
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Reserve a token now, so waiting callers are served in arrival order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+def open_pool(concurrency):
+
+    # Input: the number of calls to run at once
+    # Output: a pool of that many threads, to be shared by every map_concurrently
+    #         call of a run (EtsyClient keeps a keep-alive connection per thread,
+    #         so a pool per call would reconnect for every batch)
+
+    return ThreadPool(max(1, concurrency))
+
+def close_pool(pool):
+
+    # Input: a pool from open_pool
+    # Output: stops the pool's threads, dropping any calls still queued
+
+    pool.terminate()
+    pool.join()
+
+def map_concurrently(pool, function, items):
+
+    # Input: a pool from open_pool, a function of one argument, and a list of arguments
+    # Output: yields the function's result for each argument, in argument order
+
+    for result in pool.imap(function, items):
+        yield result
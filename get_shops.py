@@ -1,139 +1,241 @@
+import os
 import sys
-import json
-import urllib2
 import logging
+from itertools import izip
+from command_line import parse_options
+from fetch_pool import TokenBucket, open_pool, close_pool, map_concurrently
+from etsy_api import EtsyClient, ApiError, URL_BASE
+from response_cache import ResponseCache
+from record_stream import RecordWriter, load_checkpoint, save_checkpoint
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 KEYSTRING = "<REMOVED>" 
-URL_BASE = "https://openapi.etsy.com/v2/"
+
+# The API client shared by all fetching threads (set up in main)
+CLIENT = None
+
+# Command line options and their defaults
+OPTIONS = {
+    'concurrency': 8,
+    'rate': 10.0,
+    'api_base': None,
+    'retries': 5,
+    'cache_dir': None,
+    'cache_ttl': 86400.0,
+    'cache_max_mb': 0.0,
+    'offline': False,
+    'resume': False,
+}
+
+# Pages of shops fetched (and saved) per concurrent worker before each checkpoint
+PAGES_PER_WORKER = 1
+
+# Marks a request that failed for good, as distinct from an empty result
+FAILED = object()
 
 def main():
 
     # Command line arguments (3): 
     #         1. the total number of shops to download,
     #         2. the size of the sample of these shops to get additional data for,
-    #         3. the name of the output .json file.
-    # Output: a .json file of an array of shops augmented by additional data
+    #         3. the name of the output file: .jsonl (or .jsonl.gz) for JSON Lines,
+    #            one shop per line, or .json (or .json.gz) for a single array.
+    # Options:
+    #         --concurrency N: keep up to N API requests in flight at once (default 8)
+    #         --rate R: make at most R API requests per second (default 10)
+    #         --api-base URL: fetch from URL instead of the Etsy API (e.g. a local mock server)
+    #         --retries N: retry requests failing with 429/5xx up to N times (default 5)
+    #         --cache-dir DIR: cache API responses in DIR, so reruns only fetch new or stale data
+    #         --cache-ttl S: refetch cached responses older than S seconds (default 86400)
+    #         --cache-max-mb M: evict least recently used responses past M megabytes
+    #         --offline: answer every request from the cache, never from the API
+    #         --resume: carry on from the checkpoint of an interrupted run
+    # Output: a file of shops augmented by additional data, written as each shop
+    #         completes, and a .checkpoint file of the completed pages until the run is done
+
+    global CLIENT
 
     # Check command line arguments    
     try:
-        total = (int)(sys.argv[1])
-        sample_size = (int)(sys.argv[2])
-        output_file = sys.argv[3]
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        total = (int)(args[0])
+        sample_size = (int)(args[1])
+        output_file = args[2]
     except:
         e = sys.exc_info()[0]
         logging.error("We had an error with command line args: " + str(e)) 
         return
- 
-    # Fetch the initial set of shops, batched by 100       
-    logging.info("Getting shops.")    
-    shops = []
-    for offset in range(0, total, 100):
-        limit = min(total - offset, 100)
-        logging.info("Fetching shops " + str(offset + 1) + " - " + str(offset + limit))
-        shops += get_shops(limit, offset) 
-          
-    # Select a sample of these shops and get associated data from that sample  
-    logging.info("Taking a sample of " + str(min(sample_size, total)) + " shops.") 
-    shops = shops[:sample_size]
+    cache = None
+    if options['cache_dir']:
+        cache = ResponseCache(options['cache_dir'], options['cache_ttl'], int(options['cache_max_mb'] * 1024 * 1024))
+    CLIENT = EtsyClient(
+        KEYSTRING, 
+        options['api_base'] or URL_BASE, 
+        TokenBucket(options['rate']), 
+        options['retries'],
+        cache=cache,
+        offline=options['offline']
+    )
+    failures = []
+
+    # Open the output, carrying over the shops (and completed pages) of an interrupted run
+    checkpoint_file = output_file + ".checkpoint"
+    checkpoint = {'offsets': []}
+    if options['resume']:
+        checkpoint = load_checkpoint(checkpoint_file) or checkpoint
+    writer = RecordWriter(output_file, key='shop_id', resume=options['resume'])
+    if writer.count:
+        logging.info("Resuming with " + str(writer.count) + " shops already saved.")
+    completed = set(checkpoint['offsets'])
     
-    total_listings = 0
-    total_abouts = 0
-    total_announcements = 0
-    total_connected_users = 0
-    total_user_teams = 0
-    total_other_team_users = 0
-      
-    for shop in shops:
-        if shop['announcement']:
-            total_announcements += 1
-
-    logging.info("Getting listings.")
-    for shop in shops:
-        shop['listings'] = get_listings(shop['shop_id'])
-        total_listings += len(shop['listings'])
-        
-    # Get additional data related to each shop
+    # Only the shops in the sample get additional data (and are saved), so fetch
+    # just the pages covering the sample, batched by 100, a window of pages at a time
+    logging.info("Taking a sample of " + str(min(sample_size, total)) + " shops.") 
+    sample_total = min(sample_size, total)
+    offsets = [offset for offset in range(0, sample_total, 100) if offset not in completed]
+    window = max(1, options['concurrency']) * PAGES_PER_WORKER
+    counts = {'shops': 0, 'listings': 0, 'abouts': 0, 'announcements': 0, 'user_teams': 0}
+    pool = open_pool(options['concurrency'])
+    try:
+        for start in range(0, len(offsets), window):
+            window_offsets = offsets[start:start + window]
+            complete = process_pages(writer, window_offsets, sample_total, pool, failures, counts)
+            
+            # Only pages whose shops were all saved count as completed
+            writer.flush()
+            checkpoint['offsets'] = sorted(completed.union(complete))
+            completed = set(checkpoint['offsets'])
+            save_checkpoint(checkpoint_file, checkpoint)
+    finally:
+        close_pool(pool)
+        writer.close()
+                
+    logging.info("Total shops: " + str(counts['shops']) + " new, " + str(writer.count) + " saved")
+    logging.info("Total listings: " + str(counts['listings']))
+    logging.info("Total abouts: " + str(counts['abouts']))
+    logging.info("Total announcements: " + str(counts['announcements']))
+    logging.info("Total user teams: " + str(counts['user_teams']))
+    CLIENT.log_stats()
+    if failures:
+        logging.error(str(len(failures)) + " requests failed for good; rerun with --resume to retry them:")
+        for failure in failures:
+            logging.error("  " + failure)
+    else:
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+    logging.info("Saved shops to " + output_file + ".")
 
-    logging.info("Getting abouts.")
-    for shop in shops:
-        shop['about'] = get_about(shop['shop_id'])
-        if shop['about']:
-            total_abouts += 1
+def process_pages(writer, offsets, total, pool, failures, counts):
 
-    logging.info("Getting user profiles.")
-    for shop in shops:
-        shop['user_profile'] = get_user_profile(shop['user_id'])
+    # Input: the RecordWriter for the output, the offsets of a window of pages
+    #        of shops, the total number of shops wanted, the run's pool of
+    #        fetching threads, a list to record failed requests in, and a hash
+    #        of running totals
+    # Output: saves each shop on these pages once all of its additional data
+    #         has been fetched, and returns the offsets of the pages that are complete
 
-    logging.info("Getting user teams.")
-    for shop in shops:
-        shop['user_teams'] = get_user_teams(shop['user_id'])
-                
-    logging.info("Total shops: " + str(len(shops)))           
-    logging.info("Total listings: " + str(total_listings))
-    logging.info("Total abouts: " + str(total_abouts))
-    logging.info("Total announcements: " + str(total_announcements))
-    logging.info("Total user teams: " + str(total_user_teams))
+    # Fetch the pages of shops, then get listings and additional data related to
+    # each shop not already saved, with all of every shop's requests queued together
+    pages = map_concurrently(
+        pool,
+        lambda offset: fetch(failures, "shops " + str(offset + 1) + "+", get_shops, min(total - offset, 100), offset), 
+        offsets
+    )
+    complete = set()
+    shops = []
+    for offset, page in zip(offsets, pages):
+        if page is FAILED:
+            continue
+        logging.info("Fetched shops " + str(offset + 1) + " - " + str(offset + min(total - offset, 100)))
+        complete.add(offset)
+        shops += [(offset, shop) for shop in page if shop['shop_id'] not in writer.keys]
+    
+    logging.info("Getting listings, abouts, user profiles and user teams for " + str(len(shops)) + " shops.")
+    requests = []
+    for offset, shop in shops:
+        requests.append((offset, shop, 'listings', get_listings, shop['shop_id']))
+        requests.append((offset, shop, 'about', get_about, shop['shop_id']))
+        requests.append((offset, shop, 'user_profile', get_user_profile, shop['user_id']))
+        requests.append((offset, shop, 'user_teams', get_user_teams, shop['user_id']))
+    results = map_concurrently(
+        pool,
+        lambda request: fetch(failures, request[1]['shop_name'] + " " + request[2], request[3], request[4]), 
+        requests
+    )
     
-    # Save shop data to a file in .json format
-    logging.info("Saving outputs to " + output_file + ".")
-    output_json(shops, output_file)
+    # Each shop's four requests come back together, in order, so each shop is
+    # saved as soon as its last one has (izip, unlike zip, does not wait for them all)
+    shop_failed = False
+    for index, (request, result) in enumerate(izip(requests, results)):
+        offset, shop, field = request[0], request[1], request[2]
+        shop[field] = result
+        shop_failed = shop_failed or result is FAILED
+        if index % 4 < 3:
+            continue
+        if shop_failed:
+            complete.discard(offset)
+        else:
+            writer.write(shop)
+            count_shop(shop, counts)
+        shop_failed = False
+    return complete
+
+def count_shop(shop, counts):
+
+    # Input: a shop augmented by additional data, and a hash of running totals
+    # Output: adds the shop's listings, about, announcement and teams to the totals
+
+    counts['shops'] += 1
+    if shop['announcement']:
+        counts['announcements'] += 1
+    if shop['about']:
+        counts['abouts'] += 1
+    counts['listings'] += len(shop['listings'])
+    counts['user_teams'] += len(shop['user_teams'])
   
+def fetch(failures, description, function, *args):
+
+    # Input: a list to record failed requests in, a description of the request,
+    #        and an API function and its arguments
+    # Output: the function's result, or FAILED if the request failed for good
+    
+    try:
+        return function(*args)
+    except ApiError as e:
+        logging.error("We had an error (" + str(e) + ") getting " + description + ".")
+        failures.append(description + ": " + str(e))
+        return FAILED
+    
 def get_shops(limit, offset):
     
     # Inputs: limit = the number of shops to download,
     #         offset = the starting index of shops to fetch
     # Output: A list of shops, from the Etsy API
     
-    url = (
-        URL_BASE 
-        + "shops?"
-        + "&limit=" + str(limit)
-        + "&offset=" + str(offset)
-        + "&api_key=" + KEYSTRING
-    ) 
-    object = get_data_from_api(url)
-    if object and object['results']:
-        return object['results']
-    else:
-        return []
+    return CLIENT.get_results("shops", {'limit': limit, 'offset': offset})
         
 def get_listings(shop_id):
 
     # Input: a shop_id
     # Output: A list of listings from that shop, from the Etsy API
     
-    url = (
-        URL_BASE 
-        + "shops/" 
-        + str(shop_id)
-        + "/listings/active?"
-        + "&api_key=" + KEYSTRING
-    )
-    object = get_data_from_api(url)
-    if object and object['results']:
-        return object['results']
-    else:
-        return []    
+    return CLIENT.get_results("shops/" + str(shop_id) + "/listings/active")
 
 def get_about(shop_id):
 
     # Input: a shop_id
     # Output: the ShopAbout object, if it exists, for that shop, from the Etsy API
-    # Note: This method throws errors whenever the ShopAbout section does not exist.
-    #       I'm not sure how to avoid this.
+    # Note: The API answers 404 whenever the ShopAbout section does not exist.
     
-    url = (
-        URL_BASE 
-        + "shops/" 
-        + str(shop_id)
-        + "/about?"
-        + "&api_key=" + KEYSTRING
-    )
-    object = get_data_from_api(url)
-    if object and object['results'] and len(object['results']) > 0:
-        return object['results'][0]
+    try:
+        results = CLIENT.get_results("shops/" + str(shop_id) + "/about")
+    except ApiError as e:
+        if e.status == 404:
+            return None
+        raise
+    if results:
+        return results[0]
     else:
         return None
 
@@ -142,16 +244,9 @@ def get_user_profile(user_id):
     # Input: a user_id
     # Output: a UserProfile object, if it exists, for this user, from the Etsy API
     
-    url = (
-        URL_BASE 
-        + "users/" 
-        + str(user_id)
-        + "/profile?"
-        + "&api_key=" + KEYSTRING
-    )
-    object = get_data_from_api(url)
-    if object and object['results'] and len(object['results']) > 0:
-        return object['results'][0]
+    results = CLIENT.get_results("users/" + str(user_id) + "/profile")
+    if results:
+        return results[0]
     else:
         return None
             
@@ -160,41 +255,8 @@ def get_user_teams(user_id):
     # Input: a user_id
     # Output: A list of Team objects that the user belongs to, from the Etsy API
     
-    url = (
-        URL_BASE 
-        + "users/" 
-        + str(user_id)
-        + "/teams?"
-        + "&api_key=" + KEYSTRING
-    )
-    object = get_data_from_api(url)
-    if object and object['results']:
-        return object['results']
-    else:
-        return []
-            
-def get_data_from_api(url):
-
-    # Input: a url
-    # Output: the .json objects found at that url
+    return CLIENT.get_results("users/" + str(user_id) + "/teams")
     
-    try:
-        data = urllib2.urlopen(url).readline()
-        objects = json.loads(data)
-    except:
-        e = sys.exc_info()[0]
-        logging.error("We had an error (" + str(e) + ") with url " + url + ".")
-        objects = None
-    return objects
-    
-def output_json(data, file_name):
-
-    # Input: any object, and an output file_name
-    # Output: saves the object in .json format to the specified file_name
-    
-    with open(file_name, 'w') as outfile:
-        json.dump(data, outfile)
-
 if __name__ == '__main__':
     main()
     
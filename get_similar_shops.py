@@ -1,129 +1,438 @@
 import sys
-import json
 import math
-import re
+import time
 import logging
+import numpy as np
+from command_line import parse_options, get_log_level
+from record_stream import iter_records
+from similarity_engine import get_term_matrix, normalize_rows, get_top_similar, get_top_similar_parallel, get_recall
+from inverted_index import InvertedIndex, get_all_top_similar
+from lsh_index import SimHashIndex, get_all_top_similar_lsh
+from similarity_model import save_model, get_neighbors
+from pipeline_profile import PipelineProfile
+from neighbor_export import NeighborWriter
+from tokenizer import Tokenizer, get_empty_counts, add_counts, log_counts, map_processes
+from treasury_store import TreasuryStore
+from term_vectors import Vocabulary, get_term_vector, get_document_counts, get_term_filter, prune_vocabulary, get_dot_products, get_top_terms
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.ERROR)
 
+# Candidates within this much of a shop's fifth best matrix score are rescored exactly
+SCORE_TOLERANCE = 1e-9
+
+# Highest weighted terms shown for each shop in verbose output
+TOP_TERMS = 5
+
+# Command line options and their defaults
+OPTIONS = {
+    'engine': 'matrix',
+    'bands': 16,
+    'rows': 8,
+    'recall': False,
+    'min_score': 0.0,
+    'workers': 1,
+    'tokenize_workers': 1,
+    'min_count': 1,
+    'min_df': 1,
+    'max_df': 1.0,
+    'max_terms': 0,
+    'save_model': None,
+    'query': None,
+    'export': None,
+    'log_level': 'error',
+    'profile': False,
+    'profile_file': None,
+    'profiler': None,
+}
+
+# The tokenizer and treasury store used to extract shop terms in this process
+# (set up by init_term_extraction, in each worker process too)
+_extraction = {}
+
 def main():
 
-    # Command line arguments (4): 
-    #         1. the name of a shops .json file,
-    #         2. (optional) the name of a listing-treasury hash .json file,
-    #         3. (optional) the name of a treasury tag hash .json file,
-    #         4. (optional) the string "details" to turn on more verbose output
+    # Command line arguments (3): 
+    #         1. the name of a shops file (.json array or .jsonl, optionally .gz),
+    #         2. (optional) the name of a treasury store file made by make_treasury_hashes.py,
+    #         3. (optional) the string "details" to turn on more verbose output
+    # Options:
+    #         --engine matrix|index|lsh: score all pairs with sparse matrix products (default),
+    #                                    only pairs sharing a term via an inverted index,
+    #                                    or only pairs colliding in SimHash LSH buckets
+    #                                    (approximate: similar shops may be missed)
+    #         --bands N: split the lsh engine's signatures into N bands (default 16;
+    #                    with the default rows, pairs scoring 0.6 are found 63% of
+    #                    the time and pairs scoring 0.8 94% of the time)
+    #         --rows N: put N bits in each lsh band (default 8, fewer finds more candidates)
+    #         --recall: also run the matrix engine, and log the lsh engine's recall@5 against it
+    #         --min-score S: only report similar shops scoring at least S
+    #         --workers N: score the matrix engine's row shards in N processes
+    #         --tokenize-workers N: extract and clean the shops' terms in N processes
+    #         --min-count N: leave out terms appearing fewer than N times in all (default 1)
+    #         --min-df N: leave out terms found in fewer than N shops
+    #         --max-df F: leave out terms found in more than fraction F of the shops
+    #         --max-terms N: keep only the N terms found in the most shops
+    #         --save-model DIR: save the fitted model to DIR for query_similar_shops.py
+    #                           instead of printing similar shops
+    #         --query TEXT: print the five shops most similar to free text TEXT
+    #                       instead of printing similar shops for every shop
+    #                       (the inverted index is built from all the shops for
+    #                       each query; to answer queries from a warm index, save
+    #                       a model and use query_similar_shops.py --text or the
+    #                       /search endpoint of similarity_server.py)
+    #         --export FILE: write the five most similar shops of every shop to FILE
+    #                        instead of printing them: as JSON Lines for names ending
+    #                        in .jsonl, CSV for .csv (either optionally .gz), or else
+    #                        a directory of binary matrices of int32 shop indexes and
+    #                        float32 scores (see neighbor_export.py); with "details",
+    #                        each JSON Lines record holds the shop's top terms too
+    #         --log-level LEVEL: log messages of LEVEL and above: debug, info,
+    #                            warning or error (default error)
+    #         --profile: when the run ends, write JSON metrics of it to stderr: the wall
+    #                    and CPU time and memory of each stage, timers of the steps
+    #                    within stages, and counts of the shops, tokens, terms,
+    #                    and pairs of shops scored and pruned
+    #         --profile-file FILE: write the --profile metrics to FILE instead
+    #         --profiler NAME: also list the hottest functions of the run, found with
+    #                          "cprofile" (saving its raw stats to FILE.prof too)
+    #                          or "sampling" (cheaper, for production runs)
     # Output: prints the name of each input shop followed by its five most similar shops.
     # Algorithm: tf-idf term weighting with cosine similarity measure
 
     # Check command line arguments and load input files
     try:
-        shops = get_object_from_json(sys.argv[1])
-        logging.info("Shop list found with " + str(len(shops)) + " shops.")
-        if len(sys.argv) > 3:
-            listing_treasury_hash = get_object_from_json(sys.argv[2])
-            treasury_tag_hash = get_object_from_json(sys.argv[3])
-            logging.info("Listing treasury hash found with " + str(len(listing_treasury_hash)) + " listings.")
-            logging.info("Treasury tag hash found with " + str(len(treasury_tag_hash)) + " treasuries.")
-        else:
-            listing_treasury_hash = {}
-            treasury_tag_hash = {}
-        if len(sys.argv) == 5 and sys.argv[4] == "details":            
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        logging.getLogger().setLevel(get_log_level(options['log_level']))
+        if options['engine'] not in ('matrix', 'index', 'lsh'):
+            raise ValueError("Unknown engine " + options['engine'])
+        if options['workers'] > 1 and options['engine'] != 'matrix':
+            raise ValueError("Multiple workers need the matrix engine")
+        profile = PipelineProfile(options['profile'], options['profile_file'], options['profiler'])
+        profile.start()
+        profile.begin('read_shops')
+        if len(args) > 1 and args[-1] == "details":
             print_details = True
-        else: 
+            args = args[:-1]
+        else:
             print_details = False
+        if len(args) > 1:
+            treasury_file = args[1]
+            treasury_counts = TreasuryStore(treasury_file).get_counts()
+            logging.info("Treasury store found with " + str(treasury_counts[0]) + " treasuries and " + str(treasury_counts[1]) + " listings.")
+        else:
+            treasury_file = None
+            
+        # Stream the shops in, keeping only each shop's name and term count vector
+        vocabulary = Vocabulary()
+        shops = read_shops(args[0], treasury_file, vocabulary, options['tokenize_workers'], profile)
+        logging.info("Shop list found with " + str(len(shops)) + " shops and " + str(len(vocabulary)) + " terms.")
+        profile.count('shops', len(shops))
+        profile.count('terms', len(vocabulary))
     except:
         e = sys.exc_info()[0]
         logging.error("We had an error with command line args: " + str(e)) 
         return
-           
-    # Collect the terms from each shop and its related objects
-    all_terms = []
-    for shop in shops:
-        terms = [] 
-        terms += get_listing_terms(shop['listings'])
-        terms += get_user_profile_terms(shop['user_profile'])
-        terms += get_misc_terms(shop)
-        terms += get_treasury_terms(shop['listings'], listing_treasury_hash, treasury_tag_hash)        
-
-        # Store the term-count hash in the shop object
-        shop['term_counts'] = get_term_counts(clean_terms(terms))
-        all_terms += shop['term_counts'].keys()
-        
-    # Calculate the number of shops that use each term      
-    term_shop_counts = get_term_counts(all_terms)
                 
-    # Calculate the tf-idf weight for the terms in each shop
+    # Prune the vocabulary before the shops are vectorized (by default, of nothing)
+    profile.begin('filter_terms')
+    keep = get_term_filter(
+        [shop['term_counts'] for shop in shops], 
+        len(vocabulary), 
+        options['min_count'], 
+        options['min_df'], 
+        options['max_df'], 
+        options['max_terms']
+    )
+    if not keep.all():
+        vocabulary, vectors = prune_vocabulary([shop['term_counts'] for shop in shops], vocabulary, keep)
+        for shop, vector in zip(shops, vectors):
+            shop['term_counts'] = vector
+        logging.info("Kept " + str(len(vocabulary)) + " of " + str(len(keep)) + " terms.")
+    profile.count('kept_terms', len(vocabulary))
+    
+    # Calculate the number of shops that use each term, and each term's idf
+    profile.begin('weight')
+    document_counts = get_document_counts([shop['term_counts'] for shop in shops], len(vocabulary))
+    idfs = get_idfs(document_counts, len(shops))
+                
+    # Keep the term counts of a saved model, for update_similar_shops.py to update
+    if options['save_model']:
+        counts = get_term_matrix([shop['term_counts'] for shop in shops], len(vocabulary))
+                
+    # Calculate the tf-idf weight for the terms in each shop, in place of its term counts
     for shop in shops:
-        shop['term_weights'] = get_term_weights(
-            shop['term_counts'], 
-            term_shop_counts, 
-            len(shops)
-        )
+        shop['term_weights'] = get_term_weights(shop.pop('term_counts'), idfs)
     
-    # Calculate and print the five most similar shops to each shop
-    for primary_shop in shops:   
-        if len(primary_shop['term_counts']) == 0:
-            print primary_shop['shop_name'] + " has no terms!"
+    # Save the vocabulary, idf table and normalized shop vectors as a model
+    if options['save_model']:
+        profile.begin('save_model')
+        matrix = normalize_rows(get_term_matrix([shop['term_weights'] for shop in shops], len(vocabulary)))
+        save_tfidf_model(options['save_model'], shops, vocabulary, document_counts, idfs, matrix, counts)
+        logging.info("Saved model to " + options['save_model'] + ".")
+        return
+    
+    # Weight the free text query like a shop and search the inverted index for it
+    if options['query'] is not None:
+        profile.begin('query')
+        index = InvertedIndex([shop['term_weights'] for shop in shops])
+        query_weights = get_query_weights(options['query'], vocabulary, idfs)
+        results = index.search(query_weights, 5, options['min_score'])
+        print_search_results(options['query'], [(shops[i], score) for i, score in results], vocabulary, print_details)
+        logging.info("Scored " + str(index.pairs_scored) + " shops, pruned " + str(index.pairs_pruned) + " candidates.")
+        profile.count('pairs_scored', index.pairs_scored)
+        profile.count('pairs_pruned', index.pairs_pruned)
+        return
+    
+    profile.begin('build_index')
+    vectors = [shop['term_weights'] for shop in shops]
+    if options['engine'] == 'index':
+        # Only score pairs of shops that share a term, pruned by max-weight bounds
+        index = InvertedIndex(vectors)
+        candidates = get_all_top_similar(index, vectors, 6, options['min_score'], SCORE_TOLERANCE)
+    elif options['engine'] == 'lsh':
+        # Only score pairs of shops whose signatures collide in some band
+        matrix = normalize_rows(get_term_matrix(vectors, len(vocabulary)))
+        index = SimHashIndex(matrix, options['bands'], options['rows'])
+        profile.begin('score')
+        candidates = list(get_all_top_similar_lsh(index, matrix, 6))
+        pairs = len(shops) * (len(shops) - 1) // 2
+        profile.count('pairs_scored', index.pairs_scored)
+        profile.count('pairs_pruned', pairs - index.pairs_scored)
+        logging.info("Scored " + str(index.pairs_scored) + " candidate pairs (" + str(round(100.0 * index.pairs_scored / max(1, pairs), 2)) + "% of all pairs, " + str(round(2.0 * index.pairs_scored / max(1, len(shops)), 1)) + " per shop), skipped " + str(index.pairs_skipped) + " in oversized buckets.")
+        if options['recall']:
+            exact = get_top_similar(matrix, matrix, 6, tolerance=SCORE_TOLERANCE)
+            logging.info("Recall@5 against the matrix engine: " + str(round(get_recall(candidates, exact, 5), 4)) + ".")
+    else:
+        # Build the L2-normalized term-document matrix once and score all pairs of shops
+        matrix = normalize_rows(get_term_matrix(vectors, len(vocabulary)))
+        if options['workers'] > 1:
+            candidates = get_top_similar_parallel(matrix, matrix, 6, options['workers'], SCORE_TOLERANCE)
+        else:
+            candidates = get_top_similar(matrix, matrix, 6, tolerance=SCORE_TOLERANCE)
+        profile.count('pairs_scored', len(shops) * len(shops))
+        profile.count('pairs_pruned', 0)
+    
+    # Print (or export) the five most similar shops to each shop (scoring them
+    # as they go, for the engines that score lazily)
+    profile.begin('similar_shops')
+    writer = None
+    if options['export']:
+        writer = NeighborWriter(options['export'], [shop['shop_name'] for shop in shops], 5)
+    for i, top in profile.iter_timed('score', candidates):
+        primary_shop = shops[i]
+        if len(primary_shop['term_weights']) == 0:
+            if writer is not None:
+                writer.write(i, [])
+            else:
+                print primary_shop['shop_name'] + " has no terms!"
             continue     
-        similar_shops = []
-        for other_shop in shops:
-            similarity = cosine_similarity(
-                primary_shop['term_weights'], 
-                other_shop['term_weights']
+        start = time.time()
+        candidate_ids = sorted([entry[0] for entry in top])
+        similar_shops = rescore_similar_shops(
+            primary_shop, 
+            [shops[j] for j in candidate_ids],
+            options['min_score']
+        )
+        rescored = time.time()
+        profile.add_time('rescore', rescored - start)
+        if writer is not None:
+            # (the rescored shops are mapped back to their indexes by identity)
+            shop_ids = dict((id(shops[j]), j) for j in candidate_ids)
+            writer.write(
+                i, 
+                [(shop_ids[id(shop)], score) for shop, score in similar_shops[1:6]], 
+                get_shop_top_terms(primary_shop, vocabulary) if print_details else None
             )
-            if similarity > 0:
-                similar_shops.append((other_shop, similarity))
-        similar_shops = sorted(similar_shops, key=lambda entry: -1 * entry[1]) 
-        if print_details: 
-            print_similar_shop_details(primary_shop, similar_shops[1:6]) 
+        elif print_details: 
+            print_similar_shop_details(primary_shop, similar_shops[1:6], vocabulary) 
         else:
             print_similar_shops(primary_shop, similar_shops[1:6])     
-
+        profile.add_time('output', time.time() - rescored)
+    if writer is not None:
+        writer.close()
+        logging.info("Exported similar shops to " + options['export'] + ".")
+
+    if options['engine'] == 'index':
+        logging.info("Scored " + str(index.pairs_scored) + " pairs, pruned " + str(index.pairs_pruned) + " candidates.")
+        profile.count('pairs_scored', index.pairs_scored)
+        profile.count('pairs_pruned', index.pairs_pruned)
     return
     
-def print_similar_shop_details(primary_shop, similar_shops):
+def save_tfidf_model(model_dir, shops, vocabulary, document_counts, idfs, matrix, counts):
+
+    # Input: the directory to save the model to, the list of shop objects,
+    #        the Vocabulary of term ids (the matrix columns), arrays of the number
+    #        of shops which contain each term and of each term's idf,
+    #        the normalized term-document matrix, and the matrix of term counts
+    # Output: saves the model for query_similar_shops.py (see similarity_model.py),
+    #         with each shop's most similar shops for update_similar_shops.py
+    
+    save_model(
+        model_dir, 
+        'tfidf', 
+        [shop['shop_name'] for shop in shops], 
+        vocabulary.terms, 
+        document_counts, 
+        idfs, 
+        matrix, 
+        matrix,
+        counts=counts,
+        neighbors=get_neighbors(matrix, matrix)
+    )
+    
+def get_query_weights(query, vocabulary, idfs):
 
-    # Input: a shop object along with a list of (shop, similarity score) pairs
+    # Input: a free text query string, the shops' Vocabulary,
+    #        and an array of the idf of each term id
+    # Output: a TermVector of the query's tf-idf weights,
+    #         leaving out terms that no shop uses
+    
+    term_counts = get_term_counts(Tokenizer().clean_terms(query.split()))
+    return get_term_weights(get_term_vector(term_counts, vocabulary, add_terms=False), idfs)
+
+def print_search_results(query, similar_shops, vocabulary, print_details):
+
+    # Input: a free text query, a list of (shop, similarity score) pairs,
+    #        the shops' Vocabulary, and whether to print scores and highest weighted terms
+    # Output: prints the query followed by the shops most similar to it
+    
+    lines = [query + ":\n"]
+    if not similar_shops:
+        lines.append(" No similar shops were found!\n")
+    i = 1
+    for similar_shop in similar_shops:
+        if print_details:
+            lines.append(
+                str(i) + ". " + str(similar_shop[1]) + " " + similar_shop[0]['shop_name'] 
+                + format_top_terms(get_shop_top_terms(similar_shop[0], vocabulary))
+            )
+        else:
+            lines.append(str(i) + ". " + similar_shop[0]['shop_name'] + "\n")
+        i += 1
+    sys.stdout.write("".join(lines))
+
+def print_similar_shop_details(primary_shop, similar_shops, vocabulary):
+
+    # Input: a shop object along with a list of (shop, similarity score) pairs,
+    #        and the shops' Vocabulary
     # Output: prints the primary and similar shops' names,
-    #         along with similarity score and highest weighted terms
+    #         along with similarity score and highest weighted terms,
+    #         in a single write
     
-    print primary_shop['shop_name'],
-    print_top_terms(primary_shop['term_weights'])
+    lines = [primary_shop['shop_name'] + format_top_terms(get_shop_top_terms(primary_shop, vocabulary))]
     if len(similar_shops) <= 1:
-        print " No similar shops were found!"
+        lines.append(" No similar shops were found!\n")
     else:
         i = 1
         for similar_shop in similar_shops:            
-            print str(i) + ". " + str(similar_shop[1]) + " " + similar_shop[0]['shop_name'],
-            print_top_terms(similar_shop[0]['term_weights'])
+            lines.append(
+                str(i) + ". " + str(similar_shop[1]) + " " + similar_shop[0]['shop_name'] 
+                + format_top_terms(get_shop_top_terms(similar_shop[0], vocabulary))
+            )
             i += 1
+    sys.stdout.write("".join(lines))
             
 def print_similar_shops(primary_shop, similar_shops):
 
     # Input: a shop object along with a list of (shop, similarity score) pairs
-    # Output: prints the primary and similar shops' names
+    # Output: prints the primary and similar shops' names on one line
     
-    print primary_shop['shop_name'] + ":",
     if len(similar_shops) <= 1:
-        print " No similar shops were found!"
+        sys.stdout.write(primary_shop['shop_name'] + ":  No similar shops were found!\n")
     else:
-        for similar_shop in similar_shops[:-1]:
-            print similar_shop[0]['shop_name'] + ",",
-        print similar_shops[-1][0]['shop_name']
+        sys.stdout.write(primary_shop['shop_name'] + ": " + ", ".join([similar_shop[0]['shop_name'] for similar_shop in similar_shops]) + "\n")
 
-def print_top_terms(term_weights):
+def get_shop_top_terms(shop, vocabulary):
 
-    # Input: a hash of term to weight
-    # Output: prints the top five weighted terms and their weights
+    # Input: a shop object with term weights, and the shops' Vocabulary
+    # Output: a list of the shop's TOP_TERMS highest weighted (term, weight) pairs,
+    #         found the first time they are asked for and then kept with the shop
+    #         (a shop is shown once for itself and again as each shop's similar shop)
     
-    pairs = []
-    for term in term_weights:
-        pairs.append((term, term_weights[term]))
-    pairs = sorted(pairs, key=lambda entry: -1 * entry[1])
-    for pair in pairs[:5]:
-        print " (" + pair[0] + " " + str(math.trunc(pair[1]*100)/100.0) + ")",
-    print ""
+    if 'top_terms' not in shop:
+        shop['top_terms'] = get_top_terms(shop['term_weights'], vocabulary, TOP_TERMS)
+    return shop['top_terms']
+
+def format_top_terms(top_terms):
+
+    # Input: a list of (term, weight) pairs
+    # Output: the end of an output line listing the terms and their weights
+    
+    return "".join(["  (" + term + " " + str(math.trunc(weight*100)/100.0) + ")" for term, weight in top_terms]) + " \n"
+
+def read_shops(file_name, treasury_file, vocabulary, workers=1, profile=None):
+
+    # Input: the name of a shops file (a .json array or JSON Lines, optionally .gz),
+    #        the name of a treasury store file (or None to leave out treasury tags),
+    #        the Vocabulary to intern the shops' terms in,
+    #        the number of processes to extract and clean terms in,
+    #        and (optional) a PipelineProfile to add the time of each step
+    #        and the number of tokens to
+    # Output: a list of compact shop objects holding just each shop's name and
+    #         TermVector of term counts (the rest of each shop is dropped as soon as it is read)
+    
+    profile = profile or PipelineProfile()
+    shops = []
+    cache_counts = get_empty_counts()
+    results = map_processes(
+        get_shop_term_counts, 
+        profile.iter_timed('load_json', iter_records(file_name)), 
+        workers, 
+        init_term_extraction, 
+        (treasury_file,)
+    )
+    for shop_name, term_counts, tokenizer_counts, timings in results:
+        start = time.time()
+        shops.append({'shop_name': shop_name, 'term_counts': get_term_vector(term_counts, vocabulary)})
+        profile.add_time('intern_terms', time.time() - start)
+        profile.add_times(timings)
+        profile.add_count('tokens', sum(term_counts.itervalues()))
+        add_counts(cache_counts, tokenizer_counts)
+    log_counts(cache_counts)
+    return shops
+
+def init_term_extraction(treasury_file):
+
+    # Input: the name of a treasury store file (or None)
+    # Output: sets up this process (or worker process) to extract shop terms,
+    #         with its own connection to the treasury store
+
+    _extraction['tokenizer'] = Tokenizer()
+    _extraction['treasuries'] = TreasuryStore(treasury_file) if treasury_file else None
+
+def get_shop_term_counts(shop):
+
+    # Input: an Etsy Shop object augmented by additional data
+    # Output: the shop's name, a hash from its cleaned terms to their counts,
+    #         the tokenizer's cache hit and miss counts for the shop,
+    #         and a hash of the seconds each step took (for --profile)
+    
+    tokenizer = _extraction['tokenizer']
+    start = time.time()
+    terms = get_shop_terms(shop, _extraction['treasuries'])
+    extracted = time.time()
+    tokens = tokenizer.clean_terms(terms)
+    cleaned = time.time()
+    term_counts = get_term_counts(tokens)
+    timings = {
+        'extract_terms': extracted - start, 
+        'clean_terms': cleaned - extracted, 
+        'count_terms': time.time() - cleaned,
+    }
+    return shop['shop_name'], term_counts, tokenizer.take_counts(), timings
+
+def get_shop_terms(shop, treasuries):
+
+    # Input: an Etsy Shop object augmented by additional data,
+    #        and a TreasuryStore (or None)
+    # Output: a list of terms found in the shop and its related objects
+    
+    terms = [] 
+    terms += get_listing_terms(shop['listings'])
+    terms += get_user_profile_terms(shop['user_profile'])
+    terms += get_misc_terms(shop)
+    terms += get_treasury_terms(shop['listings'], treasuries)
+    return terms
 
 def get_listing_terms(listings):
 
@@ -188,24 +497,19 @@ def get_misc_terms(shop):
         terms += team['tags']
     return terms
     
-def get_treasury_terms(listings, listing_treasury_hash, tresury_tag_hash):
+def get_treasury_terms(listings, treasuries):
 
-    # Input: a list of Etsy Listing objects, 
-    #        a hash from listing id to the ids of treasuries containing that listing,
-    #        a hash from treasury id to the tags of that treasury
+    # Input: a list of Etsy Listing objects, and a TreasuryStore (or None)
     # Output: a list of terms found in the tags of the treasuries containing
-    #         the input listings
+    #         the input listings, looked up for all the listings at once
     
-    terms = []
-    total = 0
-    for listing in listings:
-        if str(listing['listing_id']) in listing_treasury_hash:
-            total += 1
-            terms += treasury_tag_hash[str(listing['listing_id'])]
+    if treasuries is None:
+        return []
+    terms, total = treasuries.get_tags([listing['listing_id'] for listing in listings])
     if total > 0:
-        logger.debug("Shop found with " + str(total) + " treasuried listing(s).")
+        logging.debug("Shop found with " + str(total) + " treasuried listing(s).")
     return terms
-	
+
 def get_term_counts(terms):
 
     # Input: a list of terms
@@ -220,63 +524,56 @@ def get_term_counts(terms):
         term_counts[term] += 1
     return term_counts
 
-def clean_terms(terms):
+def get_idfs(document_counts, num_shops):
 
-    # Input: a list of terms
-    # Output: a list of these terms with non-alphanumeric characters removed, 
-    #         converted to lowercase, and tokenized
+    # Input: an array of the number of shops which contain each term id,
+    #        the total number of shops
+    # Output: an array of the inverse document frequency of each term id
     
-    cleaned = []
-    for term in terms:
-        stems = re.sub('[^0-9a-zA-Z]+', ' ', term).lower().strip().split()
-        for stem in stems:
-            cleaned.append(stem)
-    return cleaned
+    return np.array([math.log(float(num_shops) / count) for count in document_counts])
 
-def get_term_weights(term_counts, term_shop_counts, num_shops):
+def get_term_weights(term_counts, idfs):
 
-    # Input: a hash of term to term count, 
-    #        a hash of term to the number of documents which contain that term,
-    #        the total number of shops
-    # Output: a hash of terms to the tf-idf weighting of each term,
+    # Input: a TermVector of term counts, 
+    #        an array of the inverse document frequency of each term id
+    # Output: a TermVector of the tf-idf weighting of each term,
     #         using the augmented norm for term frequency
     
-    weights = {}
-    max_count = 1
-    for term in term_counts:
-        max_count = max(max_count, term_counts[term])
-    for term in term_counts:
-        normalized_count = 0.5 + 0.5 * term_counts[term] / max_count
-        weights[term] = normalized_count * math.log(float(num_shops) / term_shop_counts[term])
-    return weights
+    max_count = max(1, term_counts.values.max()) if len(term_counts) else 1
+    normalized_counts = 0.5 + 0.5 * term_counts.values / max_count
+    return term_counts.with_values(normalized_counts * idfs[term_counts.ids])
     
-def cosine_similarity(weights_1, weights_2):
+def rescore_similar_shops(primary_shop, candidate_shops, min_score=0.0):
 
-    # Input: two hashes from term to term weight
-    # Output: the cosine similarity score between the two hashes
+    # Input: a shop object, a list of candidate shop objects (in shop order)
+    #        chosen by a similarity engine, and the minimum score to keep
+    # Output: a list of (shop, similarity score) pairs sorted by descending similarity,
+    #         scored with cosine_similarities so scores and tie order match a full scan
     
-    if not weights_1 or not weights_2:
-        return 0.0
-    intersection = set(weights_1.keys()) & set(weights_2.keys())
-    numerator = sum([weights_1[term] * weights_2[term] for term in intersection])
-
-    sum_1 = sum([weights_1[term]**2 for term in weights_1.keys()])
-    sum_2 = sum([weights_2[term]**2 for term in weights_2.keys()])
-    denominator = math.sqrt(sum_1) * math.sqrt(sum_2)
-
-    if not denominator:
-        return 0.0
-    else:
-        return float(numerator) / denominator
-        	
-def get_object_from_json(file_name):
+    similarities = cosine_similarities(
+        primary_shop['term_weights'], 
+        [other_shop['term_weights'] for other_shop in candidate_shops]
+    )
+    similar_shops = []
+    for other_shop, similarity in zip(candidate_shops, similarities):
+        if similarity > 0 and similarity >= min_score:
+            similar_shops.append((other_shop, similarity))
+    return sorted(similar_shops, key=lambda entry: -1 * entry[1])
+    
+def cosine_similarities(weights, other_weights):
 
-    # Input: the name of a known .json file
-    # Output: a python object made from that file's contents
+    # Input: a TermVector of term weights, and a list of other TermVectors
+    # Output: a list of the cosine similarity scores between the vector
+    #         and each of the others
     
-    file = open(file_name)
-    object = json.load(file)
-    return object
+    similarities = []
+    for other, product in zip(other_weights, get_dot_products(weights, other_weights)):
+        denominator = weights.norm * other.norm
+        if not denominator:
+            similarities.append(0.0)
+        else:
+            similarities.append(product / denominator)
+    return similarities
 
 if __name__ == '__main__':
     main()
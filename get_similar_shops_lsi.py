@@ -1,156 +1,481 @@
+import os
 import sys
-import json
 import math
-import re
-from nltk.stem.wordnet import WordNetLemmatizer
-from gensim import corpora, models, similarities
+import time
+import shutil
+import tempfile
 import logging
+import numpy as np
+from command_line import parse_options, get_log_level
+from record_stream import iter_records
+from similarity_engine import get_top_similar, get_top_similar_parallel, get_recall
+from similarity_model import save_model, get_neighbors
+from pipeline_profile import PipelineProfile
+from neighbor_export import NeighborWriter
+from sharded_index import get_shard_rows, write_shards, ShardedMatrix, get_top_similar_sharded
+from ivf_index import write_ivf_index, IvfIndex, get_top_similar_ivf
+from lsi_backends import BACKENDS, GensimLsi, RandomizedLsi
+from tokenizer import Tokenizer, get_empty_counts, add_counts, log_counts, map_processes
+from treasury_store import TreasuryStore
+from term_vectors import Vocabulary, get_term_vector, get_document_counts, get_term_filter, get_top_terms
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.ERROR)
 
+# Command line options and their defaults
+OPTIONS = {
+    'workers': 1,
+    'tokenize_workers': 1,
+    'min_count': 2,
+    'min_df': 1,
+    'max_df': 1.0,
+    'max_terms': 0,
+    'save_model': None,
+    'memory_mb': 0,
+    'index_dir': None,
+    'backend': 'gensim',
+    'num_topics': 100,
+    'oversampling': 100,
+    'power_iterations': 2,
+    'ivf_lists': 0,
+    'nprobe': 8,
+    'recall': False,
+    'export': None,
+    'log_level': 'error',
+    'profile': False,
+    'profile_file': None,
+    'profiler': None,
+}
+
+# Bytes in a megabyte, for --memory-mb
+MEGABYTE = 1024 * 1024
+
+# Highest weighted terms shown for each shop in verbose output
+TOP_TERMS = 7
+
+# The tokenizer and treasury store used to extract shop terms in this process
+# (set up by init_term_extraction, in each worker process too)
+_extraction = {}
+
 def main():
 
-    # Command line arguments (4): 
-    #         1. the name of a shops .json file,
-    #         2. (optional) the name of a listing-treasury hash .json file,
-    #         3. (optional) the name of a treasury tag hash .json file,
-    #         4. (optional) the string "details" to turn on more verbose output
+    # Command line arguments (3): 
+    #         1. the name of a shops file (.json array or .jsonl, optionally .gz),
+    #         2. (optional) the name of a treasury store file made by make_treasury_hashes.py,
+    #         3. (optional) the string "details" to turn on more verbose output
+    # Options:
+    #         --workers N: score row shards of the LSI vectors in N processes
+    #         --tokenize-workers N: extract and clean the shops' terms in N processes
+    #         --min-count N: leave out terms appearing fewer than N times in all (default 2)
+    #         --min-df N: leave out terms found in fewer than N shops
+    #         --max-df F: leave out terms found in more than fraction F of the shops
+    #         --max-terms N: keep only the N terms found in the most shops
+    #         --save-model DIR: save the fitted model to DIR for query_similar_shops.py
+    #                           instead of printing similar shops
+    #         --memory-mb N: score the LSI vectors from memory-mapped shards on disk,
+    #                        using about N megabytes of working memory, in one process
+    #                        (not with --workers, --save-model or --ivf-lists)
+    #         --index-dir DIR: keep the --memory-mb shards or --ivf-lists index in DIR
+    #                          (otherwise they are written to a temporary directory and removed)
+    #         --backend NAME: fit LSI with "gensim" (Gensim's LsiModel, the default)
+    #                         or "randomized" (a randomized truncated SVD, without Gensim)
+    #         --num-topics N: the number of LSI topics (default 100)
+    #         --oversampling N: extra dimensions sampled by the SVD (default 100)
+    #         --power-iterations N: power iterations run by the SVD (default 2)
+    #         --ivf-lists N: partition the LSI vectors into N k-means lists, and score
+    #                        each shop only against the lists nearest to it,
+    #                        in one process (not with --workers or --memory-mb)
+    #                        (approximate: similar shops may be missed; with --save-model,
+    #                        the saved model is searched this way too)
+    #         --nprobe N: the number of --ivf-lists lists searched per shop (default 8)
+    #         --recall: also score all pairs exactly, and log the recall@5 and time
+    #                   per shop of --ivf-lists searches probing 1, 2, 4, ... lists
+    #         --export FILE: write the five most similar shops of every shop to FILE
+    #                        instead of printing them: as JSON Lines for names ending
+    #                        in .jsonl, CSV for .csv (either optionally .gz), or else
+    #                        a directory of binary matrices of int32 shop indexes and
+    #                        float32 scores (see neighbor_export.py); with "details",
+    #                        each JSON Lines record holds the shop's top terms too
+    #         --log-level LEVEL: log messages of LEVEL and above: debug, info,
+    #                            warning or error (default error)
+    #         --profile: when the run ends, write JSON metrics of it to stderr: the wall
+    #                    and CPU time and memory of each stage, timers of the steps
+    #                    within stages, and counts of the shops, tokens, terms,
+    #                    and pairs of shops scored and pruned
+    #         --profile-file FILE: write the --profile metrics to FILE instead
+    #         --profiler NAME: also list the hottest functions of the run, found with
+    #                          "cprofile" (saving its raw stats to FILE.prof too)
+    #                          or "sampling" (cheaper, for production runs)
     # Output: prints the name of each input shop followed by its five most similar shops.
     # Algorithm: Latent semantic indexing based on tf-idf term weighting 
-    #            with cosine similarity measure (Gensim package)
+    #            with cosine similarity measure (Gensim package, by default)
 
     # Check command line arguments and load input files
     try:       
-        shops = get_object_from_json(sys.argv[1])
-        logging.info("Shop list found with " + str(len(shops)) + " shops.")
-        if len(sys.argv) > 3:
-            listing_treasury_hash = get_object_from_json(sys.argv[2])
-            treasury_tag_hash = get_object_from_json(sys.argv[3])
-            logging.info("Treasury tag hash found with " + str(len(treasury_tag_hash)) + " treasuries.")
-            logging.info("Listing treasury hash found with " + str(len(listing_treasury_hash)) + " listings.")
-        else:
-            listing_treasury_hash = {}
-            treasury_tag_hash = {}            
-        if len(sys.argv) == 5 and sys.argv[4] == "details":            
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        logging.getLogger().setLevel(get_log_level(options['log_level']))
+        if options['backend'] not in BACKENDS:
+            raise ValueError("Unknown backend " + options['backend'])
+        if options['ivf_lists'] and options['memory_mb']:
+            raise ValueError("--ivf-lists cannot be combined with --memory-mb")
+        if options['ivf_lists'] and options['workers'] > 1:
+            raise ValueError("--workers cannot be combined with --ivf-lists")
+        if options['memory_mb'] and options['workers'] > 1:
+            raise ValueError("--workers cannot be combined with --memory-mb")
+        if options['memory_mb'] and options['save_model']:
+            raise ValueError("--save-model cannot be combined with --memory-mb")
+        profile = PipelineProfile(options['profile'], options['profile_file'], options['profiler'])
+        profile.start()
+        profile.begin('read_shops')
+        if len(args) > 1 and args[-1] == "details":
             print_details = True
+            args = args[:-1]
         else:
             print_details = False
+        if len(args) > 1:
+            treasury_file = args[1]
+            treasury_counts = TreasuryStore(treasury_file).get_counts()
+            logging.info("Treasury store found with " + str(treasury_counts[0]) + " treasuries and " + str(treasury_counts[1]) + " listings.")
+        else:
+            treasury_file = None
+            
+        # Stream the shops in, keeping only each shop's name and term count vector
+        vocabulary = Vocabulary()
+        shops = read_shops(args[0], treasury_file, vocabulary, options['tokenize_workers'], profile)
+        logging.info("Shop list found with " + str(len(shops)) + " shops and " + str(len(vocabulary)) + " terms.")
+        profile.count('shops', len(shops))
+        profile.count('terms', len(vocabulary))
     except:
         e = sys.exc_info()[0]
         logging.error("We had an error with command line args: " + str(e)) 
         return
-    
-    # Collect the terms from each shop and its related objects
-    texts = []
-    all_terms = []
-    for shop in shops:
-        terms = [] 
-        terms += get_listing_terms(shop['listings'])
-        terms += get_user_profile_terms(shop['user_profile'])
-        terms += get_misc_terms(shop)
-        terms += get_treasury_terms(shop['listings'], listing_treasury_hash, treasury_tag_hash)
-
-        # Store the term-count hash in the shop object        
-        shop['terms'] = clean_terms(terms)
-        shop['term_counts'] = get_term_counts(clean_terms(terms))
-        all_terms += shop['term_counts'].keys()
-        texts.append(clean_terms(terms))
-        
-    # Calculate the number of shops that use each term (just used for verbose output)    
-    term_shop_counts = get_term_counts(all_terms)
                 
     # Calculate the tf-idf weight for the terms in each shop (just for verbose output)
-    for shop in shops:
-        shop['term_weights'] = get_term_weights(
-            shop['term_counts'], 
-            term_shop_counts, 
-            len(shops)
-        )
+    if print_details:
+        profile.begin('weight')
+        document_counts = get_document_counts([shop['term_counts'] for shop in shops], len(vocabulary))
+        idfs = get_idfs(document_counts, len(shops))
+        for shop in shops:
+            shop['term_weights'] = get_term_weights(shop['term_counts'], idfs)
     
-    # Remove any tokens that only appear once in the whole corpus of shops
-    all_tokens = sum(texts, [])
-    tokens_once = set(word for word in set(all_tokens) if all_tokens.count(word) == 1)
-    texts = [[word for word in text if word not in tokens_once]
-        for text in texts]
+    # Prune the vocabulary, by default of tokens that only appear once in the 
+    # whole corpus of shops (the verbose output still shows every term)
+    profile.begin('filter_terms')
+    keep = get_term_filter(
+        [shop['term_counts'] for shop in shops], 
+        len(vocabulary), 
+        options['min_count'], 
+        options['min_df'], 
+        options['max_df'], 
+        options['max_terms']
+    )
+    logging.info("Kept " + str(keep.sum()) + " of " + str(len(vocabulary)) + " terms.")
+    profile.count('kept_terms', int(keep.sum()))
     
-    # Create a Gensim dictionary to house all the words in the corpus  
-    dictionary = corpora.Dictionary(texts)    
+    # Fit LSI to the tf-idf weighted shops with the chosen backend
+    profile.begin('fit_lsi')
+    start = time.time()
+    vectors = [shop['term_counts'] for shop in shops]
+    if options['backend'] == 'randomized':
+        lsi = RandomizedLsi(vectors, vocabulary, keep, options['num_topics'], options['oversampling'], options['power_iterations'])
+    else:
+        lsi = GensimLsi(vectors, vocabulary, keep, options['num_topics'], options['oversampling'], options['power_iterations'])
+    logging.info(
+        "Fit LSI with the " + options['backend'] + " backend (" + str(lsi.num_topics) + " topics, "
+        + str(len(lsi.terms)) + " terms) in " + str(round(time.time() - start, 2)) + "s."
+    )
+    profile.count('topics', lsi.num_topics)
     
-    # Convert the collection of shop term lists into a Gensim document corpus
-    corpus = [dictionary.doc2bow(text) for text in texts]   
+    if options['memory_mb']:
+        # Stream the LSI vectors to memory-mapped shards on disk, and score them
+        # a shard at a time within the memory budget
+        profile.begin('similar_shops')
+        all_sims = get_sharded_similarities(lsi, options['memory_mb'] * MEGABYTE, options['index_dir'])
+        print_all_similar_shops(shops, profile.iter_timed('score', all_sims), print_details, vocabulary, options['export'], profile)
+        profile.count('pairs_scored', len(shops) * len(shops))
+        profile.count('pairs_pruned', 0)
+        return
+    
+    # Compute the similarities between all pairs of shops, scoring the
+    # normalized LSI vectors of each shop against those of every other
+    profile.begin('project')
+    query_vectors = lsi.get_query_vectors()
+    index_vectors = lsi.get_index_vectors()
+        
+    # Save the vocabulary, idf table, LSI projection and normalized shop vectors as a model
+    if options['save_model']:
+        profile.begin('save_model')
+        save_model(
+            options['save_model'],
+            'lsi',
+            [shop['shop_name'] for shop in shops],
+            lsi.terms,
+            lsi.document_counts,
+            lsi.idfs,
+            query_vectors,
+            index_vectors,
+            lsi.projection,
+            counts=lsi.counts,
+            neighbors=get_neighbors(query_vectors, index_vectors),
+            ivf_lists=options['ivf_lists'],
+            nprobe=options['nprobe']
+        )
+        logging.info("Saved model to " + options['save_model'] + ".")
+        return
+        
+    profile.begin('similar_shops')
+    if options['ivf_lists']:
+        # Score each shop only against the k-means lists of shops nearest to it
+        all_sims = get_ivf_similarities(query_vectors, index_vectors, options['ivf_lists'], options['nprobe'], options['index_dir'], options['recall'], profile)
+    elif options['workers'] > 1:
+        # Score row shards of the normalized LSI shop vectors in a process pool
+        all_sims = get_top_similar_parallel(query_vectors, index_vectors, 6, options['workers'])
+    else:
+        # Score blocks of shop vectors at once, keeping only each shop's top six
+        all_sims = get_top_similar(query_vectors, index_vectors, 6)
+    if not options['ivf_lists']:
+        profile.count('pairs_scored', len(shops) * len(shops))
+        profile.count('pairs_pruned', 0)
+    print_all_similar_shops(shops, profile.iter_timed('score', all_sims), print_details, vocabulary, options['export'], profile)
     
-    # Convert the document corpus into a tf-idf weighted corpus
-    tfidf = models.TfidfModel(corpus)    
-    corpus_tfidf = tfidf[corpus]
+    return
+
+def get_sharded_similarities(lsi, memory_bytes, index_dir=None):
 
-    # Convert the tf-idf corpus into a LSI-based corpus of 100 topics
-    lsi = models.LsiModel(corpus_tfidf, id2word=dictionary, num_topics=100)
-    corpus_lsi = lsi[corpus_tfidf]
+    # Input: a fitted LSI backend (see lsi_backends.py),
+    #        the memory budget in bytes for scoring,
+    #        and (optional) a directory to keep the sharded vectors in
+    #        (otherwise they are written to a temporary directory)
+    # Output: yields (shop index, [(shop index, similarity), ...]) for each shop,
+    #         listing its six highest positive similarities in descending order
     
-    # Compute the similarities between all pairs of shops
-    index = similarities.MatrixSimilarity(lsi[corpus])
-        
-    # Print the the five most similar shops to each shop
-    for i in range(len(shops)):
-        if len(shops[i]['terms']) == 0:
-            print shops[i]['shop_name'] + " has no terms!"
-            continue
-            
-        # Convert the current shop's term list to the LSI basis 
-        # and find its similar shops from the LSI corpus
-        vec_lsi = lsi[tfidf[dictionary.doc2bow(shops[i]['terms'])]]
-        sims = index[vec_lsi]
-        sims = sorted(enumerate(sims), key=lambda item: -item[1])
-        sims = [sim for sim in sims if sim[1] > 0]
-        if print_details:
-            print_similar_shop_details(shops[i], shops, sims[1:6])
+    shard_dir = index_dir or tempfile.mkdtemp(prefix='lsi_index_')
+    try:
+        # (the backend's vectors are already normalized)
+        shard_rows = get_shard_rows(lsi.num_topics, memory_bytes)
+        write_shards(lsi.iter_query_vectors(), os.path.join(shard_dir, 'query'), lsi.num_topics, shard_rows, normalize=False)
+        write_shards(lsi.iter_index_vectors(), os.path.join(shard_dir, 'index'), lsi.num_topics, shard_rows, normalize=False)
+        query_matrix = ShardedMatrix(os.path.join(shard_dir, 'query'))
+        index_matrix = ShardedMatrix(os.path.join(shard_dir, 'index'))
+        logging.info("Wrote " + str(len(index_matrix.shards)) + " index shards of up to " + str(shard_rows) + " shops.")
+        for result in get_top_similar_sharded(query_matrix, index_matrix, 6, memory_bytes):
+            yield result
+    finally:
+        if not index_dir:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+def get_ivf_similarities(query_vectors, index_vectors, num_lists, nprobe, index_dir=None, recall=False, profile=None):
+
+    # Input: dense matrices of the shops' normalized query and index vectors,
+    #        the number of k-means lists to partition the index into, the number
+    #        of lists to probe per shop, (optional) a directory to keep the
+    #        IVF index in (otherwise it is written to a temporary directory),
+    #        whether to log the recall and time of searches against exact scoring,
+    #        and (optional) a PipelineProfile to count the pairs scored in
+    # Output: yields (shop index, [(shop index, similarity), ...]) for each shop,
+    #         listing its six highest positive similarities in the probed lists
+    #         in descending order
+
+    profile = profile or PipelineProfile()
+    ivf_dir = os.path.join(index_dir or tempfile.mkdtemp(prefix='lsi_index_'), 'ivf')
+    try:
+        start = time.time()
+        write_ivf_index(index_vectors, ivf_dir, num_lists)
+        index = IvfIndex(ivf_dir)
+        logging.info("Built an IVF index of " + str(index.num_lists) + " lists in " + str(round(time.time() - start, 2)) + "s.")
+        profile.add_time('build_ivf_index', time.time() - start)
+        if recall:
+            log_ivf_recall(query_vectors, index_vectors, index, nprobe)
+        index.vectors_scored = 0
+        for result in get_top_similar_ivf(query_vectors, index, 6, nprobe):
+            yield result
+        logging.info(
+            "Scored " + str(index.vectors_scored) + " pairs of shops probing " + str(nprobe) + " lists ("
+            + str(round(100.0 * index.vectors_scored / max(1, len(query_vectors) * index.num_rows), 2)) + "% of all pairs)."
+        )
+        profile.count('pairs_scored', index.vectors_scored)
+        profile.count('pairs_pruned', len(query_vectors) * index.num_rows - index.vectors_scored)
+    finally:
+        if not index_dir:
+            shutil.rmtree(os.path.dirname(ivf_dir), ignore_errors=True)
+
+def log_ivf_recall(query_vectors, index_vectors, index, nprobe):
+
+    # Input: dense matrices of the shops' normalized query and index vectors,
+    #        an IvfIndex of the index vectors, and the number of lists to probe
+    # Output: logs the time per shop of exact scoring, and the recall@5 against
+    #         it, time per shop and fraction of pairs scored of IVF searches
+    #         probing 1, 2, 4, ... lists (and nprobe lists)
+
+    num_shops = max(1, len(query_vectors))
+    start = time.time()
+    exact = list(get_top_similar(query_vectors, index_vectors, 6))
+    logging.info("Exact scoring took " + str(round(1000 * (time.time() - start) / num_shops, 4)) + " ms per shop.")
+    probes = set([min(nprobe, index.num_lists), index.num_lists])
+    probes.update([2 ** i for i in range(32) if 2 ** i < index.num_lists])
+    for probe in sorted(probes):
+        index.vectors_scored = 0
+        start = time.time()
+        approximate = list(get_top_similar_ivf(query_vectors, index, 6, probe))
+        logging.info(
+            "Probing " + str(probe) + " of " + str(index.num_lists) + " lists: recall@5 "
+            + str(round(get_recall(approximate, exact, 5), 4)) + ", "
+            + str(round(1000 * (time.time() - start) / num_shops, 4)) + " ms per shop, "
+            + str(round(100.0 * index.vectors_scored / max(1, len(query_vectors) * index.num_rows), 2)) + "% of pairs scored."
+        )
+
+def print_all_similar_shops(shops, all_sims, print_details, vocabulary, export_file=None, profile=None):
+
+    # Input: a list of shop objects, an iterable of (shop index, [(shop index,
+    #        similarity), ...]) pairs starting with each shop itself, whether to
+    #        print verbose output, the shops' Vocabulary, (optional) a file to
+    #        export the similar shops to instead (see NeighborWriter),
+    #        and (optional) the run's PipelineProfile
+    # Output: prints (or exports) the five most similar shops to each shop
+    
+    profile = profile or PipelineProfile()
+    writer = None
+    if export_file:
+        writer = NeighborWriter(export_file, [shop['shop_name'] for shop in shops], 5)
+    for i, sims in all_sims:
+        start = time.time()
+        if len(shops[i]['term_counts']) == 0:
+            if writer is not None:
+                writer.write(i, [])
+            else:
+                print shops[i]['shop_name'] + " has no terms!"
+        elif writer is not None:
+            writer.write(i, sims[1:6], get_shop_top_terms(shops[i], vocabulary) if print_details else None)
+        elif print_details:
+            print_similar_shop_details(shops[i], shops, sims[1:6], vocabulary)
         else:
             print_similar_shops(shops[i], shops, sims[1:6])
-    
-    return
+        profile.add_time('output', time.time() - start)
+    if writer is not None:
+        writer.close()
+        logging.info("Exported similar shops to " + export_file + ".")
 
-def print_similar_shop_details(primary_shop, all_shops, sims):  
+def print_similar_shop_details(primary_shop, all_shops, sims, vocabulary):  
 
-    # Input: a shop object along with a list of (shop, similarity score) pairs
+    # Input: a shop object along with a list of (shop index, similarity score) pairs,
+    #        the list of all shop objects, and the shops' Vocabulary
     # Output: prints the primary and similar shops' names,
-    #         along with similarity score and highest weighted terms
+    #         along with similarity score and highest weighted terms,
+    #         in a single write
     
-    print primary_shop['shop_name'],
-    print_top_terms(primary_shop['term_weights'])
+    lines = [primary_shop['shop_name'] + format_top_terms(get_shop_top_terms(primary_shop, vocabulary))]
     if len(sims) <= 1:
-        print " No similar shops were found!"
+        lines.append(" No similar shops were found!\n")
     else:
         i = 1 
         for sim in sims:
-            print str(i) + ". " + str(sim[1]) + " " + all_shops[sim[0]]['shop_name'],
-            print_top_terms(all_shops[sim[0]]['term_weights'])
+            lines.append(
+                str(i) + ". " + str(sim[1]) + " " + all_shops[sim[0]]['shop_name'] 
+                + format_top_terms(get_shop_top_terms(all_shops[sim[0]], vocabulary))
+            )
             i += 1   
+    sys.stdout.write("".join(lines))
     
 def print_similar_shops(primary_shop, all_shops, sims):
 
-    # Input: a shop object along with a list of (shop, similarity score) pairs
-    # Output: prints the primary and similar shops' names
+    # Input: a shop object along with a list of (shop index, similarity score) pairs,
+    #        and the list of all shop objects
+    # Output: prints the primary and similar shops' names on one line
 
-    print primary_shop['shop_name'] + ":",
     if len(sims) <= 1:
-        print " No similar shops were found!"
+        sys.stdout.write(primary_shop['shop_name'] + ":  No similar shops were found!\n")
     else:
-        for sim in sims[:-1]:
-            print all_shops[sim[0]]['shop_name'] + ",",
-        print all_shops[sims[-1][0]]['shop_name']
+        sys.stdout.write(primary_shop['shop_name'] + ": " + ", ".join([all_shops[sim[0]]['shop_name'] for sim in sims]) + "\n")
+
+def get_shop_top_terms(shop, vocabulary):
+
+    # Input: a shop object with term weights, and the shops' Vocabulary
+    # Output: a list of the shop's TOP_TERMS highest weighted (term, weight) pairs,
+    #         found the first time they are asked for and then kept with the shop
+    
+    if 'top_terms' not in shop:
+        shop['top_terms'] = get_top_terms(shop['term_weights'], vocabulary, TOP_TERMS)
+    return shop['top_terms']
                 
-def print_top_terms(term_weights):
+def format_top_terms(top_terms):
+
+    # Input: a list of (term, weight) pairs
+    # Output: the end of an output line listing the terms and their weights
 
-    # Input: a hash of term to weight
-    # Output: prints the top five weighted terms and their weights
+    return "".join(["  (" + term + " " + str(math.trunc(weight*100)/100.0) + ")" for term, weight in top_terms]) + " \n"
 
-    pairs = []
-    for term in term_weights:
-        pairs.append((term, term_weights[term]))
-    pairs = sorted(pairs, key=lambda entry: -1 * entry[1])
-    for pair in pairs[:7]:
-        print " (" + pair[0] + " " + str(math.trunc(pair[1]*100)/100.0) + ")",
-    print ""
+def read_shops(file_name, treasury_file, vocabulary, workers=1, profile=None):
+
+    # Input: the name of a shops file (a .json array or JSON Lines, optionally .gz),
+    #        the name of a treasury store file (or None to leave out treasury tags),
+    #        the Vocabulary to intern the shops' terms in,
+    #        the number of processes to extract and clean terms in,
+    #        and (optional) a PipelineProfile to add the time of each step
+    #        and the number of tokens to
+    # Output: a list of compact shop objects holding just each shop's name and
+    #         TermVector of term counts (the rest of each shop is dropped as soon as it is read)
+    
+    profile = profile or PipelineProfile()
+    shops = []
+    cache_counts = get_empty_counts()
+    results = map_processes(
+        get_shop_term_counts, 
+        profile.iter_timed('load_json', iter_records(file_name)), 
+        workers, 
+        init_term_extraction, 
+        (treasury_file,)
+    )
+    for shop_name, term_counts, tokenizer_counts, timings in results:
+        start = time.time()
+        shops.append({'shop_name': shop_name, 'term_counts': get_term_vector(term_counts, vocabulary)})
+        profile.add_time('intern_terms', time.time() - start)
+        profile.add_times(timings)
+        profile.add_count('tokens', sum(term_counts.itervalues()))
+        add_counts(cache_counts, tokenizer_counts)
+    log_counts(cache_counts)
+    return shops
+
+def init_term_extraction(treasury_file):
+
+    # Input: the name of a treasury store file (or None)
+    # Output: sets up this process (or worker process) to extract shop terms,
+    #         with its own connection to the treasury store
+
+    _extraction['tokenizer'] = Tokenizer(lemmatize=True, lower_first=True)
+    _extraction['treasuries'] = TreasuryStore(treasury_file) if treasury_file else None
+
+def get_shop_term_counts(shop):
+
+    # Input: an Etsy Shop object augmented by additional data
+    # Output: the shop's name, a hash from its cleaned terms to their counts,
+    #         the tokenizer's cache hit and miss counts for the shop,
+    #         and a hash of the seconds each step took (for --profile)
+    
+    tokenizer = _extraction['tokenizer']
+    start = time.time()
+    terms = get_shop_terms(shop, _extraction['treasuries'])
+    extracted = time.time()
+    tokens = tokenizer.clean_terms(terms)
+    cleaned = time.time()
+    term_counts = get_term_counts(tokens)
+    timings = {
+        'extract_terms': extracted - start, 
+        'clean_terms': cleaned - extracted, 
+        'count_terms': time.time() - cleaned,
+    }
+    return shop['shop_name'], term_counts, tokenizer.take_counts(), timings
+
+def get_shop_terms(shop, treasuries):
+
+    # Input: an Etsy Shop object augmented by additional data,
+    #        and a TreasuryStore (or None)
+    # Output: a list of terms found in the shop and its related objects
+    
+    terms = [] 
+    terms += get_listing_terms(shop['listings'])
+    terms += get_user_profile_terms(shop['user_profile'])
+    terms += get_misc_terms(shop)
+    terms += get_treasury_terms(shop['listings'], treasuries)
+    return terms
 
 def get_listing_terms(listings):
 
@@ -215,23 +540,18 @@ def get_misc_terms(shop):
         terms += team['tags']
     return terms
 
-def get_treasury_terms(listings, listing_treasury_hash, tresury_tag_hash):
+def get_treasury_terms(listings, treasuries):
 
-    # Input: a list of Etsy Listing objects, 
-    #        a hash from listing id to the ids of treasuries containing that listing,
-    #        a hash from treasury id to the tags of that treasury
+    # Input: a list of Etsy Listing objects, and a TreasuryStore (or None)
     # Output: a list of terms found in the tags of the treasuries containing
-    #         the input listings
+    #         the input listings, looked up for all the listings at once
     
-    terms = []
-    total = 0
-    for listing in listings:
-        if str(listing['listing_id']) in listing_treasury_hash:
-            total += 1
-            terms += treasury_tag_hash[str(listing['listing_id'])]
+    if treasuries is None:
+        return []
+    terms, total = treasuries.get_tags([listing['listing_id'] for listing in listings])
     if total > 0:
-        logger.debug("Shop found with " + str(total) + " treasuried listing(s).")
-    return terms	
+        logging.debug("Shop found with " + str(total) + " treasuried listing(s).")
+    return terms
 
 def get_term_counts(terms):
 
@@ -247,47 +567,24 @@ def get_term_counts(terms):
         term_counts[term] += 1
     return term_counts
 
-def clean_terms(terms):
+def get_idfs(document_counts, num_shops):
 
-    # Input: a list of terms
-    # Output: a list of these terms with non-alphanumeric characters removed, 
-    #         converted to lowercase, tokenized, 
-    #         and lemmatized (using NLTK WordNet package)
+    # Input: an array of the number of shops which contain each term id,
+    #        the total number of shops
+    # Output: an array of the inverse document frequency of each term id
     
-    cleaned = []
-    lmtzr = WordNetLemmatizer()
-    for term in terms:
-        stems = re.sub('[^0-9a-zA-Z]+', ' ', term.lower()).strip().split()
-        for stem in stems:
-            stem = lmtzr.lemmatize(stem)
-            cleaned.append(stem)
-    return cleaned
+    return np.array([math.log(float(num_shops) / count) for count in document_counts])
 
-def get_term_weights(term_counts, term_shop_counts, num_shops):
+def get_term_weights(term_counts, idfs):
 
-    # Input: a hash of term to term count, 
-    #        a hash of term to the number of documents which contain that term,
-    #        the total number of shops
-    # Output: a hash of terms to the tf-idf weighting of each term,
+    # Input: a TermVector of term counts, 
+    #        an array of the inverse document frequency of each term id
+    # Output: a TermVector of the tf-idf weighting of each term,
     #         using the augmented norm for term frequency
     
-    weights = {}
-    max_count = 1
-    for term in term_counts:
-        max_count = max(max_count, term_counts[term])
-    for term in term_counts:
-        normalized_count = 0.5 + 0.5 * term_counts[term] / max_count
-        weights[term] = normalized_count * math.log(float(num_shops) / term_shop_counts[term])
-    return weights
-        	
-def get_object_from_json(file_name):
-
-    # Input: the name of a known .json file
-    # Output: a python object made from that file's contents
-    
-    file = open(file_name)
-    object = json.load(file)
-    return object
+    max_count = max(1, term_counts.values.max()) if len(term_counts) else 1
+    normalized_counts = 0.5 + 0.5 * term_counts.values / max_count
+    return term_counts.with_values(normalized_counts * idfs[term_counts.ids])
 
 if __name__ == '__main__':
     main()
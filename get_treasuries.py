@@ -1,92 +1,156 @@
+import os
 import sys
-import json
-import urllib2
 import logging
+from command_line import parse_options
+from fetch_pool import TokenBucket, open_pool, close_pool, map_concurrently
+from etsy_api import EtsyClient, ApiError, URL_BASE
+from response_cache import ResponseCache
+from record_stream import RecordWriter, load_checkpoint, save_checkpoint
+from treasury_store import TreasuryStoreWriter
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 KEYSTRING = "<REMOVED>" 
-URL_BASE = "https://openapi.etsy.com/v2/"
+
+# The API client shared by all fetching threads (set up in main)
+CLIENT = None
+
+# Command line options and their defaults
+OPTIONS = {
+    'concurrency': 8,
+    'rate': 10.0,
+    'api_base': None,
+    'retries': 5,
+    'cache_dir': None,
+    'cache_ttl': 86400.0,
+    'cache_max_mb': 0.0,
+    'offline': False,
+    'resume': False,
+}
+
+# Treasuries per page of results (the most the API returns at once)
+PAGE_SIZE = 25
+
+# Pages of treasuries fetched (and saved) per concurrent worker before each checkpoint
+PAGES_PER_WORKER = 4
+
+# Marks a request that failed for good, as distinct from an empty result
+FAILED = object()
 
 def main():
 
     # Command line arguments (2): 
     #         1. the total number of treasuries to download,
-    #         2. the name of the output .json file.
-    # Output: a .json file of an array of treasuries
+    #         2. the name of the output file: .db for a treasury store that the
+    #            similarity scripts can use directly (see make_treasury_hashes.py),
+    #            .jsonl (or .jsonl.gz) for JSON Lines, one treasury per line,
+    #            or .json (or .json.gz) for a single array.
+    # Options:
+    #         --concurrency N: keep up to N API requests in flight at once (default 8)
+    #         --rate R: make at most R API requests per second (default 10)
+    #         --api-base URL: fetch from URL instead of the Etsy API (e.g. a local mock server)
+    #         --retries N: retry requests failing with 429/5xx up to N times (default 5)
+    #         --cache-dir DIR: cache API responses in DIR, so reruns only fetch new or stale pages
+    #         --cache-ttl S: refetch cached responses older than S seconds (default 86400)
+    #         --cache-max-mb M: evict least recently used responses past M megabytes
+    #         --offline: answer every request from the cache, never from the API
+    #         --resume: carry on from the checkpoint of an interrupted run
+    # Output: a treasury store or file of treasuries, written a window of pages
+    #         at a time, and a .checkpoint file of the completed pages until the run is done
+    
+    global CLIENT
     
     # Check command line arguments
     try:
-        total = (int)(sys.argv[1])
-        output_file = sys.argv[2]
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        total = (int)(args[0])
+        output_file = args[1]
     except:
         e = sys.exc_info()[0]
         logging.error("We had an error with command line args: " + str(e)) 
         return
+    cache = None
+    if options['cache_dir']:
+        cache = ResponseCache(options['cache_dir'], options['cache_ttl'], int(options['cache_max_mb'] * 1024 * 1024))
+    CLIENT = EtsyClient(
+        KEYSTRING, 
+        options['api_base'] or URL_BASE, 
+        TokenBucket(options['rate']), 
+        options['retries'],
+        cache=cache,
+        offline=options['offline']
+    )
+        
+    # Open the output, carrying over the treasuries (and completed pages) of an interrupted run
+    checkpoint_file = output_file + ".checkpoint"
+    checkpoint = {'offsets': []}
+    if options['resume']:
+        checkpoint = load_checkpoint(checkpoint_file) or checkpoint
+    if output_file.endswith('.db'):
+        writer = TreasuryStoreWriter(output_file, resume=options['resume'])
+    else:
+        writer = RecordWriter(output_file, key='id', resume=options['resume'])
+    if writer.count:
+        logging.info("Resuming with " + str(writer.count) + " treasuries already saved.")
+    completed = set(checkpoint['offsets'])
         
-    # Fetch treasuries from API, 25 at a time
+    # Fetch pages of treasuries concurrently, a window of pages at a time,
+    # saving each page's treasuries as soon as its window arrives
     logging.info("Getting treasuries.")
-    treasuries = []
-    for offset in range(0, total, 25):
-    	limit = min(total - offset, 25)
-    	logging.info("Fetching treasuries " + str(offset + 1) + " - " + str(offset + limit))
-    	treasuries += get_treasuries(limit, offset)   	
-    logging.info("There were " + str(len(treasuries)) + " treasuries found.")
- 
-    # Save treasuries to output_file in json format    
-    logging.info("Saving outputs to " + output_file + ".")
-    output_json(treasuries, output_file)
+    offsets = [offset for offset in range(0, total, PAGE_SIZE) if offset not in completed]
+    window = max(1, options['concurrency']) * PAGES_PER_WORKER
+    failures = []
+    pool = open_pool(options['concurrency'])
+    try:
+        for start in range(0, len(offsets), window):
+            window_offsets = offsets[start:start + window]
+            pages = map_concurrently(
+                pool,
+                lambda offset: fetch(failures, offset, min(total - offset, PAGE_SIZE)),
+                window_offsets
+            )
+            for offset, page in zip(window_offsets, pages):
+                if page is FAILED:
+                    continue
+                logging.info("Fetched treasuries " + str(offset + 1) + " - " + str(offset + min(total - offset, PAGE_SIZE)))
+                for treasury in page:
+                    if treasury['id'] not in writer.keys:
+                        writer.write(treasury)
+                completed.add(offset)
+            writer.flush()
+            checkpoint['offsets'] = sorted(completed)
+            save_checkpoint(checkpoint_file, checkpoint)
+    finally:
+        close_pool(pool)
+        writer.close()
+    logging.info("There were " + str(writer.count) + " treasuries found.")
+    CLIENT.log_stats()
+    if failures:
+        logging.error(str(len(failures)) + " pages failed for good, at offsets " + str(sorted(failures)) + "; rerun with --resume to retry them.")
+    elif os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    logging.info("Saved treasuries to " + output_file + ".")
+
+def fetch(failures, offset, limit):
+
+    # Input: a list to record the offsets of failed pages in,
+    #        and the offset and size of a page of treasuries
+    # Output: the page's treasuries, or FAILED if the request failed for good
+    
+    try:
+        return get_treasuries(limit, offset)
+    except ApiError as e:
+        logging.error("We had an error (" + str(e) + ") getting treasuries " + str(offset + 1) + " - " + str(offset + limit) + ".")
+        failures.append(offset)
+        return FAILED
   
 def get_treasuries(limit, offset):
 	
-	# Inputs: limit = the number of treasuries to download,
+    # Inputs: limit = the number of treasuries to download,
     #         offset = the starting index of treasuries to fetch
     # Output: A list of treasuries, from the Etsy API
      
-    url = (
-        URL_BASE 
-        + "treasuries?"
-        + "&limit=" + str(limit)
-        + "&offset=" + str(offset)
-        + "&api_key=" + KEYSTRING
-    ) 
-    object = get_data_from_api(url)
-    if object and object['results']:
-        return object['results']
-    else:
-        return []
-
-def get_data_from_api(url):
-
-    # Input: a url
-    # Output: the .json objects found at that url
+    return CLIENT.get_results("treasuries", {'limit': limit, 'offset': offset})
     
-    try:
-        data = urllib2.urlopen(url).readline()
-        objects = json.loads(data)
-    except:
-        e = sys.exc_info()[0]
-        logging.error("We had an error (" + str(e) + ") with url " + url + ".")
-        objects = None
-    return objects
-    
-def output_json(data, file_name):
-
-    # Input: any object, and an output file_name
-    # Output: saves the object in .json format to the specified file_name
-    
-    with open(file_name, 'w') as outfile:
-        json.dump(data, outfile)
-
 if __name__ == '__main__':
     main()
-  
-  
-  
-  
-  
-  
-  
-  
-  
-  
\ No newline at end of file
@@ -0,0 +1,124 @@
+import heapq
+
+# Number of query terms processed between recomputations of the k-th best score
+# (queries of no more terms than this recompute it after every term)
+THRESHOLD_INTERVAL = 4
+
+class InvertedIndex(object):
+
+    # A term -> posting list index over L2-normalized shop weight vectors.
+    # Queries are scored term-at-a-time, highest max-weight bound first: once
+    # the bound left in the unprocessed query terms cannot reach the minimum
+    # score or the current k-th best partial score, no new candidates are
+    # admitted (prefix filtering), and the remaining candidates are finished
+    # by direct lookups instead of walking the long posting lists.
+
+    def __init__(self, weight_vectors):
+
+        # Input: a list of TermVectors of term weights, one per shop
+
+        self.vectors = []
+        self.postings = {}
+        self.max_weights = {}
+        self.pairs_scored = 0
+        self.pairs_pruned = 0
+        for i, weights in enumerate(weight_vectors):
+            vector = normalize(weights)
+            self.vectors.append(vector)
+            for term in vector:
+                if term not in self.postings:
+                    self.postings[term] = []
+                    self.max_weights[term] = 0.0
+                self.postings[term].append((i, vector[term]))
+                self.max_weights[term] = max(self.max_weights[term], vector[term])
+
+    def search(self, query, count, min_score=0.0, tolerance=0.0):
+
+        # Input: a TermVector of term weights, the number of results to keep,
+        #        the minimum similarity to report, and a tolerance below the
+        #        k-th best score within which extra candidates are also kept
+        # Output: a list of (shop index, similarity) pairs in descending order
+        #         of similarity, ties broken by shop index
+
+        query = normalize(query)
+        terms = [term for term in query if term in self.postings and query[term] > 0]
+        bounds = dict((term, query[term] * self.max_weights[term]) for term in terms)
+        terms = sorted(terms, key=lambda term: (-bounds[term], term))
+
+        # remaining[i] is the most that terms[i:] can add to any shop's score
+        remaining = [0.0] * (len(terms) + 1)
+        for i in xrange(len(terms) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + bounds[terms[i]]
+
+        # Accumulate partial scores until no unseen shop can make the cut.
+        # Partial scores only grow, so a stale k-th best is still a safe cut,
+        # and none can exceed the bound processed so far, so the k-th best is
+        # only worth recomputing once the remaining bound has dropped below that.
+        # Short queries, like search box text, recompute it after every term, as
+        # waiting THRESHOLD_INTERVAL terms would never recompute it at all.
+        scores = {}
+        threshold = min_score
+        position = len(terms)
+        interval = 1 if len(terms) <= THRESHOLD_INTERVAL else THRESHOLD_INTERVAL
+        for i, term in enumerate(terms):
+            if i % interval == 0 and remaining[i] < remaining[0] - remaining[i]:
+                threshold = self.get_threshold(scores, count, min_score)
+            if remaining[i] < threshold - tolerance:
+                position = i
+                break
+            weight = query[term]
+            for shop_index, shop_weight in self.postings[term]:
+                scores[shop_index] = scores.get(shop_index, 0.0) + weight * shop_weight
+
+        # Finish the surviving candidates from their own vectors
+        rest = terms[position:]
+        if rest:
+            threshold = self.get_threshold(scores, count, min_score) - tolerance
+            for shop_index in scores.keys():
+                if scores[shop_index] + remaining[position] < threshold:
+                    del scores[shop_index]
+                    self.pairs_pruned += 1
+                    continue
+                vector = self.vectors[shop_index]
+                for term in rest:
+                    if term in vector:
+                        scores[shop_index] += query[term] * vector[term]
+        self.pairs_scored += len(scores)
+
+        threshold = self.get_threshold(scores, count, min_score) - tolerance
+        top = [(shop_index, scores[shop_index]) for shop_index in scores
+            if scores[shop_index] > 0 and scores[shop_index] >= threshold]
+        top = sorted(top, key=lambda entry: (-entry[1], entry[0]))
+        if not tolerance:
+            top = top[:count]
+        return top
+
+    def get_threshold(self, scores, count, min_score):
+
+        # Input: a hash from shop index to partial score, the number of results
+        #        to keep, and the minimum similarity to report
+        # Output: the score a shop must reach to enter the current top results
+
+        if len(scores) < count:
+            return min_score
+        return max(min_score, heapq.nlargest(count, scores.itervalues())[-1])
+
+def normalize(weights):
+
+    # Input: a TermVector of term weights
+    # Output: a hash from term id to weight, scaled to unit length
+
+    if not weights.norm:
+        return {}
+    return dict(zip(weights.ids.tolist(), (weights.values / weights.norm).tolist()))
+
+def get_all_top_similar(index, weight_vectors, count, min_score=0.0, tolerance=0.0):
+
+    # Input: an InvertedIndex, the TermVectors it was built from, the number of
+    #        results to keep per shop, the minimum similarity to report,
+    #        and a score tolerance
+    # Output: yields (shop index, [(shop index, similarity), ...]) for every
+    #         indexed shop, using the shop's own vector as the query
+
+    for i, vector in enumerate(weight_vectors):
+        yield i, index.search(vector, count, min_score, tolerance)
@@ -0,0 +1,165 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+from similarity_engine import normalize_rows, get_block_size
+from sharded_index import get_shard_top, merge_top
+
+# Name of the file describing an IVF index directory
+MANIFEST = 'manifest.json'
+
+# Training vectors sampled per list to fit the k-means centroids
+TRAINING_PER_LIST = 256
+
+# Rounds of k-means run to fit the centroids
+KMEANS_ITERATIONS = 20
+
+# Query rows searched at once (bounding the candidate lists being merged)
+QUERY_ROWS = 10000
+
+def write_ivf_index(vectors, directory, num_lists, seed=0):
+
+    # Input: a dense matrix of L2-normalized vectors, the directory to write
+    #        the index to, the number of lists to partition the vectors into,
+    #        and the seed of the k-means sample and initial centroids
+    # Output: fits k-means centroids to the vectors, assigns each vector to the
+    #         list of its nearest centroid, and saves the centroids, the vectors
+    #         grouped by list and their row numbers as .npy files
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = train_centroids(vectors, min(num_lists, len(vectors)), seed=seed)
+    lists = get_nearest_lists(vectors, centroids, 1).ravel()
+    order = np.argsort(lists, kind='mergesort')
+    offsets = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+    np.save(os.path.join(directory, 'centroids.npy'), centroids)
+    np.save(os.path.join(directory, 'offsets.npy'), offsets.astype(np.int64))
+    np.save(os.path.join(directory, 'ids.npy'), order.astype(np.int64))
+    np.save(os.path.join(directory, 'vectors.npy'), vectors[order])
+
+    # The manifest is written last, so a directory without one is incomplete
+    with open(os.path.join(directory, MANIFEST), 'w') as file:
+        json.dump({'num_features': vectors.shape[1], 'num_lists': len(centroids), 'num_rows': len(vectors)}, file)
+
+def train_centroids(vectors, num_lists, iterations=KMEANS_ITERATIONS, seed=0):
+
+    # Input: a dense matrix of L2-normalized vectors, the number of centroids,
+    #        the number of k-means rounds, and the seed of the random sample
+    # Output: a float32 matrix of unit length centroids, fit by spherical k-means
+    #         (nearest meaning highest cosine similarity) to a sample of at most
+    #         TRAINING_PER_LIST vectors per centroid
+
+    if not num_lists:
+        return np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    random = np.random.RandomState(seed)
+    if len(vectors) > TRAINING_PER_LIST * num_lists:
+        sample = vectors[np.sort(random.choice(len(vectors), TRAINING_PER_LIST * num_lists, replace=False))]
+    else:
+        sample = vectors
+    centroids = sample[random.choice(len(sample), num_lists, replace=False)]
+    for i in range(iterations):
+        lists = get_nearest_lists(sample, centroids, 1)[:, 0]
+        members = sparse.csr_matrix(
+            (np.ones(len(sample), dtype=np.float32), (lists, np.arange(len(sample)))),
+            shape=(num_lists, len(sample))
+        )
+        sums = np.asarray(members.dot(sample), dtype=np.float32)
+
+        # Lists left empty restart from random sample vectors
+        empty = np.flatnonzero(np.diff(members.indptr) == 0)
+        sums[empty] = sample[random.choice(len(sample), len(empty))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+def get_nearest_lists(vectors, centroids, nprobe):
+
+    # Input: a dense matrix of vectors, a matrix of centroids,
+    #        and the number of nearest centroids to find per vector
+    # Output: an array with a row per vector, holding the numbers of its
+    #         nprobe nearest centroids, nearest first
+
+    nprobe = min(nprobe, len(centroids))
+    nearest = np.zeros((len(vectors), nprobe), dtype=np.int64)
+    if not nprobe:
+        return nearest
+    block_size = get_block_size(len(centroids))
+    for start in xrange(0, len(vectors), block_size):
+        scores = np.asarray(vectors[start:start + block_size]).dot(centroids.T)
+        if nprobe < len(centroids):
+            top = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            top = np.tile(np.arange(len(centroids)), (len(scores), 1))
+        order = np.argsort(-scores[np.arange(len(scores))[:, np.newaxis], top], axis=1, kind='mergesort')
+        nearest[start:start + len(scores)] = top[np.arange(len(scores))[:, np.newaxis], order]
+    return nearest
+
+class IvfIndex(object):
+
+    # An inverted file (IVF) index written by write_ivf_index, with its arrays
+    # memory-mapped read-only. A query is scored only against the vectors in
+    # the lists of its nprobe nearest centroids, so it scans about
+    # nprobe / num_lists of the index (missing neighbors in other lists).
+
+    def __init__(self, directory):
+
+        # Input: a directory written by write_ivf_index
+
+        with open(os.path.join(directory, MANIFEST)) as file:
+            manifest = json.load(file)
+        self.num_features = manifest['num_features']
+        self.num_lists = manifest['num_lists']
+        self.num_rows = manifest['num_rows']
+        self.centroids = np.load(os.path.join(directory, 'centroids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self.ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+        self.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode='r')
+        self.vectors_scored = 0
+
+    def search(self, queries, count, nprobe):
+
+        # Input: a dense matrix of normalized query vectors, the number of
+        #        results to keep per query, and the number of lists to probe
+        # Output: (rows, columns, scores) arrays of each query's best count
+        #         positive similarities among the probed lists, sorted by query
+        #         row, then by descending score, then by index row
+
+        rows = [np.zeros(0, dtype=np.int64)]
+        columns = [np.zeros(0, dtype=np.int64)]
+        scores = [np.zeros(0, dtype=np.float32)]
+        queries = np.asarray(queries)
+        if self.num_lists and len(queries):
+            # Group the (query, list) probes by list, so each list is read once
+            probes = get_nearest_lists(queries, self.centroids, nprobe)
+            probe_rows = np.repeat(np.arange(len(queries)), probes.shape[1])
+            probe_lists = probes.ravel()
+            order = np.argsort(probe_lists, kind='mergesort')
+            probe_rows, probe_lists = probe_rows[order], probe_lists[order]
+            bounds = np.searchsorted(probe_lists, np.arange(self.num_lists + 1))
+            for i in np.unique(probe_lists):
+                query_rows = probe_rows[bounds[i]:bounds[i + 1]]
+                start, stop = self.offsets[i], self.offsets[i + 1]
+                if start == stop:
+                    continue
+                top_rows, top_columns, top_scores = get_shard_top(queries[query_rows].dot(self.vectors[start:stop].T), count)
+                rows.append(query_rows[top_rows])
+                columns.append(np.asarray(self.ids[start:stop])[top_columns])
+                scores.append(top_scores)
+                self.vectors_scored += len(query_rows) * (stop - start)
+        return merge_top(np.concatenate(rows), np.concatenate(columns), np.concatenate(scores), count)
+
+def get_top_similar_ivf(query_matrix, index, count, nprobe):
+
+    # Input: a dense matrix of normalized query vectors, an IvfIndex,
+    #        the number of results to keep per query row,
+    #        and the number of lists to probe per query
+    # Output: yields (query row, [(index row, similarity), ...]) for each query row,
+    #         listing its highest positive similarities in the probed lists in
+    #         descending order with ties broken by index row
+
+    for block_start in xrange(0, len(query_matrix), QUERY_ROWS):
+        query = query_matrix[block_start:block_start + QUERY_ROWS]
+        rows, columns, scores = index.search(query, count, nprobe)
+        bounds = np.searchsorted(rows, np.arange(len(query) + 1))
+        for i in range(len(query)):
+            yield block_start + i, [(int(columns[j]), scores[j]) for j in range(bounds[i], bounds[i + 1])]
@@ -0,0 +1,118 @@
+import numpy as np
+from sharded_index import merge_top
+
+# Shops whose signatures are computed at once (bounding the dense projections)
+SIGNATURE_ROWS = 50000
+
+# Candidate pairs whose exact similarities are computed at once
+PAIR_BLOCK = 100000
+
+# Largest bucket whose shops are all paired up as candidates; bigger buckets
+# (such as those of boilerplate shops with identical terms) are skipped
+MAX_BUCKET_SIZE = 500
+
+class SimHashIndex(object):
+
+    # Buckets shop vectors by random-hyperplane (SimHash) signatures, using banded
+    # locality-sensitive hashing: each signature is cut into bands of rows bits,
+    # and shops whose bits agree across any whole band become candidates.
+    # Two shops with cosine similarity s agree on each bit with probability
+    # 1 - acos(s) / pi, so similar shops collide in some band far more often
+    # than dissimilar ones, and only colliding pairs are ever scored.
+
+    def __init__(self, matrix, bands=16, rows=8, seed=0):
+
+        # Input: a sparse CSR matrix with one row of term weights per shop,
+        #        the number of bands, the number of bits per band (at most 62),
+        #        and the seed of the random hyperplanes
+
+        if not 0 < rows <= 62:
+            raise ValueError("LSH rows must be between 1 and 62")
+        self.bands = bands
+        self.rows = rows
+        self.empty = np.diff(matrix.indptr) == 0
+        self.keys = get_band_keys(matrix, bands, rows, seed)
+        self.pairs_scored = 0
+        self.pairs_skipped = 0
+
+    def get_candidate_pairs(self):
+
+        # Output: (rows, columns) arrays of the distinct pairs of shops, each
+        #         with the lower row first, that share a bucket in any band
+
+        num_shops = self.keys.shape[0]
+        nonempty = np.flatnonzero(~self.empty)
+        codes = np.zeros(0, dtype=np.int64)
+        for band in range(self.bands):
+            # Sort the shops by their key in this band, so each bucket is a run
+            shops = nonempty[np.argsort(self.keys[nonempty, band], kind='mergesort')]
+            keys = self.keys[shops, band]
+            starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            sizes = np.diff(np.concatenate([starts, [len(keys)]]))
+
+            # Pair up the shops of all buckets of the same size at once, and add
+            # the band's pairs (as row * num_shops + column codes) to the distinct pairs
+            band_codes = [codes]
+            for size in np.unique(sizes[sizes > 1]):
+                bucket_starts = starts[sizes == size]
+                if size > MAX_BUCKET_SIZE:
+                    self.pairs_skipped += len(bucket_starts) * size * (size - 1) // 2
+                    continue
+                first, second = np.triu_indices(size, 1)
+                rows = shops[bucket_starts[:, np.newaxis] + first].ravel()
+                columns = shops[bucket_starts[:, np.newaxis] + second].ravel()
+                band_codes.append(np.minimum(rows, columns) * num_shops + np.maximum(rows, columns))
+            codes = np.unique(np.concatenate(band_codes))
+        return codes // num_shops, codes % num_shops
+
+def get_band_keys(matrix, bands, rows, seed=0):
+
+    # Input: a sparse CSR matrix of shop vectors, the number of bands and of
+    #        bits per band, and the seed of the random hyperplanes
+    # Output: an array with a row per shop and a column per band, holding the
+    #         integer made of the shop's signature bits in that band
+
+    random = np.random.RandomState(seed)
+    hyperplanes = random.standard_normal((matrix.shape[1], bands * rows)).astype(np.float32)
+    weights = (1 << np.arange(rows, dtype=np.int64))
+    keys = np.zeros((matrix.shape[0], bands), dtype=np.int64)
+    for start in xrange(0, matrix.shape[0], SIGNATURE_ROWS):
+        stop = min(start + SIGNATURE_ROWS, matrix.shape[0])
+        bits = np.asarray(matrix[start:stop].dot(hyperplanes)) > 0
+        keys[start:stop] = bits.reshape(stop - start, bands, rows).dot(weights)
+    return keys
+
+def get_all_top_similar_lsh(index, matrix, count):
+
+    # Input: a SimHashIndex, the L2-normalized sparse CSR matrix it was built
+    #        from, and the number of results to keep per shop
+    # Output: yields (shop index, [(shop index, similarity), ...]) for each shop,
+    #         listing its highest positive similarities among its candidates
+    #         (and itself) in descending order, with ties broken by shop index
+    #         (the number of candidate pairs scored is kept in index.pairs_scored)
+
+    rows, columns = index.get_candidate_pairs()
+    index.pairs_scored = len(rows)
+
+    # Each shop is a candidate for itself
+    shops = np.flatnonzero(~index.empty)
+    top_rows = shops
+    top_columns = shops
+    top_scores = np.asarray(matrix[shops].multiply(matrix[shops]).sum(axis=1)).ravel()
+
+    # Score a block of pairs at a time, merging each pair (as a candidate for
+    # both of its shops) into the running top lists
+    for start in xrange(0, len(rows), PAIR_BLOCK):
+        block_rows = rows[start:start + PAIR_BLOCK]
+        block_columns = columns[start:start + PAIR_BLOCK]
+        scores = np.asarray(matrix[block_rows].multiply(matrix[block_columns]).sum(axis=1)).ravel()
+        positive = scores > 0
+        top_rows, top_columns, top_scores = merge_top(
+            np.concatenate([top_rows, block_rows[positive], block_columns[positive]]),
+            np.concatenate([top_columns, block_columns[positive], block_rows[positive]]),
+            np.concatenate([top_scores, scores[positive], scores[positive]]),
+            count
+        )
+    bounds = np.searchsorted(top_rows, np.arange(matrix.shape[0] + 1))
+    for i in xrange(matrix.shape[0]):
+        yield i, [(int(top_columns[j]), top_scores[j]) for j in xrange(bounds[i], bounds[i + 1])]
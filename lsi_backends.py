@@ -0,0 +1,229 @@
+import numpy as np
+from scipy import sparse
+from similarity_engine import get_term_matrix, normalize_rows
+from term_vectors import get_document_counts, prune_vocabulary
+
+# Shop vectors projected onto the LSI topics at a time when streaming them
+PROJECTION_ROWS = 10000
+
+# LSI backends selectable with get_similar_shops_lsi.py --backend
+BACKENDS = ('gensim', 'randomized')
+
+class GensimLsi(object):
+
+    # Fits Gensim's LsiModel to the tf-idf weighted shop corpus, and projects
+    # the shops onto its topics (Gensim is imported only when this backend is used).
+    # Every LSI backend has the same attributes and methods:
+    #   terms, document_counts and idfs: the kept terms in column order,
+    #     the number of shops using each, and each term's idf weight
+    #   counts: the sparse matrix of shop term counts, a column per kept term
+    #   projection: the term to topic projection matrix
+    #   get_query_vectors() / get_index_vectors(): dense matrices of the shops'
+    #     normalized float32 topic vectors, to query with and to index
+    #   iter_query_vectors() / iter_index_vectors(): the same vectors, yielded
+    #     a shop at a time
+
+    def __init__(self, vectors, vocabulary, keep, num_topics, oversampling=100, power_iterations=2):
+
+        # Input: a list of TermVectors of shop term counts, their Vocabulary,
+        #        an array marking the term ids to keep, the number of topics,
+        #        and the extra dimensions and power iterations of the
+        #        stochastic SVD Gensim fits the model with
+
+        from gensim import corpora, models
+
+        # Create a Gensim dictionary to house all the words in the corpus
+        texts = (get_text(vector, vocabulary, keep) for vector in vectors)
+        self.dictionary = corpora.Dictionary(texts)
+
+        # Convert the collection of shop term counts into a Gensim document corpus
+        # (words outside the dictionary, like those appearing once, are left out)
+        token_ids = np.array([self.dictionary.token2id.get(term, -1) for term in vocabulary.terms], dtype=np.int64)
+        self.corpus = [get_bow(vector, token_ids) for vector in vectors]
+
+        # Convert the document corpus into a tf-idf weighted corpus
+        self.tfidf = models.TfidfModel(self.corpus)
+        corpus_tfidf = self.tfidf[self.corpus]
+
+        # Convert the tf-idf corpus into a LSI-based corpus of num_topics topics
+        self.lsi = models.LsiModel(
+            corpus_tfidf,
+            id2word=self.dictionary,
+            num_topics=num_topics,
+            power_iters=power_iterations,
+            extra_samples=oversampling
+        )
+        self.corpus_lsi = self.lsi[corpus_tfidf]
+
+        num_terms = len(self.dictionary)
+        self.terms = [self.dictionary[i] for i in range(num_terms)]
+        self.document_counts = [self.dictionary.dfs.get(i, 0) for i in range(num_terms)]
+        self.idfs = [self.tfidf.idfs.get(i, 0.0) for i in range(num_terms)]
+        self.counts = get_bow_matrix(self.corpus, num_terms)
+        self.projection = self.lsi.projection.u
+        self.num_topics = self.lsi.num_topics
+
+    def get_query_vectors(self):
+
+        # Output: the LSI corpus materialized once, as a dense matrix of
+        #         normalized float32 shop vectors (one row per shop)
+
+        from gensim import matutils
+        return normalize_rows(matutils.corpus2dense(self.corpus_lsi, num_terms=self.num_topics, dtype=np.float32).T)
+
+    def get_index_vectors(self):
+
+        # Output: the normalized float32 matrix of shop vectors to score against
+
+        from gensim import similarities
+        return similarities.MatrixSimilarity(self.lsi[self.corpus]).index
+
+    def iter_query_vectors(self):
+
+        # Output: yields the normalized float32 vector of each shop to query with
+
+        from gensim import matutils
+        for vector in self.corpus_lsi:
+            yield matutils.unitvec(matutils.sparse2full(vector, self.num_topics))
+
+    def iter_index_vectors(self):
+
+        # Output: yields the normalized float32 vector of each shop to index,
+        #         normalized just as MatrixSimilarity normalizes them
+
+        from gensim import matutils
+        for vector in self.lsi[self.corpus]:
+            yield matutils.unitvec(matutils.sparse2full(vector, self.num_topics))
+
+class RandomizedLsi(object):
+
+    # Fits LSI with a randomized truncated SVD of the sparse tf-idf matrix,
+    # using only numpy and scipy. The tf-idf weights and the query and index
+    # vectors follow the Gensim backend (see GensimLsi for the attributes and methods).
+
+    def __init__(self, vectors, vocabulary, keep, num_topics, oversampling=100, power_iterations=2, seed=0):
+
+        # Input: a list of TermVectors of shop term counts, their Vocabulary,
+        #        an array marking the term ids to keep, the number of topics,
+        #        the extra dimensions to sample beyond num_topics, the number
+        #        of power iterations, and the seed of the random sample
+
+        vocabulary, vectors = prune_vocabulary(vectors, vocabulary, keep)
+        self.counts = get_term_matrix(vectors, len(vocabulary))
+        document_counts = get_document_counts(vectors, len(vocabulary))
+
+        # Weight terms by log2 idf and normalize each shop's weights, as Gensim's
+        # TfidfModel does (terms in every shop get no weight at all)
+        idfs = np.log2(float(len(vectors)) / np.maximum(document_counts, 1))
+        self.tfidf = normalize_rows(self.counts.dot(sparse.diags(idfs)))
+        self.tfidf.eliminate_zeros()
+
+        self.terms = list(vocabulary.terms)
+        self.document_counts = document_counts.tolist()
+        self.idfs = idfs.tolist()
+        self.projection = randomized_svd(self.tfidf, num_topics, oversampling, power_iterations, seed)[2].T
+        self.num_topics = self.projection.shape[1]
+
+    def get_query_vectors(self):
+
+        # Output: a dense matrix of the shops' normalized float32 tf-idf topic vectors
+
+        return project(self.tfidf, self.projection, 0, self.tfidf.shape[0])
+
+    def get_index_vectors(self):
+
+        # Output: a dense matrix of the shops' normalized float32 term count
+        #         topic vectors (as the Gensim backend indexes them)
+
+        return project(self.counts, self.projection, 0, self.counts.shape[0])
+
+    def iter_query_vectors(self):
+
+        # Output: yields the rows of get_query_vectors, projected in blocks
+
+        return iter_projected(self.tfidf, self.projection)
+
+    def iter_index_vectors(self):
+
+        # Output: yields the rows of get_index_vectors, projected in blocks
+
+        return iter_projected(self.counts, self.projection)
+
+def randomized_svd(matrix, rank, oversampling=10, power_iterations=2, seed=0):
+
+    # Input: a sparse (or dense) matrix, the number of singular values to find,
+    #        the extra dimensions to sample, the number of power iterations
+    #        (each sharpens the estimate at the cost of two passes over the matrix),
+    #        and the seed of the random sample
+    # Output: a (U, S, Vt) truncated SVD of the matrix, following Halko, Martinsson
+    #         and Tropp's randomized range finder
+
+    rank = min(rank, min(matrix.shape))
+    samples = min(rank + oversampling, min(matrix.shape))
+    if not rank:
+        return np.zeros((matrix.shape[0], 0)), np.zeros(0), np.zeros((0, matrix.shape[1]))
+    random = np.random.RandomState(seed)
+
+    # Find an orthonormal basis for the range of the matrix from a random sample,
+    # re-orthonormalizing between power iterations to keep it stable
+    basis = np.linalg.qr(matrix.dot(random.standard_normal((matrix.shape[1], samples))))[0]
+    for i in range(power_iterations):
+        basis = np.linalg.qr(matrix.T.dot(basis))[0]
+        basis = np.linalg.qr(matrix.dot(basis))[0]
+
+    # Take the SVD of the matrix restricted to that basis
+    small = np.asarray(matrix.T.dot(basis)).T
+    u, s, vt = np.linalg.svd(small, full_matrices=False)
+    return basis.dot(u[:, :rank]), s[:rank], vt[:rank]
+
+def project(matrix, projection, start, stop):
+
+    # Input: a sparse matrix of shop term weights, a term to topic projection
+    #        matrix, and a range of rows to project
+    # Output: a dense matrix of the rows' normalized float32 topic vectors
+
+    return normalize_rows(np.asarray(matrix[start:stop].dot(projection))).astype(np.float32)
+
+def iter_projected(matrix, projection):
+
+    # Input: a sparse matrix of shop term weights and a term to topic projection matrix
+    # Output: yields each row's normalized float32 topic vector,
+    #         projecting PROJECTION_ROWS rows at a time
+
+    for start in xrange(0, matrix.shape[0], PROJECTION_ROWS):
+        for vector in project(matrix, projection, start, min(start + PROJECTION_ROWS, matrix.shape[0])):
+            yield vector
+
+def get_bow_matrix(corpus, num_terms):
+
+    # Input: a Gensim corpus (a list of bags of words) and the number of terms
+    # Output: a sparse CSR matrix with one row of term counts per document
+
+    indptr = np.zeros(len(corpus) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(bow) for bow in corpus])
+    indices = np.array([id for bow in corpus for id, count in bow], dtype=np.int32)
+    data = np.array([count for bow in corpus for id, count in bow], dtype=np.float64)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(corpus), num_terms))
+
+def get_text(term_counts, vocabulary, keep):
+
+    # Input: a TermVector of term counts, its Vocabulary, and an array
+    #        marking the term ids to keep
+    # Output: a list of the kept terms, each repeated as many times as it was counted
+
+    text = []
+    for id, count in zip(term_counts.ids, term_counts.values):
+        if keep[id]:
+            text += [vocabulary.terms[id]] * int(count)
+    return text
+
+def get_bow(term_counts, token_ids):
+
+    # Input: a TermVector of term counts, and an array of the Gensim dictionary
+    #        id of each term id (-1 for terms left out of the dictionary)
+    # Output: the Gensim bag of words (a list of (token id, count) pairs sorted
+    #         by token id) for the terms found in the dictionary
+
+    ids = token_ids[term_counts.ids]
+    kept = ids >= 0
+    return sorted(zip(ids[kept].tolist(), term_counts.values[kept].astype(int).tolist()))
@@ -0,0 +1,157 @@
+import os
+import csv
+import json
+import numpy as np
+from record_stream import RecordWriter, open_file, make_new_directory, replace_directory
+
+# Version of the layout of binary exports
+BINARY_VERSION = 1
+
+# Name of the file describing a binary export directory
+MANIFEST = 'manifest.json'
+
+# Shops written between flushes of JSON Lines exports
+FLUSH_EVERY = 10000
+
+# Rows buffered by CSV exports between writes to the file
+BUFFER_ROWS = 10000
+
+# Columns of CSV exports, a row per similar shop
+CSV_COLUMNS = ['shop_index', 'shop_name', 'rank', 'similar_shop_index', 'similar_shop_name', 'score']
+
+def get_export_format(file_name):
+
+    # Input: the name of an export file or directory
+    # Output: "csv" for names ending in .csv, "jsonl" for names ending in
+    #         .jsonl or .json (each optionally followed by .gz), or else
+    #         "binary" (a directory of .npy matrices)
+
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-3]
+    if file_name.endswith('.csv'):
+        return 'csv'
+    if file_name.endswith('.jsonl') or file_name.endswith('.json'):
+        return 'jsonl'
+    return 'binary'
+
+class NeighborWriter(object):
+
+    # Exports every shop's most similar shops for other services to load, in a
+    # format chosen by the export's name (see get_export_format):
+    #   jsonl: a record per shop of its index, name, similar shops (index, name
+    #     and score) and, if given, its top terms, so each shop's terms are
+    #     written once rather than each time it is someone's similar shop
+    #   csv: a row per similar shop (see CSV_COLUMNS), with a header row
+    #   binary: a directory holding the shop names (shops.json), and an int32
+    #     matrix of the similar shops' indexes (ids.npy, padded with -1) and a
+    #     float32 matrix of their scores (scores.npy, padded with 0), with a
+    #     row per shop, which load_neighbors memory-maps without parsing
+    #     (an earlier export's directory is only replaced when the export closes,
+    #     so its readers keep their memory-mapped files until they load it again)
+    # Shops may be written in any order; shops never written have no similar shops.
+
+    def __init__(self, file_name, shop_names, count):
+
+        # Input: the export's file name (a directory for binary exports),
+        #        the list of shop names in shop index order,
+        #        and the most similar shops to keep per shop
+
+        self.file_name = file_name
+        self.format = get_export_format(file_name)
+        self.shop_names = shop_names
+        self.count = count
+        if self.format == 'binary':
+            # The export is written to a new directory which replaces file_name
+            # when it is closed, so the files of an earlier export there, which
+            # load_neighbors readers may have memory-mapped, are never overwritten
+            self.new_dir = make_new_directory(file_name)
+            shape = (len(shop_names), count)
+            self.ids = np.lib.format.open_memmap(os.path.join(self.new_dir, 'ids.npy'), 'w+', np.int32, shape)
+            self.ids[:] = -1
+            self.scores = np.lib.format.open_memmap(os.path.join(self.new_dir, 'scores.npy'), 'w+', np.float32, shape)
+        elif self.format == 'csv':
+            self.file = open_file(file_name, 'wb')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(CSV_COLUMNS)
+            self.rows = []
+        else:
+            self.writer = RecordWriter(file_name, flush_every=FLUSH_EVERY)
+
+    def write(self, i, similar_shops, top_terms=None):
+
+        # Input: a shop index, a list of its similar shops' (shop index, similarity)
+        #        pairs in descending order of similarity (only the first count are
+        #        kept), and (optional) a list of the shop's top (term, weight) pairs
+        # Output: adds the shop's similar shops to the export
+
+        similar_shops = similar_shops[:self.count]
+        if self.format == 'binary':
+            if similar_shops:
+                self.ids[i, :len(similar_shops)] = [j for j, score in similar_shops]
+                self.scores[i, :len(similar_shops)] = [score for j, score in similar_shops]
+        elif self.format == 'csv':
+            name = self.shop_names[i].encode('utf-8')
+            for rank, (j, score) in enumerate(similar_shops):
+                self.rows.append([i, name, rank + 1, j, self.shop_names[j].encode('utf-8'), repr(float(score))])
+            if len(self.rows) >= BUFFER_ROWS:
+                self.flush()
+        else:
+            record = {
+                'shop_index': i,
+                'shop_name': self.shop_names[i],
+                'similar_shops': [
+                    {'shop_index': j, 'shop_name': self.shop_names[j], 'score': float(score)}
+                    for j, score in similar_shops
+                ],
+            }
+            if top_terms is not None:
+                record['top_terms'] = [[term, weight] for term, weight in top_terms]
+            self.writer.write(record)
+
+    def flush(self):
+
+        # Output: writes the buffered CSV rows out to the file
+
+        self.writer.writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+
+        # Output: finishes the export
+
+        if self.format == 'binary':
+            self.ids.flush()
+            self.scores.flush()
+            del self.ids, self.scores
+            with open(os.path.join(self.new_dir, 'shops.json'), 'w') as outfile:
+                json.dump(self.shop_names, outfile)
+
+            # The manifest is written last, so a directory without one is incomplete
+            with open(os.path.join(self.new_dir, MANIFEST), 'w') as outfile:
+                json.dump({'version': BINARY_VERSION, 'num_shops': len(self.shop_names), 'count': self.count}, outfile)
+            replace_directory(self.new_dir, self.file_name)
+        elif self.format == 'csv':
+            self.flush()
+            self.file.close()
+        else:
+            self.writer.close()
+
+def load_neighbors(directory):
+
+    # Input: a directory written by a binary NeighborWriter
+    # Output: a (shop names, ids, scores) triple of the list of shop names and the
+    #         matrices of each shop's similar shop indexes (-1 past the last one)
+    #         and scores, memory-mapped read-only
+
+    with open(os.path.join(directory, MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest['version'] != BINARY_VERSION:
+        raise ValueError(
+            "Export " + directory + " has version " + str(manifest['version'])
+            + ", expected " + str(BINARY_VERSION) + "."
+        )
+    with open(os.path.join(directory, 'shops.json')) as file:
+        shop_names = json.load(file)
+    ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+    scores = np.load(os.path.join(directory, 'scores.npy'), mmap_mode='r')
+    return shop_names, ids, scores
@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import logging
+from resource_usage import get_cpu_seconds, reset_peak_rss, get_peak_rss_mb, get_rss_mb
+
+# Profilers selectable with the similarity scripts' --profiler option
+PROFILERS = ('cprofile', 'sampling')
+
+# Seconds of CPU time between the stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+# Hottest functions listed in the metrics
+HOT_SPOTS = 25
+
+class PipelineProfile(object):
+
+    # Measures a script's run as a sequence of stages: each stage lasts from its
+    # begin() until the next stage begins (or the run ends), and gets its wall
+    # and CPU time (including that of finished worker processes), its change
+    # in resident memory, and its peak resident memory. Steps repeated inside
+    # a stage (like cleaning each shop's terms) add up their seconds in timers,
+    # and counters hold the sizes of the run (like the number of shops).
+    # Everything is recorded even when disabled (it is cheap), but only enabled
+    # profiles write their metrics, as JSON, when the script exits.
+
+    def __init__(self, enabled=False, file_name=None, profiler=None):
+
+        # Input: whether to write the metrics, (optional) the file to write them
+        #        to (otherwise they go to stderr, as one line), and (optional) the
+        #        profiler to find the hottest functions with: "cprofile"
+        #        (deterministic, with its raw stats also saved to file_name + ".prof")
+        #        or "sampling" (a stack sample every SAMPLE_INTERVAL of CPU time,
+        #        with little overhead); either only profiles this process
+
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError("Unknown profiler " + profiler)
+        self.enabled = enabled or bool(file_name) or bool(profiler)
+        self.file_name = file_name
+        self.profiler = profiler
+        self.stages = []
+        self.timers = {}
+        self.counters = {}
+        self.current = None
+        self.started = None
+        self.profile = None
+        self.sampler = None
+
+    def start(self):
+
+        # Output: starts timing the run (and the profiler), and arranges for
+        #         the metrics to be written when the script exits
+
+        self.started = (time.time(), get_cpu_seconds(children=True))
+        if not self.enabled:
+            return
+        if self.profiler == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.profiler == 'sampling':
+            self.sampler = StackSampler()
+            self.sampler.start()
+        atexit.register(self.finish)
+
+    def begin(self, name):
+
+        # Input: the name of the stage starting now
+        # Output: ends the current stage, if any, and starts measuring the new one
+
+        self.end()
+        self.current = {'stage': name, 'rss_mb': get_rss_mb()}
+        reset_peak_rss()
+        self.current['start'] = (time.time(), get_cpu_seconds(children=True))
+
+    def end(self):
+
+        # Output: ends the current stage, if any, and records its measurements
+
+        if self.current is None:
+            return
+        start, start_cpu = self.current.pop('start')
+        stage = self.current
+        stage['seconds'] = round(time.time() - start, 4)
+        stage['cpu_seconds'] = round(get_cpu_seconds(children=True) - start_cpu, 4)
+        stage['peak_rss_mb'] = get_peak_rss_mb()
+        rss = get_rss_mb()
+        if rss is not None and stage['rss_mb'] is not None:
+            stage['rss_delta_mb'] = round(rss - stage['rss_mb'], 1)
+        stage['rss_mb'] = rss
+        self.stages.append(stage)
+        self.current = None
+
+    def add_time(self, name, seconds):
+
+        # Input: the name of a timer, and the seconds to add to it
+
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def add_times(self, timings):
+
+        # Input: a hash from timer names to seconds to add to them
+        #        (such as the timings a worker process sent back)
+
+        for name in timings:
+            self.timers[name] = self.timers.get(name, 0.0) + timings[name]
+
+    def iter_timed(self, name, iterable):
+
+        # Input: the name of a timer, and an iterable
+        # Output: yields the iterable's items, adding the time spent
+        #         producing each one to the timer
+
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.time() - start)
+                return
+            self.add_time(name, time.time() - start)
+            yield item
+
+    def count(self, name, value):
+
+        # Input: the name of a counter, and its value
+
+        self.counters[name] = value
+
+    def add_count(self, name, value):
+
+        # Input: the name of a counter, and the amount to add to it
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_metrics(self):
+
+        # Output: a JSON-serializable hash of the run's measurements, stages,
+        #         timers, counters and (with a profiler) hottest functions
+
+        start, start_cpu = self.started
+        metrics = {
+            'script': os.path.basename(sys.argv[0]),
+            'arguments': sys.argv[1:],
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+            'seconds': round(time.time() - start, 4),
+            'cpu_seconds': round(get_cpu_seconds(children=True) - start_cpu, 4),
+            'peak_rss_mb': max([stage['peak_rss_mb'] for stage in self.stages] or [get_peak_rss_mb()]),
+            'stages': self.stages,
+            'timers': dict((name, round(seconds, 4)) for name, seconds in self.timers.items()),
+            'counters': self.counters,
+            'profiler': self.profiler,
+        }
+        if self.profile is not None:
+            metrics['hot_spots'] = get_cprofile_hot_spots(self.profile, HOT_SPOTS)
+        elif self.sampler is not None:
+            metrics['hot_spots'] = self.sampler.get_hot_spots(HOT_SPOTS)
+        return metrics
+
+    def finish(self):
+
+        # Output: ends the current stage, stops the profiler, and writes the metrics
+
+        self.end()
+        if self.profile is not None:
+            self.profile.disable()
+            if self.file_name:
+                self.profile.dump_stats(self.file_name + '.prof')
+        if self.sampler is not None:
+            self.sampler.stop()
+        metrics = self.get_metrics()
+        if self.file_name:
+            with open(self.file_name, 'w') as outfile:
+                json.dump(metrics, outfile, indent=2, sort_keys=True)
+            logging.info("Saved profile to " + self.file_name + ".")
+        else:
+            sys.stderr.write(json.dumps(metrics, sort_keys=True) + "\n")
+
+class StackSampler(object):
+
+    # A sampling profiler: every SAMPLE_INTERVAL of the process's CPU time, a
+    # profiling timer signal interrupts the main thread, and the functions on
+    # its stack are tallied. Each sample is weighted by the CPU time since the
+    # last one, since signals arriving during a long call into C (like a numpy
+    # product) are merged into one, which is then attributed to its caller.
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+
+        # Input: the seconds of CPU time between samples
+
+        self.interval = interval
+        self.self_seconds = {}
+        self.total_seconds = {}
+        self.samples = 0
+        self.last = None
+
+    def start(self):
+
+        # Output: starts sampling (on systems with profiling timers)
+
+        if not hasattr(signal, 'setitimer'):
+            logging.warning("The sampling profiler needs signal.setitimer, which this system lacks.")
+            return
+        self.last = get_cpu_seconds()
+        signal.signal(signal.SIGPROF, self.sample)
+        # (system calls interrupted by a sample carry on, rather than failing)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+
+        # Output: stops sampling
+
+        if hasattr(signal, 'setitimer'):
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+
+        # Input: the signal number, and the frame the main thread was running
+        # Output: adds the CPU time since the last sample to the function
+        #         running (its self time) and to each function on the stack
+
+        now = get_cpu_seconds()
+        seconds = now - self.last
+        self.last = now
+        self.samples += 1
+        key = get_function_key(frame.f_code)
+        self.self_seconds[key] = self.self_seconds.get(key, 0.0) + seconds
+        seen = set()
+        while frame is not None:
+            key = get_function_key(frame.f_code)
+            if key not in seen:
+                seen.add(key)
+                self.total_seconds[key] = self.total_seconds.get(key, 0.0) + seconds
+            frame = frame.f_back
+
+    def get_hot_spots(self, count):
+
+        # Input: the number of functions to list
+        # Output: a list of hashes of the functions with the most self time,
+        #         with their self and total (including callees) seconds
+
+        hottest = sorted(self.self_seconds, key=lambda key: -self.self_seconds[key])[:count]
+        return [
+            {
+                'function': key,
+                'self_seconds': round(self.self_seconds[key], 4),
+                'total_seconds': round(self.total_seconds[key], 4),
+            }
+            for key in hottest
+        ]
+
+def get_function_key(code):
+
+    # Input: a code object
+    # Output: its function's "file:line(name)" key, in the style of cProfile
+
+    return os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + '(' + code.co_name + ')'
+
+def get_cprofile_hot_spots(profile, count):
+
+    # Input: a stopped cProfile.Profile, and the number of functions to list
+    # Output: a list of hashes of the functions with the most self time,
+    #         with their call counts and self and total (including callees) seconds
+
+    import pstats
+    stats = pstats.Stats(profile).stats
+    hottest = sorted(stats, key=lambda function: -stats[function][2])[:count]
+    return [
+        {
+            'function': os.path.basename(function[0]) + ':' + str(function[1]) + '(' + function[2] + ')',
+            'calls': stats[function][1],
+            'self_seconds': round(stats[function][2], 4),
+            'total_seconds': round(stats[function][3], 4),
+        }
+        for function in hottest
+    ]
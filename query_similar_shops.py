@@ -0,0 +1,69 @@
+import sys
+import time
+import logging
+from command_line import parse_options
+from similarity_model import load_model, get_similar_shops, search_shops
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+# Command line options and their defaults
+OPTIONS = {
+    'text': False,
+}
+
+def main():
+
+    # Command line arguments (3):
+    #         1. the name of a model directory saved by get_similar_shops.py or
+    #            get_similar_shops_lsi.py with --save-model,
+    #         2. the name of a shop in that model (or free text, with --text),
+    #         3. (optional) the number of similar shops to print (default 5),
+    #            between 1 and the number of other shops in the model
+    # Options:
+    #         --text: print the shops most similar to the free text of argument 2,
+    #                 its terms cleaned and weighted as the model's shops' were
+    # Output: prints the shop's most similar shops along with their similarity scores,
+    #         read from the saved model without refitting anything
+
+    # Check command line arguments and load the model
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        start = time.time()
+        model = load_model(args[0])
+        shop_name = args[1]
+        if len(args) > 2:
+            count = int(args[2])
+        else:
+            count = 5
+        if not 1 <= count <= model['num_shops'] - 1:
+            raise ValueError("The count must be between 1 and the number of other shops")
+        logging.info(
+            "Loaded " + model['model'] + " model with " + str(model['num_shops'])
+            + " shops in " + str(int((time.time() - start) * 1000)) + " ms."
+        )
+    except:
+        e = sys.exc_info()[0]
+        logging.error("We had an error with command line args: " + str(e))
+        return
+
+    start = time.time()
+    if options['text']:
+        similar_shops = search_shops(model, shop_name, count)
+    else:
+        try:
+            similar_shops = get_similar_shops(model, shop_name, count)
+        except KeyError:
+            logging.error("Shop " + shop_name + " is not in the model.")
+            return
+    logging.info("Found similar shops in " + str(int((time.time() - start) * 1000)) + " ms.")
+
+    print shop_name
+    if not similar_shops:
+        print " No similar shops were found!"
+    i = 1
+    for similar_shop in similar_shops:
+        print str(i) + ". " + str(similar_shop[1]) + " " + similar_shop[0]
+        i += 1
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import gzip
+import shutil
+import tempfile
+
+# Bytes read from an input file at a time
+READ_SIZE = 1 << 16
+
+# Whitespace and commas between records, in JSON arrays as well as JSON Lines
+SEPARATOR = re.compile(r'[\s,]*')
+
+def iter_records(file_name, tolerate_truncation=False):
+
+    # Input: the name of a .json file holding an array of objects, or a JSON Lines
+    #        file with one object per line (either optionally gzipped, ending in .gz),
+    #        and whether to stop quietly at a truncated last record
+    # Output: yields the objects one at a time, without loading the whole file
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_end = False
+    started = False
+    with open_file(file_name, 'rb') as file:
+        while True:
+            position = SEPARATOR.match(buffer, position).end()
+            if not started and position < len(buffer):
+                # A JSON array is read the same way as JSON Lines, inside its brackets
+                started = True
+                if buffer[position] == '[':
+                    position += 1
+                    continue
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            if position < len(buffer):
+                try:
+                    record, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer) or at_end:
+                        yield record
+                        position = end
+                        continue
+                except ValueError:
+                    if at_end:
+                        if tolerate_truncation:
+                            return
+                        raise
+            elif at_end:
+                return
+
+            # Read more of the file, dropping what has already been parsed. An
+            # incomplete record is reparsed after each read, so read at least as
+            # much as is pending, doubling the buffer to keep large records linear
+            try:
+                data = file.read(max(READ_SIZE, len(buffer) - position))
+            except (IOError, EOFError):
+                if not tolerate_truncation:
+                    raise
+                data = ''
+            buffer = buffer[position:] + data
+            position = 0
+            at_end = not data
+
+class RecordWriter(object):
+
+    # Streams records to a JSON Lines file (or, for names ending in .json, a JSON
+    # array), gzipped if the name ends in .gz. When resuming, the complete records
+    # of an earlier, interrupted run are carried over and their keys remembered,
+    # so callers can skip work that is already done.
+
+    def __init__(self, file_name, key=None, resume=False, flush_every=100):
+
+        # Input: the output file name, (optional) the record field identifying
+        #        each record, whether to resume an earlier run's output,
+        #        and the number of records written between flushes
+
+        self.file_name = file_name
+        self.key = key
+        self.keys = set()
+        self.count = 0
+        self.flush_every = flush_every
+        self.array = is_array_file(file_name)
+
+        # Move an earlier run's output aside and copy its complete records back
+        source = None
+        if resume:
+            # (named with a prefix, so it keeps the output's .json/.gz suffixes)
+            directory, name = os.path.split(file_name)
+            source = os.path.join(directory, 'resume-' + name)
+            if not os.path.exists(source):
+                if os.path.exists(file_name):
+                    os.rename(file_name, source)
+                else:
+                    source = None
+        self.file = open_file(file_name, 'wb')
+        if self.array:
+            self.file.write('[')
+        if source:
+            for record in iter_records(source, tolerate_truncation=True):
+                if not self.key or record[self.key] not in self.keys:
+                    self.write(record)
+            self.flush()
+            os.remove(source)
+
+    def write(self, record):
+
+        # Input: a JSON-serializable record
+        # Output: appends the record to the output file
+
+        data = json.dumps(record)
+        if self.array:
+            data = (",\n" if self.count else "\n") + data
+        else:
+            data += "\n"
+        self.file.write(data)
+        self.count += 1
+        if self.key:
+            self.keys.add(record[self.key])
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+
+        # Output: pushes the records written so far out to the file
+
+        self.file.flush()
+
+    def close(self):
+
+        # Output: finishes and closes the output file
+
+        if self.array:
+            self.file.write("\n]\n")
+        self.file.close()
+
+def load_checkpoint(file_name):
+
+    # Input: the name of a checkpoint file
+    # Output: the checkpoint's hash, or an empty hash if there is no checkpoint
+
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name) as file:
+        return json.load(file)
+
+def save_checkpoint(file_name, checkpoint):
+
+    # Input: the name of a checkpoint file and a JSON-serializable hash
+    # Output: atomically replaces the checkpoint file with the hash
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    with os.fdopen(handle, 'w') as file:
+        json.dump(checkpoint, file)
+    os.rename(temp_path, file_name)
+
+def make_new_directory(directory):
+
+    # Input: the name of a directory to be replaced by replace_directory
+    # Output: the name of a new, empty directory beside it to write the replacement to
+
+    directory = os.path.abspath(directory)
+    new_dir = tempfile.mkdtemp(dir=os.path.dirname(directory), prefix=os.path.basename(directory) + '.new-')
+    os.chmod(new_dir, 0o755)
+    return new_dir
+
+def replace_directory(new_dir, directory):
+
+    # Input: a directory of newly written files, and the directory to replace with it
+    # Output: renames new_dir to directory, then removes the old directory; its files
+    #         are unlinked rather than rewritten, so processes which memory-mapped
+    #         them keep reading the old contents intact until they load the new ones
+
+    directory = os.path.abspath(directory)
+    old_dir = None
+    if os.path.exists(directory):
+        old_dir = new_dir + '.old'
+        os.rename(directory, old_dir)
+    os.rename(new_dir, directory)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def open_file(file_name, mode):
+
+    # Input: a file name and mode
+    # Output: the opened file, through gzip if the name ends in .gz
+
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode)
+    return open(file_name, mode)
+
+def is_array_file(file_name):
+
+    # Input: a file name
+    # Output: whether the name is of a .json (array) rather than a JSON Lines file
+
+    if file_name.endswith('.gz'):
+        file_name = file_name[:-3]
+    return file_name.endswith('.json')
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import resource
+
+# Linux file that resets the process's peak resident memory when "5" is written to it
+CLEAR_REFS = '/proc/self/clear_refs'
+
+# Linux file listing the process's current and peak resident memory
+STATUS = '/proc/self/status'
+
+# Bytes in a megabyte
+MEGABYTE = 1024 * 1024
+
+def get_cpu_seconds(children=False):
+
+    # Input: whether to add the CPU time of the process's finished child processes
+    #        (such as the workers of a closed process pool)
+    # Output: the user plus system CPU time used by this process so far, in seconds
+
+    times = os.times()
+    if children:
+        return times[0] + times[1] + times[2] + times[3]
+    return times[0] + times[1]
+
+def reset_peak_rss():
+
+    # Output: resets this process's peak resident memory to its current resident
+    #         memory, so get_peak_rss_mb measures from here on; returns whether
+    #         it could (it can't on systems other than Linux)
+
+    try:
+        with open(CLEAR_REFS, 'w') as file:
+            file.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def get_peak_rss_mb():
+
+    # Output: this process's peak resident memory since the last reset_peak_rss
+    #         (or since it started), in megabytes
+
+    peak = get_status_kb('VmHWM')
+    if peak is not None:
+        return round(peak / 1024.0, 1)
+
+    # (ru_maxrss is in kilobytes, except on Mac OS where it is in bytes)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return round(float(peak) / MEGABYTE, 1)
+    return round(peak / 1024.0, 1)
+
+def get_rss_mb():
+
+    # Output: this process's current resident memory in megabytes
+    #         (or None where /proc is not available)
+
+    rss = get_status_kb('VmRSS')
+    return round(rss / 1024.0, 1) if rss is not None else None
+
+def get_status_kb(field):
+
+    # Input: the name of a memory field of /proc/self/status, like "VmRSS"
+    # Output: the field's value in kilobytes, or None if it can't be read
+
+    try:
+        with open(STATUS) as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def measure(function, *args):
+
+    # Input: a function and its arguments
+    # Output: a (result, measurements) pair of the function's result and a hash
+    #         of the wall and CPU seconds it took, the peak resident memory
+    #         while it ran and the resident memory after it returned
+
+    reset_peak_rss()
+    start = time.time()
+    start_cpu = get_cpu_seconds()
+    result = function(*args)
+    measurements = {
+        'seconds': round(time.time() - start, 3),
+        'cpu_seconds': round(get_cpu_seconds() - start_cpu, 3),
+        'peak_rss_mb': get_peak_rss_mb(),
+        'rss_mb': get_rss_mb(),
+    }
+    return result, measurements
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+class ResponseCache(object):
+
+    # A size-bounded on-disk cache of API responses. Each response is stored in
+    # a file named by the SHA-1 of its normalized URL (which never includes the
+    # API key), holding one line of metadata (URL, status, fetch time, ETag and
+    # Last-Modified validators) followed by the response body. Reads refresh a
+    # file's modification time, and the least recently used files are evicted
+    # once the cache grows past its size limit.
+
+    def __init__(self, cache_dir, ttl, max_bytes=None):
+
+        # Input: the cache directory, the seconds a response stays fresh,
+        #        and (optional) the largest total size of cached files in bytes
+
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.size = sum([os.path.getsize(path) for path in self.get_files()])
+
+    def get(self, url):
+
+        # Input: a normalized URL without the API key
+        # Output: a hash of the cached response's metadata plus its 'body' and
+        #         whether it is still 'fresh', or None if the URL is not cached
+
+        path = self.get_path(url)
+        try:
+            with open(path) as file:
+                entry = json.loads(file.readline())
+                entry['body'] = file.read()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        entry['fresh'] = time.time() - entry['fetched'] < self.ttl
+        return entry
+
+    def put(self, url, status, body, headers):
+
+        # Input: a normalized URL without the API key, the response status,
+        #        body and a hash of its (lowercase) headers
+        # Output: stores the response, evicting old responses if the cache is full
+
+        entry = {
+            'url': url,
+            'status': status,
+            'fetched': time.time(),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+        }
+        self.write(url, json.dumps(entry) + "\n" + body)
+
+    def refresh(self, url, entry):
+
+        # Input: a normalized URL and its cached entry, which the API has just
+        #        confirmed is unchanged (304 Not Modified)
+        # Output: marks the cached response as freshly fetched
+
+        metadata = dict((key, entry[key]) for key in entry if key not in ('body', 'fresh'))
+        metadata['fetched'] = time.time()
+        self.write(url, json.dumps(metadata) + "\n" + entry['body'])
+
+    def write(self, url, data):
+
+        # Input: a normalized URL and the data of its cache file
+        # Output: atomically replaces the URL's cache file
+
+        path = self.get_path(url)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as file:
+            file.write(data)
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.rename(temp_path, path)
+            self.size += len(data)
+            if self.max_bytes and self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+
+        # Output: deletes least recently used cache files until the cache is
+        #         back under 90% of its size limit (called holding the lock)
+
+        files = []
+        for path in self.get_files():
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                pass
+        files.sort()
+        self.size = sum([entry[1] for entry in files])
+        for mtime, size, path in files:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def get_files(self):
+
+        # Output: the paths of all cache files
+
+        paths = []
+        for directory, names, files in os.walk(self.cache_dir):
+            paths += [os.path.join(directory, name) for name in files if not name.startswith('tmp')]
+        return paths
+
+    def get_path(self, url):
+
+        # Input: a normalized URL
+        # Output: the path of the URL's cache file
+
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
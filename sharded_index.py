@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+from similarity_engine import normalize_rows
+
+# Name of the file listing the row count of each shard in a shard directory
+MANIFEST = 'manifest.json'
+
+# Bytes taken by each float32 vector entry and similarity score
+ITEM_BYTES = 4
+
+# Fraction of the memory budget spent on the index shard being scored
+# (the rest holds a block of query rows and its scores against the shard)
+SHARD_FRACTION = 0.25
+
+def get_shard_rows(num_features, memory_bytes):
+
+    # Input: the length of each vector, and the memory budget in bytes
+    # Output: the number of vectors to store in each shard
+
+    return max(1, int(memory_bytes * SHARD_FRACTION) // (ITEM_BYTES * max(1, num_features)))
+
+def get_block_rows(num_features, shard_rows, count, memory_bytes):
+
+    # Input: the length of each vector, the number of vectors per index shard,
+    #        the number of results kept per query, and the memory budget in bytes
+    # Output: the number of query rows to score against each shard at once,
+    #         counting the query rows, two copies of their scores against
+    #         one shard, and the candidate top lists being merged
+
+    available = memory_bytes - ITEM_BYTES * num_features * shard_rows
+    row_bytes = ITEM_BYTES * num_features + 2 * ITEM_BYTES * shard_rows + 3 * 8 * count
+    return max(1, int(available) // row_bytes)
+
+def write_shards(vectors, directory, num_features, shard_rows, normalize=True):
+
+    # Input: an iterable of dense vectors, the directory to write shards to,
+    #        the length of each vector, the number of vectors per shard,
+    #        and whether to L2-normalize the vectors (if they are not already)
+    # Output: writes the vectors as float32 to numbered .npy shards,
+    #         holding at most one shard of vectors in memory at a time
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    shards = []
+    buffer = np.zeros((shard_rows, num_features), dtype=np.float32)
+    rows = 0
+    for vector in vectors:
+        buffer[rows] = vector
+        rows += 1
+        if rows == shard_rows:
+            shards.append(save_shard(buffer, rows, normalize, directory, len(shards)))
+            rows = 0
+    if rows or not shards:
+        shards.append(save_shard(buffer, rows, normalize, directory, len(shards)))
+
+    # The manifest is written last, so a directory without one is incomplete
+    with open(os.path.join(directory, MANIFEST), 'w') as file:
+        json.dump({'num_features': num_features, 'shards': shards}, file)
+
+def save_shard(buffer, rows, normalize, directory, number):
+
+    # Input: a buffer of vectors, the number of its rows in use, whether to
+    #        normalize them, and the shard directory and the shard's number
+    # Output: saves the rows as the shard's .npy file,
+    #         and returns the shard's number of rows
+
+    shard = buffer[:rows]
+    if normalize:
+        shard = normalize_rows(shard)
+    np.save(os.path.join(directory, 'shard' + str(number) + '.npy'), shard)
+    return rows
+
+class ShardedMatrix(object):
+
+    # A matrix of vectors saved by write_shards, with each shard memory-mapped
+    # read-only, so only the pages being scored need to be held in memory
+
+    def __init__(self, directory):
+
+        # Input: a directory written by write_shards
+
+        with open(os.path.join(directory, MANIFEST)) as file:
+            manifest = json.load(file)
+        self.num_features = manifest['num_features']
+        self.shards = [
+            np.load(os.path.join(directory, 'shard' + str(i) + '.npy'), mmap_mode='r')
+            for i in range(len(manifest['shards']))
+        ]
+        self.offsets = np.concatenate([[0], np.cumsum(manifest['shards'])]).astype(np.int64)
+        self.num_rows = int(self.offsets[-1])
+
+    def get_rows(self, start, stop):
+
+        # Input: a range of row numbers
+        # Output: a dense array holding a copy of those rows
+
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        parts = []
+        for i in range(first, len(self.shards)):
+            if self.offsets[i] >= stop:
+                break
+            parts.append(self.shards[i][max(start, self.offsets[i]) - self.offsets[i]:min(stop, self.offsets[i + 1]) - self.offsets[i]])
+        if not parts:
+            return np.zeros((0, self.num_features), dtype=np.float32)
+        return np.concatenate(parts)
+
+def get_top_similar_sharded(query_matrix, index_matrix, count, memory_bytes):
+
+    # Input: ShardedMatrix objects of query and index vectors,
+    #        the number of results to keep per query row,
+    #        and the memory budget in bytes for scoring
+    # Output: yields (query row, [(index row, similarity), ...]) for each query row,
+    #         listing its highest positive similarities in descending order
+    #         with ties broken by index row (as similarity_engine.get_top_similar)
+
+    shard_rows = max([len(shard) for shard in index_matrix.shards])
+    block_rows = get_block_rows(index_matrix.num_features, shard_rows, count, memory_bytes)
+    for block_start in xrange(0, query_matrix.num_rows, block_rows):
+        block_stop = min(block_start + block_rows, query_matrix.num_rows)
+        query = query_matrix.get_rows(block_start, block_stop)
+
+        # Score the block against one shard at a time, merging each shard's
+        # top candidates into the block's running top lists
+        rows = np.zeros(0, dtype=np.int64)
+        columns = np.zeros(0, dtype=np.int64)
+        scores = np.zeros(0, dtype=np.float32)
+        for offset, shard in zip(index_matrix.offsets, index_matrix.shards):
+            if not len(shard):
+                continue
+            top_rows, top_columns, top_scores = get_shard_top(query.dot(shard.T), count)
+            rows, columns, scores = merge_top(
+                np.concatenate([rows, top_rows]),
+                np.concatenate([columns, top_columns + offset]),
+                np.concatenate([scores, top_scores]),
+                count
+            )
+
+        # Rows are sorted by query row, so each row's list is a contiguous run
+        bounds = np.searchsorted(rows, np.arange(len(query) + 1))
+        for i in range(len(query)):
+            yield block_start + i, [(int(columns[j]), scores[j]) for j in range(bounds[i], bounds[i + 1])]
+
+def get_shard_top(scores, count):
+
+    # Input: a dense block of similarity scores (one row per query)
+    #        and the number of results to keep per row
+    # Output: (rows, columns, scores) arrays of each row's positive scores that
+    #         are at least its count-th best (so ties at the cut are all kept)
+
+    if scores.shape[1] > count:
+        thresholds = np.partition(scores, -count, axis=1)[:, -count]
+        rows, columns = np.nonzero((scores >= thresholds[:, np.newaxis]) & (scores > 0))
+    else:
+        rows, columns = np.nonzero(scores > 0)
+    return rows, columns, scores[rows, columns]
+
+def merge_top(rows, columns, scores, count):
+
+    # Input: (rows, columns, scores) arrays of candidate results for a block of
+    #        query rows, and the number of results to keep per row
+    # Output: the same arrays holding just each row's best count candidates,
+    #         sorted by row, then by descending score, then by column
+
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = ranks < count
+    return rows[keep], columns[keep], scores[keep]
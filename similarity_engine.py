@@ -0,0 +1,210 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from scipy import sparse
+
+# Upper bound on the size of the dense similarity block scored at once
+BLOCK_BYTES = 64 * 1024 * 1024
+
+# Number of row shards handed to each worker process, for load balancing
+SHARDS_PER_WORKER = 4
+
+# Matrices memory-mapped by each worker process (see load_shared_matrices)
+_shared = {}
+
+def get_term_matrix(vectors, num_terms):
+
+    # Input: a list of TermVectors of term weights, one per shop,
+    #        and the number of terms in their vocabulary
+    # Output: a sparse CSR matrix with one row of term weights per shop,
+    #         with a column per term id
+
+    indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(vector) for vector in vectors])
+    if vectors:
+        data = np.concatenate([vector.values for vector in vectors])
+        indices = np.concatenate([vector.ids for vector in vectors])
+    else:
+        data = np.zeros(0, dtype=np.float64)
+        indices = np.zeros(0, dtype=np.int32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(vectors), num_terms))
+
+def normalize_rows(matrix):
+
+    # Input: a sparse or dense matrix
+    # Output: the same matrix with every row scaled to unit length
+    #         (rows of all zeros are left as they are)
+
+    if sparse.issparse(matrix):
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    else:
+        norms = np.sqrt((matrix * matrix).sum(axis=1))
+    norms[norms == 0] = 1.0
+    scale = 1.0 / norms
+    if sparse.issparse(matrix):
+        return sparse.diags(scale).dot(matrix).tocsr()
+    return matrix * scale[:, np.newaxis].astype(matrix.dtype)
+
+def get_block_size(num_columns):
+
+    # Input: the number of index rows every query row is scored against
+    # Output: the number of query rows whose dense scores fit in BLOCK_BYTES
+
+    return max(1, BLOCK_BYTES // (8 * max(1, num_columns)))
+
+def get_top_similar(query_matrix, index_matrix, count, start=0, stop=None, block_size=None, tolerance=0.0):
+
+    # Input: a matrix of query row vectors and a matrix of index row vectors
+    #        (both L2-normalized, sparse or dense), the number of results
+    #        to keep per query row, an optional range of query rows to score,
+    #        the number of query rows to score per block, and a tolerance
+    #        (see select_top)
+    # Output: yields (query row, [(index row, similarity), ...]) for each query row,
+    #         listing its highest positive similarities in descending order
+    #         with ties broken by index row
+
+    if stop is None:
+        stop = query_matrix.shape[0]
+    if block_size is None:
+        block_size = get_block_size(index_matrix.shape[0])
+    index_transpose = index_matrix.T
+    if sparse.issparse(index_transpose):
+        index_transpose = index_transpose.tocsc()
+    for block_start in xrange(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        scores = query_matrix[block_start:block_stop].dot(index_transpose)
+        if sparse.issparse(scores):
+            scores = scores.toarray()
+        for offset, top in enumerate(select_top(np.asarray(scores), count, tolerance)):
+            yield block_start + offset, top
+
+def select_top(scores, count, tolerance=0.0):
+
+    # Input: a dense block of similarity scores (one row per query),
+    #        the number of results to keep per row, and a tolerance below the
+    #        k-th best score within which extra candidates are also kept
+    # Output: yields a list of (column, score) pairs for each row, holding
+    #         the row's highest positive scores in descending order
+    #         (longer than count only when tolerance is non-zero)
+
+    if scores.shape[1] > count:
+        thresholds = np.partition(scores, -count, axis=1)[:, -count]
+    else:
+        thresholds = np.full(scores.shape[0], -np.inf)
+    for row, threshold in zip(scores, thresholds):
+        # Keep every entry tied with the k-th best so the cut is by column order
+        columns = np.flatnonzero((row >= threshold - tolerance) & (row > 0))
+        order = np.lexsort((columns, -row[columns]))
+        if not tolerance:
+            order = order[:count]
+        yield [(int(columns[i]), row[columns[i]]) for i in order]
+
+def get_recall(approximate, exact, count):
+
+    # Input: lists of (shop index, [(shop index, similarity), ...]) pairs from an
+    #        approximate and an exact engine (in the same shop order, each list
+    #        starting with the shop itself), and the number of results to compare
+    # Output: the fraction of the exact engine's top count similar shops that the
+    #         approximate engine also found (recall@count)
+
+    found = 0
+    total = 0
+    for (i, approximate_top), (j, exact_top) in zip(approximate, exact):
+        expected = set([entry[0] for entry in exact_top if entry[0] != i][:count])
+        found += len(expected & set([entry[0] for entry in approximate_top if entry[0] != i][:count]))
+        total += len(expected)
+    return float(found) / total if total else 1.0
+
+def get_top_similar_parallel(query_matrix, index_matrix, count, workers, tolerance=0.0):
+
+    # Input: the same matrices, count and tolerance as get_top_similar,
+    #        and the number of worker processes to score with
+    # Output: yields the same (query row, [(index row, similarity), ...]) pairs
+    #         as get_top_similar, in query row order
+    
+    shared_dir = tempfile.mkdtemp(prefix='similar_shops_')
+    try:
+        # Workers memory-map the matrices instead of receiving pickled copies
+        save_matrix(query_matrix, os.path.join(shared_dir, 'query'))
+        if index_matrix is query_matrix:
+            index_name = 'query'
+        else:
+            index_name = 'index'
+            save_matrix(index_matrix, os.path.join(shared_dir, index_name))
+        
+        num_rows = query_matrix.shape[0]
+        shard_size = max(1, -(-num_rows // (workers * SHARDS_PER_WORKER)))
+        shards = [(start, min(start + shard_size, num_rows)) for start in xrange(0, num_rows, shard_size)]
+        pool = multiprocessing.Pool(
+            workers, 
+            initializer=load_shared_matrices, 
+            initargs=(shared_dir, index_name, count, tolerance)
+        )
+        try:
+            for results in pool.imap(score_shard, shards):
+                for result in results:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+def load_shared_matrices(shared_dir, index_name, count, tolerance):
+
+    # Input: the directory of matrices saved by get_top_similar_parallel,
+    #        the name of the index matrix, and the scoring parameters
+    # Output: memory-maps the matrices into this worker process
+    
+    _shared['query'] = load_matrix(os.path.join(shared_dir, 'query'))
+    _shared['index'] = load_matrix(os.path.join(shared_dir, index_name))
+    _shared['count'] = count
+    _shared['tolerance'] = tolerance
+
+def score_shard(shard):
+
+    # Input: a (start, stop) range of query rows
+    # Output: the list of get_top_similar results for those rows
+    
+    return list(get_top_similar(
+        _shared['query'], 
+        _shared['index'], 
+        _shared['count'], 
+        start=shard[0], 
+        stop=shard[1], 
+        tolerance=_shared['tolerance']
+    ))
+
+def save_matrix(matrix, path):
+
+    # Input: a sparse CSR or dense matrix, and a path prefix
+    # Output: saves the matrix as .npy files starting with that prefix
+    
+    if sparse.issparse(matrix):
+        np.save(path + '_data.npy', matrix.data)
+        np.save(path + '_indices.npy', matrix.indices)
+        np.save(path + '_indptr.npy', matrix.indptr)
+        np.save(path + '_shape.npy', np.array(matrix.shape, dtype=np.int64))
+    else:
+        np.save(path + '.npy', np.ascontiguousarray(matrix))
+
+def load_matrix(path):
+
+    # Input: a path prefix the matrix was saved under by save_matrix
+    # Output: the matrix, backed by read-only memory-mapped files
+    
+    if os.path.exists(path + '.npy'):
+        return np.load(path + '.npy', mmap_mode='r')
+    shape = tuple(np.load(path + '_shape.npy'))
+    return sparse.csr_matrix(
+        (
+            np.load(path + '_data.npy', mmap_mode='r'), 
+            np.load(path + '_indices.npy', mmap_mode='r'), 
+            np.load(path + '_indptr.npy', mmap_mode='r')
+        ),
+        shape=shape, 
+        copy=False
+    )
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+from scipy import sparse
+from record_stream import make_new_directory, replace_directory
+from similarity_engine import save_matrix, load_matrix, select_top, get_top_similar
+from ivf_index import write_ivf_index, IvfIndex
+from tokenizer import Tokenizer
+
+# Version of the on-disk model layout written by save_model
+MODEL_VERSION = 2
+
+# Number of most similar shops kept for each shop in a saved model
+NEIGHBORS = 5
+
+def save_model(model_dir, model, shop_names, vocabulary, document_counts, idfs, query_vectors, index_vectors, projection=None, counts=None, neighbors=None, ivf_lists=0, nprobe=1):
+
+    # Input: the directory to save the model to,
+    #        the kind of model ("tfidf" or "lsi"),
+    #        a list of shop names in matrix row order,
+    #        a list of terms in matrix column order,
+    #        an array of the number of shops using each term,
+    #        an array of the idf weight of each term,
+    #        the L2-normalized shop vectors used as queries and as the index
+    #        (these are the same matrix for tf-idf),
+    #        (optional) the term to topic projection matrix of an LSI model,
+    #        (optional) the sparse matrix of shop term counts the model was fit to,
+    #        (optional) the (shop indexes, similarities, floors) arrays of each
+    #        shop's nearest neighbors from get_neighbors, which
+    #        update_similar_shops.py needs to update the model,
+    #        and (optional) the number of lists of an IVF index of the dense
+    #        index vectors to search, probing nprobe of them per query
+    # Output: saves the model as a manifest plus .json and .npy files,
+    #         which load_model can memory-map without refitting anything;
+    #         sparse (tf-idf) models also get an inverted index of their shop
+    #         vectors, a matrix with a row of (shop, weight) postings per term
+    #         (replacing any model already in the directory; processes which
+    #         loaded that one keep serving it until they load the directory again)
+
+    # The model is written to a new directory which then replaces model_dir, so
+    # the files of an earlier model there, which servers (or update_similar_shops.py)
+    # may have memory-mapped, are never overwritten
+    new_dir = make_new_directory(model_dir)
+    try:
+        output_json(shop_names, os.path.join(new_dir, 'shops.json'))
+        output_json(vocabulary, os.path.join(new_dir, 'vocabulary.json'))
+        np.save(os.path.join(new_dir, 'document_counts.npy'), np.asarray(document_counts, dtype=np.int64))
+        np.save(os.path.join(new_dir, 'idfs.npy'), np.asarray(idfs, dtype=np.float64))
+        save_matrix(query_vectors, os.path.join(new_dir, 'query'))
+        if index_vectors is not query_vectors:
+            save_matrix(index_vectors, os.path.join(new_dir, 'index'))
+        if sparse.issparse(index_vectors):
+            save_matrix(index_vectors.T.tocsr(), os.path.join(new_dir, 'postings'))
+        if projection is not None:
+            np.save(os.path.join(new_dir, 'projection.npy'), np.ascontiguousarray(projection))
+        if counts is not None:
+            save_matrix(counts, os.path.join(new_dir, 'counts'))
+        if neighbors is not None:
+            np.save(os.path.join(new_dir, 'neighbors.npy'), np.asarray(neighbors[0], dtype=np.int32))
+            np.save(os.path.join(new_dir, 'neighbor_scores.npy'), np.asarray(neighbors[1], dtype=np.float32))
+            np.save(os.path.join(new_dir, 'neighbor_floors.npy'), np.asarray(neighbors[2], dtype=np.float32))
+        if ivf_lists:
+            write_ivf_index(index_vectors, os.path.join(new_dir, 'ivf'), ivf_lists)
+
+        # The manifest is written last, so a model directory without one is incomplete
+        manifest = {
+            'version': MODEL_VERSION,
+            'model': model,
+            'num_shops': len(shop_names),
+            'num_terms': len(vocabulary),
+            'num_topics': projection.shape[1] if projection is not None else None,
+            'shared_index': index_vectors is query_vectors,
+            'has_counts': counts is not None,
+            'has_postings': sparse.issparse(index_vectors),
+            'num_neighbors': neighbors[0].shape[1] if neighbors is not None else 0,
+            'ivf_lists': ivf_lists,
+            'nprobe': nprobe,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        output_json(manifest, os.path.join(new_dir, 'manifest.json'))
+    except:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        raise
+    replace_directory(new_dir, model_dir)
+
+def load_model(model_dir):
+
+    # Input: the directory a model was saved to by save_model
+    # Output: a hash holding the model's manifest entries, shop names, vocabulary,
+    #         and its arrays memory-mapped read-only from disk
+
+    model = get_object_from_json(os.path.join(model_dir, 'manifest.json'))
+    if model['version'] != MODEL_VERSION:
+        raise ValueError(
+            "Model " + model_dir + " has version " + str(model['version'])
+            + ", expected " + str(MODEL_VERSION) + "; rebuild it with --save-model."
+        )
+    model['shop_names'] = get_object_from_json(os.path.join(model_dir, 'shops.json'))
+    model['shop_ids'] = dict((name, i) for i, name in enumerate(model['shop_names']))
+    model['vocabulary'] = get_object_from_json(os.path.join(model_dir, 'vocabulary.json'))
+    model['term_ids'] = dict((term, i) for i, term in enumerate(model['vocabulary']))
+    model['document_counts'] = np.load(os.path.join(model_dir, 'document_counts.npy'), mmap_mode='r')
+    model['idfs'] = np.load(os.path.join(model_dir, 'idfs.npy'), mmap_mode='r')
+    model['query_vectors'] = load_matrix(os.path.join(model_dir, 'query'))
+    if model['shared_index']:
+        model['index_vectors'] = model['query_vectors']
+    else:
+        model['index_vectors'] = load_matrix(os.path.join(model_dir, 'index'))
+    if model['num_topics']:
+        model['projection'] = np.load(os.path.join(model_dir, 'projection.npy'), mmap_mode='r')
+    if model.get('has_counts'):
+        model['counts'] = load_matrix(os.path.join(model_dir, 'counts'))
+    if model.get('has_postings'):
+        model['postings'] = load_matrix(os.path.join(model_dir, 'postings'))
+    if model.get('num_neighbors'):
+        model['neighbors'] = np.load(os.path.join(model_dir, 'neighbors.npy'), mmap_mode='r')
+        model['neighbor_scores'] = np.load(os.path.join(model_dir, 'neighbor_scores.npy'), mmap_mode='r')
+        model['neighbor_floors'] = np.load(os.path.join(model_dir, 'neighbor_floors.npy'), mmap_mode='r')
+    if model.get('ivf_lists'):
+        model['ivf'] = IvfIndex(os.path.join(model_dir, 'ivf'))
+    return model
+
+def get_neighbors(query_vectors, index_vectors, rows=None):
+
+    # Input: the normalized query and index vectors of a model's shops,
+    #        and (optional) an array of the shops to find neighbors for (default all)
+    # Output: a (shop indexes, similarities, floors) triple of arrays, with a row
+    #         per shop of its NEIGHBORS most similar other shops (padded with -1
+    #         indexes and 0 similarities), and its floor: the similarity of its
+    #         next most similar shop (or 0 if it has none), which no shop left off
+    #         its list exceeds (update_similar_shops.py keeps lists by this margin)
+
+    if rows is not None:
+        query_vectors = query_vectors[rows]
+    else:
+        rows = np.arange(query_vectors.shape[0])
+    neighbors = np.full((len(rows), NEIGHBORS), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), NEIGHBORS), dtype=np.float32)
+    floors = np.zeros(len(rows), dtype=np.float32)
+    for offset, top in get_top_similar(query_vectors, index_vectors, NEIGHBORS + 2):
+        top = [pair for pair in top if pair[0] != rows[offset]][:NEIGHBORS + 1]
+        listed = top[:NEIGHBORS]
+        neighbors[offset, :len(listed)] = [pair[0] for pair in listed]
+        scores[offset, :len(listed)] = [pair[1] for pair in listed]
+        if len(top) > NEIGHBORS:
+            floors[offset] = top[NEIGHBORS][1]
+    return neighbors, scores, floors
+
+def get_similar_shops(model, shop_name, count):
+
+    # Input: a model from load_model, a shop name, and the number of results
+    # Output: a list of (shop name, similarity) pairs for the shop's most
+    #         similar other shops, in descending order of similarity
+    #         (raises KeyError for shops that are not in the model)
+
+    i = model['shop_ids'][shop_name]
+    return [
+        (model['shop_names'][j], float(similarity))
+        for j, similarity in get_similar_vectors(model, model['query_vectors'][i], count, exclude=i)
+    ]
+
+def search_shops(model, text, count):
+
+    # Input: a model from load_model, a free text query, and the number of results
+    # Output: a list of (shop name, similarity) pairs for the shops most similar
+    #         to the text, in descending order of similarity (empty when none of
+    #         the text's terms are in the model)
+
+    vector = get_text_vector(model, text)
+    if vector is None:
+        return []
+    return [
+        (model['shop_names'][j], float(similarity))
+        for j, similarity in get_similar_vectors(model, vector, count)
+    ]
+
+def get_text_vector(model, text):
+
+    # Input: a model from load_model, and a free text query
+    # Output: the text's normalized vector in the model's query space, its terms
+    #         cleaned and weighted as the script that fit the model did its shops'
+    #         (a sparse row of tf-idf weights with the augmented norm for term
+    #         frequency, or a dense LSI topic vector), or None if none of its
+    #         terms are in the model
+
+    if 'tokenizer' not in model:
+        if model['model'] == 'lsi':
+            model['tokenizer'] = Tokenizer(lemmatize=True, lower_first=True)
+        else:
+            model['tokenizer'] = Tokenizer()
+    ids = [model['term_ids'][term] for term in model['tokenizer'].clean_terms(text.split()) if term in model['term_ids']]
+    if not ids:
+        return None
+    ids, counts = np.unique(ids, return_counts=True)
+    idfs = np.asarray(model['idfs'])[ids]
+    if model['model'] == 'lsi':
+        vector = (counts * idfs).dot(np.asarray(model['projection'][ids]))
+    else:
+        vector = (0.5 + 0.5 * counts / float(counts.max())) * idfs
+    norm = np.sqrt((vector ** 2).sum())
+    if not norm:
+        return None
+    if model['model'] == 'lsi':
+        return (vector / norm).astype(np.float32)
+    return sparse.csr_matrix((vector / norm, ids, [0, len(ids)]), shape=(1, len(model['vocabulary'])))
+
+def get_similar_vectors(model, vector, count, exclude=None):
+
+    # Input: a model from load_model, a normalized query vector (a sparse row
+    #        or dense array in the model's query space), the number of results,
+    #        and (optional) a shop index to leave out of the results
+    # Output: a list of (shop index, similarity) pairs in descending order
+    #         (approximate for models with an IVF index)
+
+    if 'ivf' in model and not sparse.issparse(vector):
+        rows, columns, scores = model['ivf'].search(np.asarray(vector)[np.newaxis, :], count + 1, model['nprobe'])
+        return [(int(j), score) for j, score in zip(columns, scores) if j != exclude][:count]
+    if sparse.issparse(vector) and 'postings' in model:
+        # Only walk the postings of the vector's terms
+        scores = model['postings'][vector.indices].T.dot(vector.data)
+    elif sparse.issparse(vector):
+        scores = model['index_vectors'].dot(vector.T).toarray().ravel()
+    else:
+        scores = model['index_vectors'].dot(np.asarray(vector))
+    if exclude is not None:
+        scores[exclude] = 0
+    return next(select_top(scores[np.newaxis, :], count))
+
+def output_json(data, file_name):
+
+    # Input: any object, and an output file_name
+    # Output: saves the object in .json format to the specified file_name
+
+    with open(file_name, 'w') as outfile:
+        json.dump(data, outfile)
+
+def get_object_from_json(file_name):
+
+    # Input: the name of a known .json file
+    # Output: a python object made from that file's contents
+
+    with open(file_name) as file:
+        return json.load(file)
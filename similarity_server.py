@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import urlparse
+import collections
+import BaseHTTPServer
+import SocketServer
+from command_line import parse_options
+from similarity_model import load_model, get_similar_shops, search_shops
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+# Command line options and their defaults
+OPTIONS = {
+    'host': '127.0.0.1',
+    'port': 8000,
+    'socket': None,
+    'cache_size': 10000,
+    'max_k': 100,
+}
+
+# Number of recent request latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 10000
+
+# Error message for requests to unknown paths
+USAGE = "Use /similar?shop=NAME&k=5, /search?q=TEXT&k=5, /batch or /stats."
+
+def main():
+
+    # Command line arguments (1):
+    #         1. the name of a model directory saved with --save-model
+    # Options:
+    #         --host H, --port P: listen for HTTP on H:P (default 127.0.0.1:8000)
+    #         --socket PATH: listen for HTTP on a Unix socket instead
+    #         --cache-size N: keep up to N lookups in the LRU result cache
+    #         --max-k N: the most similar shops a lookup may ask for (default 100,
+    #                    and at most the number of other shops in the model)
+    # Output: serves similar shop lookups from the model, kept warm in memory:
+    #         GET  /similar?shop=NAME&k=5
+    #         GET  /search?q=TEXT&k=5 for the shops most similar to free text
+    #         POST /batch with a body of {"shops": [NAME, ...], "k": 5}
+    #         GET  /stats for cache, latency and throughput statistics
+
+    # Check command line arguments and load the model
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        model = load_model(args[0])
+    except:
+        e = sys.exc_info()[0]
+        logging.error("We had an error with command line args: " + str(e))
+        return
+    logging.info("Loaded " + model['model'] + " model with " + str(model['num_shops']) + " shops.")
+
+    if options['socket']:
+        if os.path.exists(options['socket']):
+            os.remove(options['socket'])
+        server = UnixSimilarityServer(options['socket'], SimilarityHandler)
+        logging.info("Listening on " + options['socket'] + ".")
+    else:
+        server = SimilarityServer((options['host'], options['port']), SimilarityHandler)
+        logging.info("Listening on " + options['host'] + ":" + str(options['port']) + ".")
+    server.model = model
+    server.max_count = min(options['max_k'], model['num_shops'] - 1)
+    server.cache = LRUCache(options['cache_size'])
+    server.stats = ServerStats()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options['socket'] and os.path.exists(options['socket']):
+            os.remove(options['socket'])
+
+class SimilarityServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # An HTTP server that handles each connection in its own thread
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixSimilarityServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    # The same server listening on a Unix socket
+
+    daemon_threads = True
+
+    def server_bind(self):
+
+        # Output: binds the socket and fills in the names BaseHTTPServer expects
+
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+class SimilarityHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Answers similar shop lookups with JSON responses
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        # Output: answers /similar, /search and /stats requests
+
+        start = time.time()
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/stats':
+            self.send_json(200, self.server.stats.get_summary(self.server.cache))
+            return
+        if (url.path != '/similar' or 'shop' not in query) and (url.path != '/search' or 'q' not in query):
+            self.send_error_json(404, USAGE)
+            return
+        try:
+            count = int(query.get('k', ['5'])[0])
+        except ValueError:
+            self.send_error_json(400, "k must be an integer.")
+            return
+        if not self.check_count(count):
+            return
+        if url.path == '/search':
+            self.send_json(200, self.search(query['q'][0], count))
+            self.server.stats.record(time.time() - start, 1)
+            return
+        result = self.lookup(query['shop'][0], count)
+        if result is None:
+            self.send_error_json(404, "Shop " + query['shop'][0] + " is not in the model.")
+            return
+        self.send_json(200, result)
+        self.server.stats.record(time.time() - start, 1)
+
+    def do_POST(self):
+
+        # Output: answers /batch requests for several shops at once
+
+        start = time.time()
+        if urlparse.urlparse(self.path).path != '/batch':
+            self.send_error_json(404, USAGE)
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            count = int(request.get('k', 5))
+            shop_names = request['shops']
+            if not isinstance(shop_names, list) or not all(isinstance(shop_name, basestring) for shop_name in shop_names):
+                raise TypeError("shops must be a list of shop names")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error_json(400, "Send a body of {\"shops\": [NAME, ...], \"k\": 5}.")
+            return
+        if not self.check_count(count):
+            return
+        results = []
+        for shop_name in shop_names:
+            result = self.lookup(shop_name, count)
+            if result is None:
+                result = {'shop': shop_name, 'error': "Shop is not in the model."}
+            results.append(result)
+        self.send_json(200, {'results': results})
+        self.server.stats.record(time.time() - start, len(shop_names))
+
+    def check_count(self, count):
+
+        # Input: the number of similar shops a request asked for
+        # Output: whether it is between 1 and the server's maximum,
+        #         sending an error response if it isn't
+
+        if 1 <= count <= self.server.max_count:
+            return True
+        self.send_error_json(400, "k must be between 1 and " + str(self.server.max_count) + ".")
+        return False
+
+    def lookup(self, shop_name, count):
+
+        # Input: a shop name and the number of similar shops to return
+        # Output: a hash of the shop name and its similar shops,
+        #         or None if the shop is not in the model
+
+        key = (shop_name, count)
+        result = self.server.cache.get(key)
+        if result is not None:
+            return result
+        try:
+            similar_shops = get_similar_shops(self.server.model, shop_name, count)
+        except KeyError:
+            return None
+        result = {
+            'shop': shop_name,
+            'similar': [{'shop': name, 'score': score} for name, score in similar_shops],
+        }
+        self.server.cache.put(key, result)
+        return result
+
+    def search(self, text, count):
+
+        # Input: a free text query and the number of similar shops to return
+        # Output: a hash of the query and the shops most similar to it
+
+        key = ('search', text, count)
+        result = self.server.cache.get(key)
+        if result is not None:
+            return result
+        result = {
+            'query': text,
+            'similar': [{'shop': name, 'score': score} for name, score in search_shops(self.server.model, text, count)],
+        }
+        self.server.cache.put(key, result)
+        return result
+
+    def send_json(self, status, data):
+
+        # Input: an HTTP status code and any JSON-serializable object
+        # Output: sends the object as the response body
+
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+
+        # Input: an HTTP status code and an error message
+        # Output: sends the message as a JSON error response
+
+        self.server.stats.record_error()
+        self.send_json(status, {'error': message})
+
+    def address_string(self):
+
+        # Output: the client address for log lines (Unix sockets have none)
+
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+
+        # Output: sends request log lines through logging at debug level
+
+        logging.debug(self.address_string() + " " + (format % args))
+
+class LRUCache(object):
+
+    # A thread-safe, size-bounded cache that evicts the least recently used entry
+
+    def __init__(self, capacity):
+
+        # Input: the maximum number of entries to keep
+
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+
+        # Input: a cache key
+        # Output: the cached value, or None if the key is not cached
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+
+        # Input: a cache key and its value
+        # Output: caches the value, evicting the least recently used entry if full
+
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.pop(key)
+            elif len(self.entries) >= self.capacity:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+
+class ServerStats(object):
+
+    # Thread-safe request counters and a window of recent request latencies
+
+    def __init__(self):
+
+        self.started = time.time()
+        self.requests = 0
+        self.lookups = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+
+    def record(self, latency, lookups):
+
+        # Input: the seconds a request took and the number of shops it looked up
+        # Output: adds the request to the statistics
+
+        with self.lock:
+            self.requests += 1
+            self.lookups += lookups
+            self.latencies.append(latency)
+
+    def record_error(self):
+
+        # Output: counts a failed request
+
+        with self.lock:
+            self.errors += 1
+
+    def get_summary(self, cache):
+
+        # Input: the server's LRUCache
+        # Output: a hash of request, throughput, latency and cache statistics
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.time() - self.started
+            summary = {
+                'uptime_seconds': uptime,
+                'requests': self.requests,
+                'lookups': self.lookups,
+                'errors': self.errors,
+                'requests_per_second': self.requests / uptime if uptime else 0.0,
+                'lookups_per_second': self.lookups / uptime if uptime else 0.0,
+            }
+        summary['latency_ms'] = {
+            'mean': 1000 * sum(latencies) / len(latencies) if latencies else None,
+            'p50': get_percentile(latencies, 50),
+            'p95': get_percentile(latencies, 95),
+            'p99': get_percentile(latencies, 99),
+            'max': 1000 * latencies[-1] if latencies else None,
+        }
+        with cache.lock:
+            summary['cache'] = {
+                'size': len(cache.entries),
+                'capacity': cache.capacity,
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_rate': float(cache.hits) / (cache.hits + cache.misses) if cache.hits + cache.misses else None,
+            }
+        return summary
+
+def get_percentile(values, percent):
+
+    # Input: a sorted list of latencies in seconds, and a percentile
+    # Output: the latency at that percentile in milliseconds, or None if empty
+
+    if not values:
+        return None
+    return 1000 * values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+if __name__ == '__main__':
+    main()
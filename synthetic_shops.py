@@ -0,0 +1,207 @@
+import sys
+import logging
+import numpy as np
+from command_line import parse_options
+from record_stream import RecordWriter
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+# Command line options and their defaults
+OPTIONS = {
+    'seed': 0,
+    'vocabulary_size': 200000,
+    'zipf_exponent': 1.0,
+    'categories': 200,
+}
+
+# Syllables the synthetic words are spelled with (a word per vocabulary rank)
+SYLLABLES = [
+    'ba', 'be', 'bi', 'bo', 'da', 'de', 'di', 'do', 'ka', 'ke', 'ki', 'ko',
+    'la', 'le', 'li', 'lo', 'ma', 'me', 'mi', 'mo', 'na', 'ne', 'ni', 'no',
+    'ra', 're', 'ri', 'ro', 'sa', 'se', 'si', 'so', 'ta', 'te', 'ti', 'to',
+    'va', 've', 'vi', 'vo',
+]
+
+# Words drawn from the Zipfian vocabulary at a time
+SAMPLE_BATCH = 1 << 20
+
+# Fraction of a shop's words drawn from its category's ranking of the vocabulary
+# (the rest follow the global ranking, shared by every shop)
+CATEGORY_SHARE = 0.6
+
+# Median and spread (of the log) of the number of listings per shop, which
+# are capped at the API's default page of active listings
+LISTINGS_MEDIAN = 8
+LISTINGS_SIGMA = 1.0
+MAX_LISTINGS = 25
+
+# Values of the listings' enumerated fields, as returned by the Etsy API
+WHO_MADE = ['i_did', 'collective', 'someone_else']
+WHEN_MADE = ['made_to_order', '2010_2015', '2000_2009', 'before_1995', '1990s', '1980s', '1970s']
+RECIPIENTS = ['men', 'women', 'unisex_adults', 'teen_boys', 'teen_girls', 'children', 'babies', 'pets']
+OCCASIONS = ['anniversary', 'baby_shower', 'birthday', 'christmas', 'graduation', 'halloween', 'wedding']
+
+def main():
+
+    # Command line arguments (2):
+    #         1. the number of shops to generate,
+    #         2. the name of the output file: .jsonl (or .jsonl.gz) for JSON Lines,
+    #            one shop per line, or .json (or .json.gz) for a single array.
+    # Options:
+    #         --seed N: the seed of the random shops (default 0)
+    #         --vocabulary-size N: the number of distinct words (default 200000)
+    #         --zipf-exponent S: the exponent of the words' Zipfian frequencies (default 1.0)
+    #         --categories N: the number of shop categories, each favoring its own words (default 200)
+    # Output: a file of synthetic shops with the fields get_similar_shops.py reads,
+    #         the same for the same seed and options (and the first N shops of a
+    #         larger file are the N shops of a smaller one)
+
+    # Check command line arguments
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        num_shops = int(args[0])
+        output_file = args[1]
+    except:
+        e = sys.exc_info()[0]
+        logging.error("We had an error with command line args: " + str(e))
+        return
+
+    generator = SyntheticShops(options['seed'], options['vocabulary_size'], options['zipf_exponent'], options['categories'])
+    writer = RecordWriter(output_file, flush_every=1000)
+    try:
+        for shop in generator.iter_shops(num_shops):
+            writer.write(shop)
+    finally:
+        writer.close()
+    logging.info("Wrote " + str(writer.count) + " shops to " + output_file + ".")
+
+class SyntheticShops(object):
+
+    # Generates shops shaped like those written by get_shops.py, with words drawn
+    # from a Zipfian vocabulary. Each shop belongs to a category with its own
+    # ranking of the vocabulary, so shops of a category share their common words.
+    # Words and the rest of the shops are drawn from separate random streams,
+    # so the shops are the same however many are generated.
+
+    def __init__(self, seed=0, vocabulary_size=200000, zipf_exponent=1.0, num_categories=200):
+
+        # Input: the seed of the random shops, the number of distinct words,
+        #        the exponent of the words' Zipfian frequencies,
+        #        and the number of shop categories
+
+        self.words = [get_word(rank) for rank in range(vocabulary_size)]
+        frequencies = 1.0 / np.arange(1, vocabulary_size + 1) ** zipf_exponent
+        self.cumulative = np.cumsum(frequencies / frequencies.sum())
+        self.num_categories = num_categories
+        self.category_offsets = np.random.RandomState([seed, 0]).randint(0, vocabulary_size, num_categories).tolist()
+        self.word_random = np.random.RandomState([seed, 1])
+        self.shop_random = np.random.RandomState([seed, 2])
+        self.ranks = []
+        self.shared = []
+        self.position = 0
+
+    def iter_shops(self, num_shops):
+
+        # Input: the number of shops to generate
+        # Output: yields each synthetic shop
+
+        for shop_id in xrange(num_shops):
+            yield self.get_shop(shop_id)
+
+    def get_shop(self, shop_id):
+
+        # Input: the shop's number (used for its ids and name)
+        # Output: a shop with listings, a user profile, an about,
+        #         an announcement and user teams
+
+        random = self.shop_random
+        category = random.randint(self.num_categories)
+        num_listings = int(min(MAX_LISTINGS, max(1, round(random.lognormal(np.log(LISTINGS_MEDIAN), LISTINGS_SIGMA)))))
+        about = None
+        if random.rand() < 0.5:
+            about = {
+                'story_headline': self.get_text(random.randint(3, 9), category),
+                'story_leading_paragraph': self.get_text(random.randint(10, 40), category),
+                'story': self.get_text(random.randint(20, 150), category),
+            }
+        return {
+            'shop_id': shop_id,
+            'user_id': shop_id,
+            'shop_name': 'SyntheticShop' + str(shop_id),
+            'announcement': self.get_text(random.randint(5, 40), category) if random.rand() < 0.4 else None,
+            'about': about,
+            'user_profile': {
+                'country_id': int(random.randint(50, 250)),
+                'region': self.get_text(1, category) if random.rand() < 0.3 else None,
+                'city': self.get_text(1, category) if random.rand() < 0.3 else None,
+                'materials': '.'.join(self.get_words(random.randint(1, 5), category)) if random.rand() < 0.2 else None,
+            },
+            'user_teams': [{'tags': self.get_words(random.randint(1, 6), category)} for i in range(random.poisson(0.3))],
+            'listings': [self.get_listing(shop_id * MAX_LISTINGS + i, category) for i in range(num_listings)],
+        }
+
+    def get_listing(self, listing_id, category):
+
+        # Input: the listing's id and its shop's category
+        # Output: a listing with tags, materials, category path, style, title,
+        #         description and enumerated fields
+
+        random = self.shop_random
+        return {
+            'listing_id': listing_id,
+            'tags': self.get_words(random.randint(0, 14), category),
+            'materials': self.get_words(random.randint(0, 6), category),
+            'category_path': [self.words[(self.category_offsets[category] + i) % len(self.words)] for i in range(random.randint(1, 4))],
+            'style': self.get_words(random.randint(0, 3), category) or None,
+            'title': self.get_text(random.randint(3, 15), category),
+            'description': self.get_text(random.randint(10, 120), category),
+            'who_made': WHO_MADE[random.randint(len(WHO_MADE))],
+            'when_made': WHEN_MADE[random.randint(len(WHEN_MADE))],
+            'recipient': RECIPIENTS[random.randint(len(RECIPIENTS))] if random.rand() < 0.3 else None,
+            'occasion': OCCASIONS[random.randint(len(OCCASIONS))] if random.rand() < 0.3 else None,
+        }
+
+    def get_text(self, count, category):
+
+        # Input: the number of words and the shop's category
+        # Output: a string of the words, separated by spaces
+
+        return ' '.join(self.get_words(count, category))
+
+    def get_words(self, count, category):
+
+        # Input: the number of words and the shop's category
+        # Output: a list of words drawn from the category's Zipfian ranking
+        #         of the vocabulary, or from the global one
+
+        if self.position + count > len(self.ranks):
+            # Draw the next batch of word ranks, and whether each follows the global ranking
+            ranks = np.searchsorted(self.cumulative, self.word_random.rand(SAMPLE_BATCH + count))
+            shared = self.word_random.rand(SAMPLE_BATCH + count) >= CATEGORY_SHARE
+            self.ranks = self.ranks[self.position:] + np.minimum(ranks, len(self.words) - 1).tolist()
+            self.shared = self.shared[self.position:] + shared.tolist()
+            self.position = 0
+        words = self.words
+        offset = self.category_offsets[category]
+        stop = self.position + count
+        chosen = [
+            words[rank] if shared else words[(rank + offset) % len(words)]
+            for rank, shared in zip(self.ranks[self.position:stop], self.shared[self.position:stop])
+        ]
+        self.position = stop
+        return chosen
+
+def get_word(rank):
+
+    # Input: a vocabulary rank
+    # Output: a distinct word of two or more syllables spelling out the rank
+
+    syllables = [SYLLABLES[rank % len(SYLLABLES)]]
+    rank //= len(SYLLABLES)
+    while rank or len(syllables) < 2:
+        syllables.append(SYLLABLES[rank % len(SYLLABLES)])
+        rank //= len(SYLLABLES)
+    return ''.join(syllables)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import math
+import numpy as np
+
+class Vocabulary(object):
+
+    # Interns terms as consecutive integer ids, so that shop vectors hold small
+    # integers instead of repeated term strings, and are compared without hashing
+
+    def __init__(self, terms=None):
+
+        # Input: (optional) a list of terms to intern, in id order
+
+        self.ids = {}
+        self.terms = []
+        for term in terms or []:
+            self.get_id(term)
+
+    def get_id(self, term):
+
+        # Input: a term
+        # Output: the term's id, assigning the next id to a term not seen before
+
+        id = self.ids.get(term)
+        if id is None:
+            id = len(self.terms)
+            self.ids[term] = id
+            self.terms.append(term)
+        return id
+
+    def __len__(self):
+
+        return len(self.terms)
+
+class TermVector(object):
+
+    # A sparse vector of term counts or weights, held as parallel arrays of
+    # ascending term ids and their values, with its euclidean norm precomputed
+
+    __slots__ = ('ids', 'values', 'norm')
+
+    def __init__(self, ids, values):
+
+        # Input: an array of ascending term ids and an array of their values
+
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.norm = math.sqrt(np.dot(self.values, self.values))
+
+    def __len__(self):
+
+        return len(self.ids)
+
+    def with_values(self, values):
+
+        # Input: an array of new values, one per term of this vector
+        # Output: a vector of the same terms with the new values
+
+        return TermVector(self.ids, values)
+
+def get_term_vector(term_counts, vocabulary, add_terms=True):
+
+    # Input: a hash from term to count (or weight), a Vocabulary, and whether to
+    #        intern new terms (if not, terms missing from the vocabulary are dropped)
+    # Output: the hash as a TermVector
+
+    if add_terms:
+        # (new terms are interned in sorted order, so ids never depend on hash order)
+        for term in sorted([term for term in term_counts if term not in vocabulary.ids]):
+            vocabulary.get_id(term)
+        terms = term_counts.keys()
+    else:
+        terms = [term for term in term_counts if term in vocabulary.ids]
+    ids = np.array([vocabulary.ids[term] for term in terms], dtype=np.int32)
+    order = np.argsort(ids)
+    return TermVector(ids[order], np.array([term_counts[term] for term in terms], dtype=np.float64)[order])
+
+def get_document_counts(vectors, num_terms):
+
+    # Input: a list of TermVectors and the size of their vocabulary
+    # Output: an array of the number of vectors which contain each term id
+
+    if not vectors:
+        return np.zeros(num_terms, dtype=np.int64)
+    return np.bincount(np.concatenate([vector.ids for vector in vectors]), minlength=num_terms)
+
+def get_term_filter(vectors, num_terms, min_count=1, min_documents=1, max_document_fraction=1.0, max_terms=0):
+
+    # Input: a list of TermVectors of term counts, the size of their vocabulary,
+    #        the fewest times a term must appear in the whole corpus, the fewest
+    #        vectors that must contain it, the largest fraction of vectors that
+    #        may contain it, and (if not 0) the most terms to keep, keeping those
+    #        in the most vectors
+    # Output: an array marking the term ids that pass every filter, counted in
+    #         a single pass over the vectors
+
+    if vectors:
+        ids = np.concatenate([vector.ids for vector in vectors])
+        counts = np.concatenate([vector.values for vector in vectors])
+    else:
+        ids = np.zeros(0, dtype=np.int32)
+        counts = np.zeros(0)
+    corpus_counts = np.bincount(ids, counts, minlength=num_terms)
+    document_counts = np.bincount(ids, minlength=num_terms)
+    keep = (
+        (corpus_counts >= min_count) 
+        & (document_counts >= min_documents) 
+        & (document_counts <= max_document_fraction * len(vectors))
+    )
+    if max_terms and keep.sum() > max_terms:
+        ranked = np.argsort(-document_counts, kind='mergesort')
+        ranked = ranked[keep[ranked]]
+        keep[ranked[max_terms:]] = False
+    return keep
+
+def prune_vocabulary(vectors, vocabulary, keep):
+
+    # Input: a list of TermVectors, their Vocabulary, and an array marking
+    #        the term ids to keep
+    # Output: a (Vocabulary, vectors) pair holding only the kept terms,
+    #         renumbered in the same order
+
+    new_ids = np.cumsum(keep) - 1
+    pruned = []
+    for vector in vectors:
+        kept = keep[vector.ids]
+        pruned.append(TermVector(new_ids[vector.ids[kept]], vector.values[kept]))
+    return Vocabulary([vocabulary.terms[id] for id in np.flatnonzero(keep)]), pruned
+
+def get_dot_products(vector, others):
+
+    # Input: a TermVector and a list of other TermVectors
+    # Output: a list of the dot product of the vector with each of the others
+
+    if not others:
+        return []
+    lengths = np.array([len(other) for other in others])
+    if not len(vector) or not lengths.sum():
+        return [0.0] * len(others)
+
+    # Look up all of the others' terms in the vector's sorted ids at once,
+    # and sum each other vector's products of shared terms
+    ids = np.concatenate([other.ids for other in others])
+    values = np.concatenate([other.values for other in others])
+    positions = np.searchsorted(vector.ids, ids)
+    positions[positions == len(vector)] = 0
+    products = np.where(vector.ids[positions] == ids, values * vector.values[positions], 0.0)
+    owners = np.repeat(np.arange(len(others)), lengths)
+    return np.bincount(owners, weights=products, minlength=len(others)).tolist()
+
+def get_top_terms(vector, vocabulary, count):
+
+    # Input: a TermVector, its Vocabulary, and the number of terms to return
+    # Output: a list of the (term, value) pairs with the highest values,
+    #         in descending order of value
+
+    order = np.argsort(-vector.values, kind='mergesort')[:count]
+    return [(vocabulary.terms[vector.ids[i]], float(vector.values[i])) for i in order]
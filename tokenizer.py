@@ -0,0 +1,144 @@
+import re
+import logging
+import multiprocessing
+
+# Runs of characters that separate the tokens of a term
+SEPARATORS = re.compile('[^0-9a-zA-Z]+')
+
+# Most distinct raw terms (and tokens) whose cleaned forms are remembered
+CACHE_SIZE = 200000
+
+# Records handed to a worker process at a time by map_processes
+RECORDS_PER_TASK = 50
+
+class Tokenizer(object):
+
+    # Cleans raw terms into lowercase alphanumeric tokens, optionally lemmatized
+    # with NLTK's WordNet lemmatizer (created once, and only when needed).
+    # Shop terms repeat heavily, so the tokens of each distinct raw term and the
+    # lemma of each distinct token are memoized, in caches that stop growing
+    # once they hold cache_size entries.
+
+    def __init__(self, lemmatize=False, lower_first=False, cache_size=CACHE_SIZE):
+
+        # Input: whether to lemmatize tokens, whether to lowercase terms before
+        #        (rather than after) removing non-alphanumeric characters,
+        #        and the most entries to keep in each cache
+
+        self.lower_first = lower_first
+        self.cache_size = cache_size
+        self.lemmatizer = None
+        if lemmatize:
+            from nltk.stem.wordnet import WordNetLemmatizer
+            self.lemmatizer = WordNetLemmatizer()
+        self.term_cache = {}
+        self.lemma_cache = {}
+        self.counts = get_empty_counts()
+
+    def clean_terms(self, terms):
+
+        # Input: a list of terms
+        # Output: a list of these terms with non-alphanumeric characters removed,
+        #         converted to lowercase, tokenized, and (optionally) lemmatized
+
+        cleaned = []
+        cache = self.term_cache
+        for term in terms:
+            tokens = cache.get(term)
+            if tokens is None:
+                self.counts['term_misses'] += 1
+                tokens = self.clean_term(term)
+                if len(cache) < self.cache_size:
+                    cache[term] = tokens
+            else:
+                self.counts['term_hits'] += 1
+            cleaned += tokens
+        return cleaned
+
+    def clean_term(self, term):
+
+        # Input: a term
+        # Output: a tuple of the term's cleaned tokens
+
+        if self.lower_first:
+            tokens = SEPARATORS.sub(' ', term.lower()).split()
+        else:
+            tokens = SEPARATORS.sub(' ', term).lower().split()
+        if self.lemmatizer:
+            tokens = [self.lemmatize(token) for token in tokens]
+        return tuple(tokens)
+
+    def lemmatize(self, token):
+
+        # Input: a lowercase token
+        # Output: the token's lemma
+
+        lemma = self.lemma_cache.get(token)
+        if lemma is None:
+            self.counts['lemma_misses'] += 1
+            lemma = self.lemmatizer.lemmatize(token)
+            if len(self.lemma_cache) < self.cache_size:
+                self.lemma_cache[token] = lemma
+        else:
+            self.counts['lemma_hits'] += 1
+        return lemma
+
+    def take_counts(self):
+
+        # Output: the cache hit and miss counts since they were last taken
+        #         (for sending from a worker process), which are then reset
+
+        counts = self.counts
+        self.counts = get_empty_counts()
+        return counts
+
+def get_empty_counts():
+
+    # Output: a hash of zeroed cache hit and miss counts
+
+    return {'term_hits': 0, 'term_misses': 0, 'lemma_hits': 0, 'lemma_misses': 0}
+
+def add_counts(total, counts):
+
+    # Input: a hash of cache hit and miss counts, and another to add to it
+    # Output: adds the second hash's counts into the first
+
+    for key in counts:
+        total[key] += counts[key]
+
+def log_counts(counts):
+
+    # Input: a hash of cache hit and miss counts
+    # Output: logs the hit rate of the term and lemma caches
+
+    for cache in ('term', 'lemma'):
+        hits = counts[cache + '_hits']
+        lookups = hits + counts[cache + '_misses']
+        if lookups:
+            logging.info(
+                "Tokenizer " + cache + " cache: " + str(lookups) + " lookups, "
+                + str(hits) + " hits (" + str(round(100.0 * hits / lookups, 1)) + "%)."
+            )
+
+def map_processes(function, records, workers, initializer=None, initargs=()):
+
+    # Input: a function of one argument, an iterable of arguments (such as a
+    #        stream of records), the number of worker processes (1 to run in
+    #        this process), and (optional) a function and arguments to set up
+    #        each worker with
+    # Output: yields the function's result for each argument, in argument order
+
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        for record in records:
+            yield function(record)
+        return
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        for result in pool.imap(function, records, RECORDS_PER_TASK):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+
+# Treasuries inserted into a store built from a treasuries file at a time
+INSERT_BATCH = 1000
+
+# Listing ids looked up per query (below SQLite's limit on query parameters)
+QUERY_BATCH = 500
+
+def write_treasury_store(treasuries, file_name):
+
+    # Input: a list (or stream) of treasuries, and the name of the store file
+    # Output: saves an SQLite store of each treasury's tags and of the treasuries
+    #         containing each listing, indexed by listing id, reading the
+    #         treasuries in a single pass; returns the number of treasuries saved
+
+    # The store is built under a temporary name, so an interrupted build
+    # never leaves an incomplete store behind
+    temp_file = file_name + '.tmp'
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    writer = TreasuryStoreWriter(temp_file, flush_every=INSERT_BATCH)
+    try:
+        for treasury in treasuries:
+            writer.write(treasury)
+    finally:
+        writer.close()
+    os.rename(temp_file, file_name)
+    return writer.count
+
+class TreasuryStoreWriter(object):
+
+    # Adds treasuries to a store as they arrive, with the same interface as
+    # record_stream.RecordWriter (keyed by treasury id), so a crawl can insert
+    # each page into the store instead of writing a treasuries file. Every
+    # flush commits, so an interrupted crawl keeps the treasuries flushed so far.
+
+    def __init__(self, file_name, resume=False, flush_every=100):
+
+        # Input: the store file name, whether to keep the treasuries of an
+        #        earlier run's store (otherwise it is replaced), and the number
+        #        of treasuries written between flushes
+
+        if not resume and os.path.exists(file_name):
+            os.remove(file_name)
+        self.file_name = file_name
+        self.flush_every = flush_every
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS treasuries (treasury_id TEXT PRIMARY KEY, tags TEXT)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS listing_treasuries (listing_id INTEGER, treasury_id TEXT, '
+            'PRIMARY KEY (listing_id, treasury_id)) WITHOUT ROWID'
+        )
+        self.keys = set(row[0] for row in self.connection.execute('SELECT treasury_id FROM treasuries'))
+        self.count = len(self.keys)
+        self.replaced = set()
+        self.pending = []
+
+    def write(self, treasury):
+
+        # Input: a treasury
+        # Output: queues the treasury for the store, flushing every flush_every treasuries
+
+        self.pending.append(treasury)
+        if treasury['id'] in self.keys:
+            self.replaced.add(treasury['id'])
+        else:
+            self.keys.add(treasury['id'])
+            self.count += 1
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+
+        # Output: inserts the queued treasuries and commits them
+
+        insert_treasuries(self.connection, self.pending, self.replaced)
+        self.connection.commit()
+        self.pending = []
+        self.replaced = set()
+
+    def close(self):
+
+        # Output: flushes the queued treasuries and closes the store, leaving
+        #         it as a single file (without its write-ahead log)
+
+        self.flush()
+        self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.close()
+
+def insert_treasuries(connection, treasuries, replaced=()):
+
+    # Input: an open store connection, a list of treasuries, and the ids of
+    #        those that may already be in the store
+    # Output: inserts the treasuries' tags and listing ids into the store
+    #         (a treasury seen again replaces its tags and listings)
+
+    # Only the last copy of a treasury counts. The old listings of a replaced
+    # treasury are deleted before its current ones are inserted, in the caller's
+    # transaction. The index this needs is only built once a treasury is
+    # replaced, so a store built from distinct treasuries carries no extra index
+    treasuries = dict((treasury['id'], treasury) for treasury in treasuries).values()
+    if replaced:
+        connection.execute('CREATE INDEX IF NOT EXISTS treasury_listings ON listing_treasuries (treasury_id)')
+        connection.executemany(
+            'DELETE FROM listing_treasuries WHERE treasury_id = ?',
+            [(treasury_id,) for treasury_id in replaced]
+        )
+    connection.executemany(
+        'INSERT OR REPLACE INTO treasuries VALUES (?, ?)',
+        [(treasury['id'], json.dumps(treasury['tags'] or [])) for treasury in treasuries]
+    )
+    connection.executemany(
+        'INSERT OR IGNORE INTO listing_treasuries VALUES (?, ?)',
+        [
+            (listing['data']['listing_id'], treasury['id'])
+            for treasury in treasuries
+            for listing in treasury['listings']
+        ]
+    )
+
+class TreasuryStore(object):
+
+    # A store written by write_treasury_store, opened without loading it:
+    # each lookup reads just the index pages of the listings it asks for
+
+    def __init__(self, file_name):
+
+        # Input: the name of a store file written by write_treasury_store
+
+        if not os.path.isfile(file_name):
+            raise IOError("No treasury store found at " + file_name)
+        self.connection = sqlite3.connect(file_name)
+
+    def get_tags(self, listing_ids):
+
+        # Input: a list of listing ids
+        # Output: a (tags, found) pair of the list of the tags of every treasury
+        #         containing each listing (repeated for each such listing), and
+        #         the number of listings found in any treasury
+
+        tags = []
+        found = set()
+        listing_ids = list(set(listing_ids))
+        for start in xrange(0, len(listing_ids), QUERY_BATCH):
+            batch = listing_ids[start:start + QUERY_BATCH]
+            rows = self.connection.execute(
+                'SELECT listing_treasuries.listing_id, treasuries.tags FROM listing_treasuries '
+                'JOIN treasuries ON treasuries.treasury_id = listing_treasuries.treasury_id '
+                'WHERE listing_treasuries.listing_id IN (' + ','.join(['?'] * len(batch)) + ')',
+                batch
+            )
+            for listing_id, treasury_tags in rows:
+                found.add(listing_id)
+                tags += json.loads(treasury_tags)
+        return tags, len(found)
+
+    def get_counts(self):
+
+        # Output: a (treasuries, listings) pair of the number of treasuries
+        #         in the store and of the distinct listings they contain
+
+        treasuries = self.connection.execute('SELECT COUNT(*) FROM treasuries').fetchone()[0]
+        listings = self.connection.execute('SELECT COUNT(DISTINCT listing_id) FROM listing_treasuries').fetchone()[0]
+        return treasuries, listings
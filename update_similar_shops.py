@@ -0,0 +1,365 @@
+import sys
+import time
+import logging
+import numpy as np
+from scipy import sparse
+from command_line import parse_options
+from record_stream import iter_records
+from similarity_engine import get_term_matrix, normalize_rows, get_top_similar
+from similarity_model import NEIGHBORS, load_model, save_model, get_neighbors
+from sharded_index import merge_top
+from lsi_backends import project
+from term_vectors import Vocabulary
+
+logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+
+# Command line options and their defaults
+OPTIONS = {
+    'remove': None,
+    'tolerance': 0.01,
+    'approximate': False,
+}
+
+# Allowance for the float32 rounding of the saved similarities and floors
+ROUNDING = 1e-6
+
+def main():
+
+    # Command line arguments (3):
+    #         1. the name of a model directory saved by get_similar_shops.py or
+    #            get_similar_shops_lsi.py with --save-model,
+    #         2. (optional) the name of a shops file (.json array or .jsonl,
+    #            optionally .gz) of added shops, and of changed shops to replace,
+    #         3. (optional) the name of a treasury store file made by
+    #            make_treasury_hashes.py (the same store the model was fit with)
+    # Options:
+    #         --remove FILE: a .json array or JSON Lines file of the names of shops to remove
+    #         --tolerance D: treat shops whose vectors moved farther than distance D
+    #                        (default 0.01) like changed shops, scoring their lists
+    #                        again and merging them into the others; smaller moves
+    #                        are covered by each list's margin, so the lists are exact
+    #                        either way, and D only trades one kind of work for the other
+    #         --approximate: keep the lists of shops which moved less than the tolerance
+    #                        without checking their margins (faster, but a similarity
+    #                        between two such shops may be off by up to twice the
+    #                        tolerance, until a later update without --approximate)
+    # Output: applies the delta to the model, replacing its directory with the
+    #         updated model (servers which loaded it keep serving the old model
+    #         until they are restarted), and prints the five most similar shops
+    #         to each shop whose list of similar shops changed.
+    # Algorithm: the shops' term counts and the document counts are updated with
+    #            the delta and every shop's vector is reweighted by the new idfs
+    #            (LSI models fold shops into their saved topics rather than
+    #            refitting them). Each saved list keeps a floor, the similarity
+    #            of the next most similar shop. Only the lists of shops which
+    #            changed, moved past the tolerance, or lost a similar shop, and
+    #            lists whose weakest similar shop may have moved below the floor
+    #            plus the most any other shop moved, are scored again; the other
+    #            lists just merge in the changed shops that now beat them.
+
+    # Check command line arguments and load the model and delta
+    try:
+        args, options = parse_options(sys.argv[1:], OPTIONS)
+        model = load_model(args[0])
+        if not model.get('has_counts'):
+            raise ValueError("Model " + args[0] + " has no term counts; rebuild it with --save-model.")
+        if len(args) > 2:
+            treasury_file = args[2]
+        else:
+            treasury_file = None
+        vocabulary = Vocabulary(model['vocabulary'])
+        if len(args) > 1:
+            shops = read_delta(model['model'], args[1], treasury_file, vocabulary)
+        else:
+            shops = []
+        if options['remove']:
+            removed = set(iter_records(options['remove']))
+        else:
+            removed = set()
+        logging.info(
+            "Loaded " + model['model'] + " model with " + str(model['num_shops']) + " shops, and a delta of "
+            + str(len(shops)) + " added or changed and " + str(len(removed)) + " removed shops."
+        )
+    except:
+        e = sys.exc_info()[0]
+        logging.error("We had an error with command line args: " + str(e))
+        return
+
+    # Update the term counts and document counts, and reweight every shop
+    start = time.time()
+    update = apply_delta(model, shops, removed, vocabulary)
+    idfs = get_idfs(model['model'], update['document_counts'], len(update['shop_names']))
+    projection = None
+    if model['model'] == 'lsi':
+        # (terms new to the model have no topics until it is refit)
+        projection = np.zeros((len(vocabulary), model['num_topics']))
+        projection[:model['projection'].shape[0]] = model['projection']
+    query_vectors, index_vectors = get_vectors(update['counts'], idfs, projection)
+
+    # Score the lists that may have changed again, and merge the rest
+    neighbors, changed, counts = update_neighbors(model, update, query_vectors, index_vectors, options['tolerance'], options['approximate'])
+    logging.info(
+        "Updated the model to " + str(len(update['shop_names'])) + " shops and " + str(len(vocabulary)) + " terms, "
+        + "scoring " + str(counts['scored']) + " lists again and merging into " + str(counts['merged'])
+        + " (" + str(counts['moved']) + " shops moved) in " + str(round(time.time() - start, 2)) + "s."
+    )
+
+    save_model(
+        args[0],
+        model['model'],
+        update['shop_names'],
+        vocabulary.terms,
+        update['document_counts'],
+        idfs,
+        query_vectors,
+        index_vectors,
+        projection,
+        counts=update['counts'],
+        neighbors=neighbors,
+        ivf_lists=model.get('ivf_lists', 0),
+        nprobe=model.get('nprobe', 1)
+    )
+
+    # Print the five most similar shops to each shop whose list changed
+    names = update['shop_names']
+    for i in np.flatnonzero(changed):
+        similar = [names[j] for j in neighbors[0][i] if j >= 0]
+        if similar:
+            print names[i] + ": " + ", ".join(similar)
+        else:
+            print names[i] + ":  No similar shops were found!"
+
+def read_delta(model, file_name, treasury_file, vocabulary):
+
+    # Input: the kind of model ("tfidf" or "lsi"), the name of a shops file,
+    #        the name of a treasury store file (or None), and the model's
+    #        Vocabulary (new terms are added to it)
+    # Output: a list of compact shop objects with 'shop_name' and 'term_counts',
+    #         whose terms are extracted by the script that fit the model
+
+    if model == 'lsi':
+        import get_similar_shops_lsi as script
+    else:
+        import get_similar_shops as script
+    return script.read_shops(file_name, treasury_file, vocabulary)
+
+def apply_delta(model, shops, removed, vocabulary):
+
+    # Input: a model from load_model, a list of added or changed shop objects,
+    #        a set of the names of shops to remove, and the updated Vocabulary
+    # Output: a hash of the updated 'shop_names', the 'old_rows' each shop had
+    #         in the model (-1 for added shops), which shops are 'dirty' (added
+    #         or changed), and the updated 'counts' matrix and 'document_counts'
+
+    delta = dict((shop['shop_name'], shop['term_counts']) for shop in shops)
+    names = []
+    old_rows = []
+    vectors = []
+    for i, name in enumerate(model['shop_names']):
+        if name not in removed:
+            names.append(name)
+            old_rows.append(i)
+            vectors.append(delta.pop(name, None))
+    for shop in shops:
+        if shop['shop_name'] in delta and shop['shop_name'] not in removed:
+            names.append(shop['shop_name'])
+            old_rows.append(-1)
+            vectors.append(delta.pop(shop['shop_name']))
+    old_rows = np.array(old_rows, dtype=np.int64)
+    dirty = np.array([vector is not None for vector in vectors], dtype=bool)
+
+    # Stack the unchanged shops' counts with the new ones, in the new shop order
+    old_counts = resize_columns(model['counts'], len(vocabulary))
+    new_counts = get_term_matrix([vector for vector in vectors if vector is not None], len(vocabulary))
+    sources = old_rows.copy()
+    sources[dirty] = old_counts.shape[0] + np.arange(dirty.sum())
+    counts = sparse.vstack([old_counts, new_counts]).tocsr()[sources]
+
+    # Take the replaced and removed shops' terms out of the document counts,
+    # and the added and changed shops' terms in
+    kept = np.zeros(old_counts.shape[0], dtype=bool)
+    kept[old_rows[~dirty]] = True
+    document_counts = np.zeros(len(vocabulary), dtype=np.int64)
+    document_counts[:len(model['document_counts'])] = model['document_counts']
+    document_counts -= np.bincount(old_counts[np.flatnonzero(~kept)].indices, minlength=len(vocabulary))
+    document_counts += np.bincount(new_counts.indices, minlength=len(vocabulary))
+    return {
+        'shop_names': names,
+        'old_rows': old_rows,
+        'dirty': dirty,
+        'counts': counts,
+        'document_counts': document_counts,
+    }
+
+def get_idfs(model, document_counts, num_shops):
+
+    # Input: the kind of model, an array of the number of shops using each term,
+    #        and the number of shops
+    # Output: an array of each term's idf, as the script that fit the model
+    #         computes it (log2 for LSI, following Gensim), and 0 for unused terms
+
+    idfs = np.zeros(len(document_counts))
+    used = document_counts > 0
+    idfs[used] = np.log(float(num_shops) / document_counts[used])
+    if model == 'lsi':
+        idfs /= np.log(2)
+    return idfs
+
+def get_vectors(counts, idfs, projection=None):
+
+    # Input: the sparse matrix of shop term counts, an array of term idfs,
+    #        and (for LSI models) the term to topic projection matrix
+    # Output: the (query, index) matrices of normalized shop vectors, which are
+    #         the same sparse matrix for tf-idf, and dense float32 matrices for LSI
+
+    if projection is not None:
+        weights = counts.dot(sparse.diags(idfs)).tocsr()
+        return project(weights, projection, 0, counts.shape[0]), project(counts, projection, 0, counts.shape[0])
+
+    # Weight the counts with the augmented norm for term frequency, as the
+    # tf-idf script does (see get_term_weights in get_similar_shops.py)
+    max_counts = np.maximum(1, counts.max(axis=1).toarray().ravel())
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    data = (0.5 + 0.5 * counts.data / max_counts[rows]) * idfs[counts.indices]
+    matrix = normalize_rows(sparse.csr_matrix((data, counts.indices, counts.indptr), shape=counts.shape))
+    return matrix, matrix
+
+def update_neighbors(model, update, query_vectors, index_vectors, tolerance, approximate=False):
+
+    # Input: a model from load_model, the hash from apply_delta, the updated
+    #        query and index vectors, the distance a shop's vectors may move
+    #        before it is merged into every kept list like a changed shop,
+    #        and whether to keep lists without checking their margins
+    # Output: a ((shop indexes, similarities, floors), changed, counts) tuple, of
+    #         each shop's NEIGHBORS most similar shops and floor (see get_neighbors),
+    #         an array marking the shops whose list changed, and a hash counting
+    #         the lists scored again and merged into and the shops that moved
+
+    num_shops = len(update['shop_names'])
+    old_rows = update['old_rows']
+
+    # Measure how far each carried shop's vectors moved; shops which were added
+    # or changed, or moved past the tolerance, are dirty
+    dirty = update['dirty'].copy()
+    carried = np.flatnonzero(~dirty)
+    query_moves = np.zeros(num_shops)
+    query_moves[carried] = get_distances(query_vectors[carried], resize_columns(model['query_vectors'], query_vectors.shape[1])[old_rows[carried]])
+    if model['shared_index']:
+        index_moves = query_moves
+    else:
+        index_moves = np.zeros(num_shops)
+        index_moves[carried] = get_distances(index_vectors[carried], model['index_vectors'][old_rows[carried]])
+    moved = np.maximum(query_moves, index_moves)[carried] > tolerance
+    dirty[carried[moved]] = True
+
+    # For unit vectors, a pair's similarity changes by at most the sum of
+    # the distances the two shops moved, so no clean shop off a list can now
+    # score more than the list's floor plus the shop's own move plus slack
+    clean = ~dirty
+    slack = index_moves[clean].max() if clean.any() else 0.0
+
+    # Map the model's lists to the new shop indexes. The lists of dirty shops,
+    # of shops that lost a similar shop, and of shops whose weakest similar
+    # shop might have fallen below some clean shop off the list are scored again
+    old_neighbors = np.full((num_shops, NEIGHBORS), -1, dtype=np.int64)
+    old_scores = np.zeros((num_shops, NEIGHBORS))
+    old_floors = np.zeros(num_shops)
+    rescore = dirty.copy()
+    if model.get('num_neighbors'):
+        known = np.flatnonzero(old_rows >= 0)
+        new_rows = np.full(len(model['shop_names']), -1, dtype=np.int64)
+        new_rows[old_rows[known]] = known
+        listed = np.array(model['neighbors'])[old_rows[known], :NEIGHBORS]
+        mapped = np.where(listed >= 0, new_rows[np.maximum(listed, 0)], -1)
+        lost = ((listed >= 0) & ((mapped < 0) | dirty[np.maximum(mapped, 0)])).any(axis=1)
+        old_neighbors[known, :listed.shape[1]] = mapped
+        old_scores[known, :listed.shape[1]] = np.array(model['neighbor_scores'])[old_rows[known], :NEIGHBORS]
+        old_floors[known] = np.array(model['neighbor_floors'])[old_rows[known]]
+        rescore[known[lost]] = True
+
+        # (an empty slot is only kept from shops scoring 0 or less)
+        lowest = np.where(
+            old_neighbors >= 0,
+            old_scores - index_moves[np.maximum(old_neighbors, 0)],
+            0.0
+        ).min(axis=1) - query_moves
+        highest = old_floors + query_moves + slack
+        if not approximate:
+            rescore |= lowest <= highest + 2 * ROUNDING
+    else:
+        rescore[:] = True
+
+    neighbors = np.full((num_shops, NEIGHBORS), -1, dtype=np.int64)
+    scores = np.zeros((num_shops, NEIGHBORS), dtype=np.float32)
+    floors = np.zeros(num_shops, dtype=np.float32)
+    rows = np.flatnonzero(rescore)
+    neighbors[rows], scores[rows], floors[rows] = get_neighbors(query_vectors, index_vectors, rows)
+
+    # Rescore the kept lists with the new vectors, and merge in the dirty
+    # shops which now beat them (the best shop left over raises the floor)
+    rows = np.flatnonzero(~rescore)
+    listed = old_neighbors[rows]
+    list_rows, list_slots = np.nonzero(listed >= 0)
+    candidates = [
+        list_rows,
+        listed[list_rows, list_slots],
+        get_row_dots(query_vectors[rows[list_rows]], index_vectors[listed[list_rows, list_slots]])
+    ]
+    dirty_rows = np.flatnonzero(dirty)
+    if len(rows) and len(dirty_rows):
+        for offset, top in get_top_similar(query_vectors[rows], index_vectors[dirty_rows], NEIGHBORS + 1):
+            candidates[0] = np.concatenate([candidates[0], [offset] * len(top)])
+            candidates[1] = np.concatenate([candidates[1], [dirty_rows[pair[0]] for pair in top]])
+            candidates[2] = np.concatenate([candidates[2], [pair[1] for pair in top]])
+    merged_rows, merged_columns, merged_scores = merge_top(
+        candidates[0].astype(np.int64),
+        candidates[1].astype(np.int64),
+        candidates[2].astype(np.float32),
+        NEIGHBORS + 1
+    )
+    slots = np.arange(len(merged_rows)) - np.searchsorted(merged_rows, merged_rows)
+    listed = slots < NEIGHBORS
+    neighbors[rows[merged_rows[listed]], slots[listed]] = merged_columns[listed]
+    scores[rows[merged_rows[listed]], slots[listed]] = merged_scores[listed]
+    floors[rows] = old_floors[rows] + query_moves[rows] + slack
+    left_over = rows[merged_rows[~listed]]
+    floors[left_over] = np.maximum(floors[left_over], merged_scores[~listed])
+
+    changed = (neighbors != old_neighbors).any(axis=1)
+    counts = {'scored': int(rescore.sum()), 'merged': len(rows), 'moved': int(moved.sum())}
+    return (neighbors, scores, floors), changed, counts
+
+def get_distances(vectors, other_vectors):
+
+    # Input: two sparse or dense matrices of the same shape
+    # Output: an array of the euclidean distance between each pair of rows
+
+    difference = vectors - other_vectors
+    if sparse.issparse(difference):
+        return np.sqrt(np.asarray(difference.multiply(difference).sum(axis=1)).ravel())
+    return np.sqrt((np.asarray(difference, dtype=np.float64) ** 2).sum(axis=1))
+
+def get_row_dots(vectors, other_vectors):
+
+    # Input: two sparse or dense matrices of the same shape
+    # Output: an array of the dot product of each pair of rows
+
+    if sparse.issparse(vectors):
+        return np.asarray(vectors.multiply(other_vectors).sum(axis=1)).ravel()
+    return (vectors * other_vectors).sum(axis=1)
+
+def resize_columns(matrix, num_columns):
+
+    # Input: a sparse CSR or dense matrix, and a number of columns at least its own
+    # Output: an in-memory copy of the matrix, padded with empty columns
+    #         (dense matrices, whose columns are topics, are just copied)
+
+    if not sparse.issparse(matrix):
+        return np.array(matrix)
+    return sparse.csr_matrix(
+        (np.array(matrix.data), np.array(matrix.indices), np.array(matrix.indptr)),
+        shape=(matrix.shape[0], num_columns)
+    )
+
+if __name__ == '__main__':
+    main()